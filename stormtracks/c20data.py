@@ -1,6 +1,8 @@
 import os
 import time
 import datetime as dt
+import ctypes
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 from netCDF4 import Dataset
@@ -38,14 +40,25 @@ class C20Data(object):
         self._year = year
         self.dx = None
         self.date = None
+        # Running total of (uncompressed) bytes loaded, used for progress reporting.
+        self.bytes_read = 0
 	self.version = version
 	log.info('C20Data: year={}, version={}'.format(year, version))
 
         if fields == 'all':
             # rh995 has been removed.
-            self.fields = ['u9950', 'v9950', 'u850', 'v850', 'prmsl', 't9950', 't850', 'cape', 'pwat']
+            self._set_fields(['u9950', 'v9950', 'u850', 'v850', 'prmsl',
+                              't9950', 't850', 'cape', 'pwat'])
         else:
-            self.fields = fields
+            self._set_fields(fields)
+
+        fields = ', '.join(self.fields)
+	log.info('Using: {}'.format(fields))
+        self._load_datasets(self._year)
+
+    def _set_fields(self, fields):
+        '''Sets the fields to load and which vorticities can be calculated from them'''
+        self.fields = fields
 
         if 'u9950' in self.fields and 'v9950' in self.fields:
             self.calc_9950_vorticity = True
@@ -57,10 +70,6 @@ class C20Data(object):
         else:
             self.calc_850_vorticity = False
 
-        fields = ', '.join(self.fields)
-	log.info('Using: {}'.format(fields))
-        self._load_datasets(self._year)
-
     def set_year(self, year):
         '''Sets a year and loads the relevant dataset'''
         self._year = year
@@ -153,7 +162,8 @@ class C20Data(object):
         '''
         if date != self.date:
             try:
-                log.debug("Setting date to {0}".format(date))
+                # Lazy formatting: this is called for every timestep.
+                log.debug('Setting date to %s', date)
                 index = np.where(self.dates == date)[0][0]
                 self.date = date
                 self._process_ensemble_data(index)
@@ -193,24 +203,23 @@ class C20Data(object):
         start = time.time()
         self._load_ensemble_data(index)
         end = time.time()
-        fields = ', '.join(self.fields)
-        log.debug('  Loaded {0} in {1}'.format(fields, end - start))
+        log.debug('  Loaded %s in %s', self.fields, end - start)
 
         if self.calc_9950_vorticity:
             start = time.time()
             self._calculate_vorticities('9950')
             end = time.time()
-            log.debug('  Calculated 9950 vorticity in {0}'.format(end - start))
+            log.debug('  Calculated 9950 vorticity in %s', end - start)
         if self.calc_850_vorticity:
             start = time.time()
             self._calculate_vorticities('850')
             end = time.time()
-            log.debug('  Calculated 850 vorticity in {0}'.format(end - start))
+            log.debug('  Calculated 850 vorticity in %s', end - start)
 
         start = time.time()
         self._find_min_max_from_fields()
         end = time.time()
-        log.debug('  Found maxima/minima in {0}'.format(end - start))
+        log.debug('  Found maxima/minima in %s', end - start)
 
     def _load_ensemble_data(self, index):
         '''Loads the raw data from the NetCDF4 files'''
@@ -225,44 +234,127 @@ class C20Data(object):
                 setattr(self, field, - self.nc_datasets[field].variables[field][index])
             else:
                 setattr(self, field, self.nc_datasets[field].variables[field][index])
+            self.bytes_read += getattr(self, field).nbytes
 
-    def _calculate_vorticities(self, pressure_level):
+    def _calculate_vorticities(self, pressure_level, ensemble_members=None):
         '''Calculates vort (2nd order) and vort4 (4th order)
 
-        Uses c functions for speed.'''
-        vort = []
+        Uses c functions for speed.
+
+        :param pressure_level: '9950' or '850'
+        :param ensemble_members: members to calculate vorticity for (default all),
+            the vorticity of any other members is left as zeros
+        '''
+        if ensemble_members is None:
+            ensemble_members = range(NUM_ENSEMBLE_MEMBERS)
+
+        u = getattr(self, 'u{}'.format(pressure_level))
+        v = getattr(self, 'v{}'.format(pressure_level))
+        vort = np.zeros_like(u)
         # self.vort4 = []
-        if pressure_level == '9950':
-            for em in range(NUM_ENSEMBLE_MEMBERS):
-                vort.append(self._cvorticity(self.u9950[em], self.v9950[em]))
-                # vort4.append(self._cvorticity4(self.u[em], self.v[em]))
-        elif pressure_level == '850':
-            for em in range(NUM_ENSEMBLE_MEMBERS):
-                vort.append(self._cvorticity(self.u850[em], self.v850[em]))
-                # vort4.append(self._cvorticity4(self.u[em], self.v[em]))
+        for em in ensemble_members:
+            vort[em] = self._cvorticity(u[em], v[em])
+            # vort4.append(self._cvorticity4(u[em], v[em]))
         setattr(self, 'vort{}'.format(pressure_level), vort)
 
-    def _find_min_max_from_fields(self):
-        '''Finds the minima (prmsl) and maxima (vort/vort4)'''
+    def _find_min_max_from_fields(self, ensemble_members=None):
+        '''Finds the minima (prmsl) and maxima (vort/vort4)
+
+        :param ensemble_members: members to find extrema for (default all),
+            any other members get an empty list of extrema
+        '''
+        if ensemble_members is None:
+            ensemble_members = range(NUM_ENSEMBLE_MEMBERS)
+
         if 'prmsl' in self.fields:
-            self.pmins, self.pmaxs = [], []
-            for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
+            self.pmins, self.pmaxs = [[] for em in range(NUM_ENSEMBLE_MEMBERS)], []
+            for ensemble_member in ensemble_members:
                 e, index_pmaxs, index_pmins = cfind_extrema(self.prmsl[ensemble_member])
-                self.pmins.append([(self.prmsl[ensemble_member][pmin[0], pmin[1]], (self.lons[pmin[1]], self.lats[pmin[0]]))
-                              for pmin in index_pmins])
+                self.pmins[ensemble_member] = [
+                    (self.prmsl[ensemble_member][pmin[0], pmin[1]],
+                     (self.lons[pmin[1]], self.lats[pmin[0]]))
+                    for pmin in index_pmins]
 
         if 'u9950' in self.fields and 'v9950' in self.fields:
-            self.vmaxs9950 = []
-            for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
+            self.vmaxs9950 = [[] for em in range(NUM_ENSEMBLE_MEMBERS)]
+            for ensemble_member in ensemble_members:
                 e, index_vmaxs, index_vmins = cfind_extrema(self.vort9950[ensemble_member])
-                self.vmaxs9950.append([
-                    (self.vort9950[ensemble_member][vmax[0], vmax[1]], (self.lons[vmax[1]], self.lats[vmax[0]]))
-                    for vmax in index_vmaxs])
+                self.vmaxs9950[ensemble_member] = [
+                    (self.vort9950[ensemble_member][vmax[0], vmax[1]],
+                     (self.lons[vmax[1]], self.lats[vmax[0]]))
+                    for vmax in index_vmaxs]
 
         if 'u850' in self.fields and 'v850' in self.fields:
-            self.vmaxs850 = []
-            for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
+            self.vmaxs850 = [[] for em in range(NUM_ENSEMBLE_MEMBERS)]
+            for ensemble_member in ensemble_members:
                 e, index_vmaxs, index_vmins = cfind_extrema(self.vort850[ensemble_member])
-                self.vmaxs850.append([
-                    (self.vort850[ensemble_member][vmax[0], vmax[1]], (self.lons[vmax[1]], self.lats[vmax[0]]))
-                    for vmax in index_vmaxs])
+                self.vmaxs850[ensemble_member] = [
+                    (self.vort850[ensemble_member][vmax[0], vmax[1]],
+                     (self.lons[vmax[1]], self.lats[vmax[0]]))
+                    for vmax in index_vmaxs]
+
+
+class SharedFieldCubes(object):
+    '''Holds one date's worth of field cubes in shared memory
+
+    Each field is stored as a (num_ensemble_members, lat, lon) float32 cube backed by a
+    multiprocessing RawArray, so that a single loader process can decode the NetCDF4 data
+    once and any number of worker processes can read it without copying.
+    Several slots are allocated so that the next date can be loaded while the current one
+    is being processed.
+
+    :param fields: list of fields to hold
+    :param shape: shape of each cube, e.g. (56, 91, 180)
+    :param num_slots: number of dates that can be held at once
+    '''
+    def __init__(self, fields, shape, num_slots=2):
+        self.fields = fields
+        self.shape = shape
+        self.num_slots = num_slots
+        size = int(np.prod(shape))
+        self._raw_arrays = [dict((field, RawArray(ctypes.c_float, size)) for field in fields)
+                            for slot in range(num_slots)]
+
+    def cube(self, slot, field):
+        '''Returns a numpy view of the cube for a field in a given slot (no copy)'''
+        return np.frombuffer(self._raw_arrays[slot][field], dtype=np.float32).reshape(self.shape)
+
+    def fill(self, slot, c20data):
+        '''Copies the currently loaded fields of c20data into a slot'''
+        for field in self.fields:
+            self.cube(slot, field)[:] = getattr(c20data, field)
+
+
+class SharedC20Data(C20Data):
+    '''Read-only C20Data lookalike that gets its fields from SharedFieldCubes
+
+    Used by worker processes that each handle a subset of ensemble members. It exposes the
+    same per-date attributes as C20Data (prmsl, vort850, vmaxs850...) but only calculates
+    vorticities and extrema for its own ensemble members.
+
+    :param cubes: SharedFieldCubes filled by the loader process
+    :param c20data: C20Data from which to take lons/lats and grid spacings
+    '''
+    def __init__(self, cubes, c20data):
+        self.cubes = cubes
+        self._set_fields(cubes.fields)
+        self.version = c20data.version
+        self.dates = c20data.dates
+        self.lons = c20data.lons
+        self.lats = c20data.lats
+        self.dx = c20data.dx
+        self.dy = c20data.dy
+        self.date = None
+        self.bytes_read = 0
+
+    def set_slot(self, slot, date, ensemble_members):
+        '''Points all fields at a slot and processes the given ensemble members'''
+        self.date = date
+        for field in self.fields:
+            setattr(self, field, self.cubes.cube(slot, field))
+
+        if self.calc_9950_vorticity:
+            self._calculate_vorticities('9950', ensemble_members)
+        if self.calc_850_vorticity:
+            self._calculate_vorticities('850', ensemble_members)
+        self._find_min_max_from_fields(ensemble_members)
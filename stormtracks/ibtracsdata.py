@@ -1,25 +1,270 @@
 import os
+import logging
 from glob import glob
 import datetime as dt
-from collections import Counter
+from itertools import imap
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
+import pandas as pd
 import netCDF4 as nc
 
+from utils.progress import ProgressReporter
+from utils.utils import lonlat_to_xyz, xyz_to_lonlat
 from load_settings import settings
+import setup_logging
 
 DATA_DIR = os.path.join(settings.DATA_DIR, 'ibtracs')
 
+log = setup_logging.get_logger('st.ibtracsdata')
+
+
+ARCHIVE_FILENAME = 'ibtracs_archive.npz'
+CLIMATOLOGY_FILENAME = 'ibtracs_climatology.npz'
+# Columns of IbtracsArchive.climatology, one row per (year, basin).
+CLIMATOLOGY_COLUMNS = ['year', 'basin', 'storm_count', 'hurricane_count', 'hurricane_fix_count',
+                       'pdi']
+# Archives resampled onto a set of dates are cached as this, formatted with the first and
+# last dates and the number of dates.
+RESAMPLED_FILENAME_TPL = 'ibtracs_resampled_{0}_{1}_{2}.npz'
+
+# Columns of IbtracsArchive, one entry per observation.
+OBS_COLUMNS = ['storm', 'date', 'lon', 'lat', 'wind', 'pressure', 'cls']
+# Columns of IbtracsArchive, one entry per storm.
+STORM_COLUMNS = ['storm_names', 'storm_years', 'storm_basins', 'storm_offsets']
+# Columns of IbtracsArchive, one entry per IBTrACS file it was built from (with the file's
+# mtime), used to tell whether the archive is out of date.
+SOURCE_COLUMNS = ['source_files', 'source_mtimes']
+
+
+class IbtracsArchive(object):
+    '''Columnar table of all IBTrACS observations
+
+    Observations of each storm are contiguous, and storms are sorted by year (taken from the
+    storm's ID, as the per year files are named) then name. storm_offsets[i]:storm_offsets[i + 1]
+    are the observations of storm i, and year_storms gives the storms of a year with a
+    searchsorted, so loading a year is a slice.
+
+    :param columns: dict of OBS_COLUMNS and STORM_COLUMNS arrays, and optionally
+        SOURCE_COLUMNS arrays (None if not given, e.g. for resampled archives)
+    '''
+    def __init__(self, columns):
+        for name in OBS_COLUMNS + STORM_COLUMNS:
+            setattr(self, name, columns[name])
+        for name in SOURCE_COLUMNS:
+            setattr(self, name, columns.get(name))
+        self._basin_index = None
+
+    @classmethod
+    def from_storms(cls, storms, source_files=(), source_mtimes=()):
+        '''Creates an archive from a list of per storm dicts (see _read_storm_file)
+
+        :param source_files: files the storms were read from
+        :param source_mtimes: mtimes of source_files
+        '''
+        storms = sorted(storms, key=lambda storm: (storm['year'], storm['name']))
+        lengths = [len(storm['date']) for storm in storms]
+        columns = {
+            'source_files': np.array(source_files, dtype='S'),
+            'source_mtimes': np.array(source_mtimes, dtype=np.float64),
+            'storm_names': np.array([storm['name'] for storm in storms], dtype='S'),
+            'storm_years': np.array([storm['year'] for storm in storms], dtype=np.int32),
+            'storm_basins': np.array([storm['basin'] for storm in storms], dtype='S2'),
+            'storm_offsets': np.r_[0, np.cumsum(lengths)].astype(np.int64),
+            'storm': np.repeat(np.arange(len(storms)), lengths).astype(np.int32),
+        }
+        for name in OBS_COLUMNS[1:]:
+            if storms:
+                columns[name] = np.concatenate([storm[name] for storm in storms])
+            else:
+                columns[name] = np.zeros(0)
+        columns['date'] = columns['date'].astype('datetime64[s]')
+        columns['cls'] = columns['cls'].astype('S2')
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        '''Loads an archive saved with save'''
+        archive = np.load(path)
+        try:
+            # Archives saved before SOURCE_COLUMNS were added don't have them.
+            return cls(dict((name, archive[name])
+                            for name in OBS_COLUMNS + STORM_COLUMNS + SOURCE_COLUMNS
+                            if name in archive.files))
+        finally:
+            archive.close()
+
+    def save(self, path):
+        '''Saves the archive as a compressed npz file'''
+        np.savez_compressed(path, **dict((name, getattr(self, name))
+                                         for name in OBS_COLUMNS + STORM_COLUMNS + SOURCE_COLUMNS
+                                         if getattr(self, name) is not None))
+
+    def __len__(self):
+        return len(self.storm_names)
+
+    def year_storms(self, year):
+        '''Returns the slice of storms from a year'''
+        return slice(np.searchsorted(self.storm_years, year, side='left'),
+                     np.searchsorted(self.storm_years, year, side='right'))
+
+    def basin_storms(self, basin):
+        '''Returns the indices of the storms from a basin (in storm order)'''
+        if self._basin_index is None:
+            order = np.argsort(self.storm_basins, kind='mergesort')
+            basins, starts = np.unique(self.storm_basins[order], return_index=True)
+            ends = np.r_[starts[1:], len(order)]
+            self._basin_index = dict((basin, order[start:end])
+                                     for basin, start, end in zip(basins, starts, ends))
+        return self._basin_index.get(basin, np.zeros(0, dtype=np.int64))
+
+    def storm_mask(self, years=None, basins=None):
+        '''Returns a bool array, True for each storm from any of years and any of basins
+
+        :param years: years to select (None for all)
+        :param basins: basins to select, e.g. ['NA', 'WP'] (None for all)
+        '''
+        if years is None:
+            mask = np.ones(len(self), dtype=bool)
+        else:
+            mask = np.zeros(len(self), dtype=bool)
+            for year in years:
+                mask[self.year_storms(year)] = True
+        if basins is not None:
+            basin_mask = np.zeros(len(self), dtype=bool)
+            for basin in basins:
+                basin_mask[self.basin_storms(basin)] = True
+            mask &= basin_mask
+        return mask
+
+    def obs_mask(self, years=None, basins=None, bbox=None, classes=None):
+        '''Returns a bool array, True for each observation matching all of the filters
+
+        :param years: years of the storms to select (None for all)
+        :param basins: basins of the storms to select (None for all)
+        :param bbox: (min_lon, max_lon, min_lat, max_lat) of the observations to select
+            (inclusive, lons are 0 to 360), or None
+        :param classes: classes of the observations to select, e.g. ['HU'] (None for all)
+        '''
+        mask = self.storm_mask(years, basins)[self.storm]
+        if bbox is not None:
+            min_lon, max_lon, min_lat, max_lat = bbox
+            mask &= (self.lon >= min_lon) & (self.lon <= max_lon)
+            mask &= (self.lat >= min_lat) & (self.lat <= max_lat)
+        if classes is not None:
+            mask &= np.in1d(self.cls, np.array(classes, dtype='S2'))
+        return mask
+
+    def climatology(self):
+        '''Aggregates the observations of each year and basin
+
+        One pass over the observations, with bincounts to get per storm totals that are then
+        summed per (year, basin). As in ClassificationAnalysis, a hurricane is a storm with
+        any HU fixes, and the PDI is the sum of the cubes of the winds of the HU fixes (fixes
+        with missing winds count as 0).
+
+        :returns: DataFrame of CLIMATOLOGY_COLUMNS, sorted by year then basin
+        '''
+        is_hu = self.cls == 'HU'
+        winds = np.nan_to_num(self.wind.astype(np.float64))
+        storm_hu_fixes = np.bincount(self.storm, weights=is_hu, minlength=len(self))
+        storm_pdis = np.bincount(self.storm, weights=np.where(is_hu, winds ** 3, 0),
+                                 minlength=len(self))
+        storms = pd.DataFrame({'year': self.storm_years.astype(np.int64),
+                               'basin': self.storm_basins.astype(str),
+                               'storm_count': np.ones(len(self), dtype=np.int64),
+                               'hurricane_count': (storm_hu_fixes > 0).astype(np.int64),
+                               'hurricane_fix_count': storm_hu_fixes.astype(np.int64),
+                               'pdi': storm_pdis})
+        climatology = storms.groupby(['year', 'basin'], sort=True).sum().reset_index()
+        return climatology[CLIMATOLOGY_COLUMNS]
+
+    def resample(self, dates):
+        '''Interpolates all storms onto dates, e.g. the 6 hourly dates of C20Data
+
+        Each storm gets an observation at each of dates between its first and last fix.
+        Positions are interpolated along the great circle between the fixes either side,
+        winds and pressures linearly, and the class is that of the nearer fix. This is done
+        for all observations at once: the fixes either side are found with one searchsorted
+        on (storm, date). Fixes must be in date order within each storm, as in IBTrACS.
+
+        :param dates: sorted array of dates (datetimes or datetime64)
+        :returns: IbtracsArchive with the same storms, and their resampled observations
+        '''
+        dates = _to_datetime64(dates)
+        storm_ends = self.storm_offsets[1:]
+        has_obs = storm_ends > self.storm_offsets[:-1]
+        first_steps = np.zeros(len(self), dtype=np.int64)
+        lengths = np.zeros(len(self), dtype=np.int64)
+        first_steps[has_obs] = np.searchsorted(dates, self.date[self.storm_offsets[:-1][has_obs]],
+                                               side='left')
+        last_steps = np.searchsorted(dates, self.date[storm_ends[has_obs] - 1], side='right')
+        lengths[has_obs] = np.maximum(last_steps - first_steps[has_obs], 0)
+
+        storms = np.repeat(np.arange(len(self)), lengths).astype(np.int32)
+        steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        new_dates = dates[first_steps[storms] + steps]
+
+        # Fixes either side of each new date: searchsorted on one key that orders by storm
+        # then date.
+        origin, end = dates[0], dates[-1]
+        if len(self.date):
+            origin, end = min(origin, self.date.min()), max(end, self.date.max())
+        obs_secs = (self.date - origin).astype(np.int64)
+        new_secs = (new_dates - origin).astype(np.int64)
+        span = (end - origin).astype(np.int64) + 1
+        prev_obs = np.searchsorted(self.storm.astype(np.int64) * span + obs_secs,
+                                   storms.astype(np.int64) * span + new_secs, side='right') - 1
+        next_obs = np.minimum(prev_obs + 1, storm_ends[storms] - 1)
+
+        gap = (obs_secs[next_obs] - obs_secs[prev_obs]).astype(np.float64)
+        weights = np.where(gap > 0, (new_secs - obs_secs[prev_obs]) / np.maximum(gap, 1), 0.)
+
+        lons, lats = _great_circle_interp(self.lon[prev_obs], self.lat[prev_obs],
+                                          self.lon[next_obs], self.lat[next_obs], weights)
+        columns = dict((name, getattr(self, name)) for name in STORM_COLUMNS)
+        columns.update({
+            'storm_offsets': np.r_[0, np.cumsum(lengths)].astype(np.int64),
+            'storm': storms,
+            'date': new_dates,
+            'lon': lons.astype(self.lon.dtype),
+            'lat': lats.astype(self.lat.dtype),
+            'wind': _linear_interp(self.wind[prev_obs], self.wind[next_obs], weights),
+            'pressure': _linear_interp(self.pressure[prev_obs], self.pressure[next_obs],
+                                       weights),
+            'cls': np.where(weights > 0.5, self.cls[next_obs], self.cls[prev_obs]),
+        })
+        return IbtracsArchive(columns)
+
+    def best_track(self, storm):
+        '''Creates an IbStormtrack for a storm from its slice of observations'''
+        obs = slice(self.storm_offsets[storm], self.storm_offsets[storm + 1])
+        best_track = IbStormtrack(self.storm_years[storm], self.storm_names[storm])
+        best_track.basin = self.storm_basins[storm]
+        best_track.dates = self.date[obs].astype(dt.datetime)
+        best_track.lons = self.lon[obs]
+        best_track.lats = self.lat[obs]
+        best_track.winds = self.wind[obs]
+        best_track.pressures = self.pressure[obs]
+        if best_track.basin in ['NA', 'WP']:
+            best_track.cls = list(self.cls[obs])
+            best_track.is_hurricane = 'HU' in best_track.cls
+        return best_track
+
 
 class IbtracsData(object):
     '''Class used for accessing IBTrACS data
 
     Wraps the underlying NetCDF4 files and extracts the information required from them.
+    All files are read once and stored as an IbtracsArchive (see build_archive), which all
+    loading is done from.
 
     :param data_dir: directory where IBTrACS NetCDF4 files are held
-    :param verbose: whether to pring lots of output
+    :param verbose: whether to log progress while building the archive (at INFO rather
+        than DEBUG) and each file that could not be read
+    :param archive_path: path of archive (defaults to ARCHIVE_FILENAME in data_dir)
     '''
-    def __init__(self, data_dir=None, verbose=True):
+    def __init__(self, data_dir=None, verbose=True, archive_path=None):
         if data_dir:
             self.data_dir = data_dir
             self.path_tpl = os.path.join(data_dir, '{0}*.nc')
@@ -27,95 +272,229 @@ class IbtracsData(object):
             self.data_dir = DATA_DIR
             self.path_tpl = os.path.join(DATA_DIR, '{0}*.nc')
         self.verbose = verbose
+        if archive_path:
+            self.archive_path = archive_path
+        else:
+            self.archive_path = os.path.join(self.data_dir, ARCHIVE_FILENAME)
+        self._archive = None
+        self._resampled_archives = {}
+        self._climatology = None
+        self.failures = []
+
+    @property
+    def archive(self):
+        '''The IbtracsArchive, loaded from disk or built if it doesn't exist yet
+
+        The archive is rebuilt if the IBTrACS files have been added, removed or modified
+        since it was built.
+        '''
+        if self._archive is None:
+            if os.path.exists(self.archive_path):
+                archive = IbtracsArchive.load(self.archive_path)
+                if self._is_current(archive):
+                    self._archive = archive
+                else:
+                    log.info('IBTrACS files have changed since the archive was built')
+            if self._archive is None:
+                self._archive = self.build_archive()
+        return self._archive
+
+    def _source_files(self):
+        '''Returns the IBTrACS files and their mtimes'''
+        filenames = sorted(glob(self.path_tpl.format('')))
+        return filenames, np.array([os.path.getmtime(filename) for filename in filenames])
+
+    def _is_current(self, archive):
+        '''Whether archive was built from the IBTrACS files as they are now'''
+        if archive.source_files is None:
+            return False
+        filenames, mtimes = self._source_files()
+        return (list(archive.source_files) == filenames and
+                (archive.source_mtimes == mtimes).all())
+
+    @property
+    def climatology(self):
+        '''Per year and basin storm counts, hurricane counts and PDI (see
+        IbtracsArchive.climatology)
+
+        Cached in data_dir, and redone if the archive has been rebuilt since.
+        '''
+        if self._climatology is None:
+            path = os.path.join(self.data_dir, CLIMATOLOGY_FILENAME)
+            archive = self.archive
+            if (os.path.exists(path) and
+                    os.path.getmtime(path) >= os.path.getmtime(self.archive_path)):
+                saved = np.load(path)
+                try:
+                    self._climatology = pd.DataFrame(dict((name, saved[name])
+                                                          for name in CLIMATOLOGY_COLUMNS),
+                                                     columns=CLIMATOLOGY_COLUMNS)
+                finally:
+                    saved.close()
+            else:
+                self._climatology = archive.climatology()
+                columns = dict((name, self._climatology[name].values)
+                               for name in CLIMATOLOGY_COLUMNS)
+                # Saved as fixed width strings, so that loading doesn't need pickle.
+                columns['basin'] = columns['basin'].astype('S2')
+                np.savez(path, **columns)
+        return self._climatology
+
+    def year_climatology(self, years, basin='NA'):
+        '''Returns the climatology of a basin indexed by year, with rows of zeros for any
+        of years without storms'''
+        climatology = self.climatology
+        basin_climatology = climatology[climatology.basin == basin].set_index('year')
+        return basin_climatology.drop('basin', axis=1).reindex(years, fill_value=0)
+
+    def resampled_archive(self, dates):
+        '''The archive resampled onto dates (see IbtracsArchive.resample)
+
+        Resampled archives are cached in memory and in data_dir, and are redone if the
+        archive has been rebuilt since.
+
+        :param dates: sorted array of dates, e.g. C20Data.dates
+        '''
+        dates = _to_datetime64(dates)
+        key = (dates[0].item().strftime('%Y%m%d%H'), dates[-1].item().strftime('%Y%m%d%H'),
+               len(dates))
+        if key not in self._resampled_archives:
+            path = os.path.join(self.data_dir, RESAMPLED_FILENAME_TPL.format(*key))
+            archive = self.archive
+            if (os.path.exists(path) and
+                    os.path.getmtime(path) >= os.path.getmtime(self.archive_path)):
+                self._resampled_archives[key] = IbtracsArchive.load(path)
+            else:
+                resampled = archive.resample(dates)
+                resampled.save(path)
+                self._resampled_archives[key] = resampled
+        return self._resampled_archives[key]
+
+    def build_archive(self, num_procs=None):
+        '''Reads all IBTrACS files and saves them as a single IbtracsArchive
 
-    def __say(self, message):
-        '''Prints a message if ``self.verbose == True``'''
-        if self.verbose:
-            print(message)
+        Only needs to be done once (or when the IBTrACS data changes). The files are read in
+        worker processes; files that can't be read are skipped and recorded in self.failures.
 
-    def load_ibtracks_year(self, year, basin='NA'):
+        :param num_procs: number of worker processes (defaults to number of cores, 1 reads
+            the files in this process)
+        :returns: the IbtracsArchive
+        '''
+        if num_procs is None:
+            num_procs = cpu_count()
+        filenames, mtimes = self._source_files()
+        log.info('reading {} IBTrACS files using {} processes'.format(len(filenames), num_procs))
+
+        storms = []
+        self.failures = []
+        progress = ProgressReporter(log, 'Reading IBTrACS files', len(filenames),
+                                    level=logging.INFO if self.verbose else logging.DEBUG)
+        pool = Pool(num_procs) if num_procs > 1 and len(filenames) > 1 else None
+        try:
+            if pool:
+                # Files are small, so send them to the workers in chunks. Storms are sorted when
+                # the archive is created, so the order they come back in doesn't matter.
+                chunksize = max(len(filenames) // (num_procs * 8), 1)
+                results = pool.imap_unordered(_try_read_storm_file, filenames, chunksize)
+            else:
+                results = imap(_try_read_storm_file, filenames)
+
+            for filename, storm, error in results:
+                if storm is None:
+                    self.failures.append((filename, error))
+                    if self.verbose:
+                        log.warn('Could not load data for {}: {}'.format(filename, error))
+                    progress.update(current=os.path.basename(filename))
+                else:
+                    storms.append(storm)
+                    progress.update(rows=len(storm['date']), current=storm['name'])
+            progress.finish()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if self.failures:
+            log.warn('could not load {} of {} IBTrACS files, see failures'.format(
+                len(self.failures), len(filenames)))
+        archive = IbtracsArchive.from_storms(storms, filenames, mtimes)
+        archive.save(self.archive_path)
+        self._archive = archive
+        self._resampled_archives = {}
+        self._climatology = None
+        return archive
+
+    def load_ibtracks_year(self, year, basin='NA', dates=None):
         '''Loads a given year's worth of data
 
         :param year: year to load
         :param basin: which basins to load ('all' for all of them)
+        :param dates: if given, best tracks are resampled onto these dates (e.g.
+            C20Data.dates), so that every fix lines up with a 20CR timestep
         :returns: list of loaded best tracks
         '''
-        y = str(year)
-
-        filenames = glob(self.path_tpl.format(y))
-        self.best_tracks = self._load_ibtracks_filenames(year, basin, filenames)
-        return self.best_tracks
-
-    def _load_ibtracks_filenames(self, year, basin, filenames):
-        basins = Counter()
-        best_tracks = []
-        for filename in filenames:
-            try:
-                best_track = self._load_ibtracks_data(year, filename)
-                if basin == 'all' or basin == best_track.basin:
-                    best_track.index = len(best_tracks)
-                    best_tracks.append(best_track)
-                basins[best_track.basin] += 1
-            except Exception, e:
-                self.__say('Could not load data for {0}'.format(filename))
-                self.__say(e.message)
-        if len(best_tracks) == 0:
+        basins = None if basin == 'all' else [basin]
+        storms = np.where(self.archive.storm_mask([year], basins))[0]
+        if dates is None:
+            self.best_tracks = self._load_storms(storms)
+        else:
+            self.best_tracks = self._load_storms(storms, self.resampled_archive(dates))
+        if len(self.best_tracks) == 0:
             raise Exception('No best tracks loaded for year {0}\n'
                             'Has the ibtracs data been downloaded?'.format(year))
-        return best_tracks
+        return self.best_tracks
 
-    def _load_ibtracks_data(self, year, filename):
-        self.__say(filename.split('/')[-1])
-        dataset = nc.Dataset(filename)
-        best_track = IbStormtrack(year, filename.split('/')[-1].split('.')[0])
-        best_track.basin = _convert_ib_field(dataset.variables['genesis_basin'])
+    def query(self, years=None, basins=None, bbox=None, classes=None):
+        '''Selects observations from any number of years, using the archive's indices
 
-        dates = []
-        for i in range(dataset.variables['nobs'].getValue()):
-            time_string = _convert_ib_field(dataset.variables['isotime'][i])
-            date = dt.datetime.strptime(time_string, '%Y-%m-%d %H:%M:%S')
-            dates.append(date)
-        best_track.dates = np.array(dates)
+        All filters are optional, see IbtracsArchive.obs_mask for what they take.
 
-        best_track.pressures = dataset.variables['pres_for_mapping'][:]
-        best_track.winds = dataset.variables['wind_for_mapping'][:]
+        :returns: dict of OBS_COLUMNS arrays of the selected observations, in storm order
+            ('storm' is the index of each observation's storm in self.archive)
+        '''
+        archive = self.archive
+        mask = archive.obs_mask(years, basins, bbox, classes)
+        return dict((name, getattr(archive, name)[mask]) for name in OBS_COLUMNS)
 
-        # Convert lons to 0 to 360. (They start off -180 to 180).
-        ib_lons = dataset.variables['lon_for_mapping'][:]
-        best_track.lons = np.zeros_like(ib_lons)
-        for i, lon in enumerate(ib_lons):
-            best_track.lons[i] = lon if lon > 0 else lon + 360
-
-        best_track.lats = dataset.variables['lat_for_mapping'][:]
-        if best_track.basin == 'NA':
-            best_track.cls = []
-            best_track.is_hurricane = False
-            for i in range(dataset.variables['nobs'].getValue()):
-                cls = _convert_ib_field(dataset.variables['atcf_class'][i])
-                if cls == 'HU':
-                    best_track.is_hurricane = True
-                best_track.cls.append(cls)
-
-        if best_track.basin == 'WP':
-            # TODO: Naming/check rules.
-            best_track.cls = []
-            best_track.is_hurricane = False
-            for wind in best_track.winds:
-                if wind >= 65:
-                    best_track.cls.append('HU')
-                    best_track.is_hurricane = True
-                else:
-                    best_track.cls.append('TS')
+    def iter_storms(self, years=None, basins=None, bbox=None, classes=None):
+        '''Yields best tracks of the storms that have any observations selected by query
 
-        return best_track
+        Each best track has all of its storm's observations, not just the selected ones.
+        '''
+        archive = self.archive
+        storms = np.unique(archive.storm[archive.obs_mask(years, basins, bbox, classes)])
+        for index, storm in enumerate(storms):
+            best_track = archive.best_track(storm)
+            best_track.index = index
+            yield best_track
+
+    def _load_storms(self, storms, archive=None):
+        if archive is None:
+            archive = self.archive
+        best_tracks = []
+        for storm in storms:
+            best_track = archive.best_track(storm)
+            best_track.index = len(best_tracks)
+            best_tracks.append(best_track)
+        return best_tracks
 
     def load_wilma_katrina(self):
-        '''Loads only best tracks corresponding to Wilma and Katrina (2005)'''
-        wilma_fn = '2005289N18282.ibtracs.v03r05.nc'
-        katrina_fn = '2005236N23285.ibtracs.v03r05.nc'
-        wilma_path = os.path.join(self.data_dir, wilma_fn)
-        katrina_path = os.path.join(self.data_dir, katrina_fn)
-        return self._load_ibtracks_filenames(2005, 'NA', [wilma_path, katrina_path])
+        '''Loads only best tracks corresponding to Wilma and Katrina (2005)
+
+        Uses the archive if it has already been loaded, otherwise just their two files are
+        read.
+        '''
+        wilma_name = '2005289N18282'
+        katrina_name = '2005236N23285'
+        archive = self._archive
+        if archive is None:
+            filenames = [glob(self.path_tpl.format(name))[0]
+                         for name in [wilma_name, katrina_name]]
+            archive = IbtracsArchive.from_storms([_read_storm_file(filename)
+                                                  for filename in filenames])
+        storm_names = list(archive.storm_names)
+        return self._load_storms([storm_names.index(wilma_name),
+                                  storm_names.index(katrina_name)], archive)
 
 
 class IbStormtrack(object):
@@ -126,6 +505,103 @@ class IbStormtrack(object):
         self.is_matched = False
 
 
+def _read_storm_file(filename):
+    '''Reads one storm's NetCDF4 file
+
+    :returns: dict of the storm's name, year, basin and arrays of its observations
+    '''
+    dataset = nc.Dataset(filename)
+    try:
+        name = filename.split('/')[-1].split('.')[0]
+        variables = dataset.variables
+        basin = _convert_ib_field(variables['genesis_basin'][:])
+
+        # isotimes are 'YYYY-MM-DD HH:MM:SS', which numpy can parse directly.
+        dates = _convert_ib_fields(variables['isotime'][:]).astype('datetime64[s]')
+        winds = _read_ib_floats(variables['wind_for_mapping'])
+        pressures = _read_ib_floats(variables['pres_for_mapping'])
+
+        # Convert lons to 0 to 360. (They start off -180 to 180).
+        ib_lons = _read_ib_floats(variables['lon_for_mapping'])
+        lons = np.where(ib_lons > 0, ib_lons, ib_lons + 360)
+        lats = _read_ib_floats(variables['lat_for_mapping'])
+
+        if basin == 'NA':
+            cls = _convert_ib_fields(variables['atcf_class'][:])
+        elif basin == 'WP':
+            # TODO: Naming/check rules.
+            with np.errstate(invalid='ignore'):
+                cls = np.where(winds >= 65, 'HU', 'TS')
+        else:
+            cls = np.zeros(len(dates), dtype='S2')
+    finally:
+        dataset.close()
+
+    return {'name': name, 'year': int(name[:4]), 'basin': basin,
+            'date': dates, 'lon': lons, 'lat': lats,
+            'wind': winds, 'pressure': pressures, 'cls': cls.astype('S2')}
+
+
+def _try_read_storm_file(filename):
+    '''Worker: reads one storm's file, returning (filename, storm dict or None, error or None)'''
+    try:
+        return filename, _read_storm_file(filename), None
+    except Exception, e:
+        return filename, None, '{0}: {1}'.format(type(e).__name__, e)
+
+
 def _convert_ib_field(array):
-    '''Utility function for converting IBTrACS field to string'''
-    return ''.join(array)
+    '''Utility function for converting IBTrACS field (1D char array) to string'''
+    return _convert_ib_fields(np.asarray(array)[None, :])[0]
+
+
+def _convert_ib_fields(array):
+    '''Converts a 2D IBTrACS char array to an array of strings, one per row
+
+    Reinterprets each row of n 1 byte chars as one n byte string, rather than joining them.
+    '''
+    array = np.ascontiguousarray(np.ma.getdata(array), dtype='S1')
+    if array.shape[1] == 0:
+        return np.zeros(array.shape[0], dtype='S1')
+    return array.view('S{0}'.format(array.shape[1]))[:, 0]
+
+
+def _to_datetime64(dates):
+    '''Converts dates to datetime64[s], rounding to the nearest second
+
+    C20Data.dates are calculated from fractional days, so can be a few microseconds out.
+    '''
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    return (dates + np.timedelta64(500000, 'us')).astype('datetime64[s]')
+
+
+def _linear_interp(values0, values1, weights):
+    '''Interpolates linearly between values0 and values1, keeping values on a fix exact
+    (even if the other fix has a missing value)'''
+    values = values0 + (values1 - values0) * weights
+    values = np.where(weights == 0, values0, np.where(weights == 1, values1, values))
+    return values.astype(values0.dtype)
+
+
+def _great_circle_interp(lons0, lats0, lons1, lats1, weights):
+    '''Interpolates between pairs of points along the great circles joining them
+
+    :returns: lons (0 to 360) and lats in degrees
+    '''
+    xyz0 = lonlat_to_xyz(lons0, lats0)
+    xyz1 = lonlat_to_xyz(lons1, lats1)
+    cos_angles = (xyz0 * xyz1).sum(axis=1) / np.sqrt((xyz0 ** 2).sum(axis=1) *
+                                                     (xyz1 ** 2).sum(axis=1))
+    angles = np.arccos(np.clip(cos_angles, -1, 1))
+    sin_angles = np.sin(angles)
+    # Nearby (or the same) points are interpolated linearly to avoid dividing by ~0.
+    is_near = sin_angles < 1e-9
+    safe_sin_angles = np.where(is_near, 1, sin_angles)
+    weights0 = np.where(is_near, 1 - weights, np.sin((1 - weights) * angles) / safe_sin_angles)
+    weights1 = np.where(is_near, weights, np.sin(weights * angles) / safe_sin_angles)
+    return xyz_to_lonlat(weights0[:, None] * xyz0 + weights1[:, None] * xyz1)
+
+
+def _read_ib_floats(variable):
+    '''Reads a float IBTrACS variable as float32, with masked values as NaN'''
+    return np.ma.filled(np.ma.asarray(variable[:]).astype(np.float32), np.nan)
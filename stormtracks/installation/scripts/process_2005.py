@@ -9,12 +9,15 @@ import stormtracks.ibtracsdata as ibtracsdata
 from stormtracks.results import StormtracksResultsManager
 
 from stormtracks.processing.find_vortmax import VortmaxFinder
+from stormtracks.processing.parallel import find_vort_maxima_date_sharded
+from stormtracks.processing.tracking import VortmaxNearestNeighbourTracker
+from stormtracks.processing.track_features import track_features
 import stormtracks.processing.matching as matching
 
 log = get_logger('st.demo')
 
 
-def process_year(year=2005, results_name='demo'):
+def process_year(year=2005, results_name='demo', num_procs=1):
     start = dt.datetime.now()
     log.info('Processing year, results: {}, {}'.format(year, results_name))
 
@@ -25,13 +28,21 @@ def process_year(year=2005, results_name='demo'):
     # Run through 20CR looking for vortmax. Collect all fields for each vortmax, save as pandas DataFrame.
     c20data = C20Data(year)
     finder = VortmaxFinder(c20data, False)
-    df_year = finder.find_vort_maxima(start_date, end_date)
+    if num_procs == 1:
+        df_year = finder.find_vort_maxima(start_date, end_date)
+    else:
+        df_year = find_vort_maxima_date_sharded(finder, start_date, end_date, num_procs)
 
     results_manager.save_result(year, 'all_fields', df_year)
 
-    # Match each best track to the corresponding vortmax from 20CR.
+    # Track the vortmax and summarise each track.
+    track_store = VortmaxNearestNeighbourTracker().track(df_year)
+    results_manager.save_result(year, 'track_features', track_features(track_store, df_year))
+
+    # Match each best track to the corresponding vortmax from 20CR, with the best tracks
+    # resampled onto 20CR's dates so that fixes between timesteps aren't dropped.
     ib = ibtracsdata.IbtracsData()
-    ib.load_ibtracks_year(year)
+    ib.load_ibtracks_year(year, dates=c20data.dates)
     best_track_matches = matching.simple_matching(ib.best_tracks, df_year)
     results_manager.save_result(year, 'best_track_matches', best_track_matches)
 
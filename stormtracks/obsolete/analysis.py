@@ -602,8 +602,8 @@ class ClassificationAnalysis(object):
     def __init__(self):
         self.results_manager = StormtracksResultsManager(settings.FIELD_RESULTS)
         self.plot_results_manager = StormtracksResultsManager('plot_results')
+        self.ibdata = IbtracsData(verbose=False)
         self.all_best_tracks = {}
-        self.hurricanes_in_year = {}
         self.cal_cd = None
         self.val_cd = None
         self.classifiers = None
@@ -657,6 +657,7 @@ class ClassificationAnalysis(object):
             print(start_year)
             years = range(start_year, start_year + 10)
             cla_data = self.load_classification_data('{0}s'.format(start_year), years, ems)
+            ib_climatology = self.ibdata.year_climatology(years)
 
             classifier.predict(cla_data)
             pred_hurr = cla_data.data[classifier.are_hurr_pred]
@@ -664,19 +665,8 @@ class ClassificationAnalysis(object):
             for year in years:
                 cla_hurr = []
                 cla_pdi = []
-                ib_hurr = self.get_total_hurrs([year])
-                ib_hurrs.append(ib_hurr)
-
-                if year not in self.all_best_tracks:
-                    self.load_ibtracs_year(year)
-
-                ib_pdi = 0
-                for bt in self.all_best_tracks[year]:
-                    for cls, ws in zip(bt.cls, bt.winds):
-                        if cls == 'HU':
-                            ib_pdi += ws ** 3
-
-                ib_pdis.append(ib_pdi)
+                ib_hurrs.append(ib_climatology.hurricane_fix_count[year])
+                ib_pdis.append(ib_climatology.pdi[year])
 
                 year_mask = (pred_hurr[:, 15] == year)
                 for em in ems:
@@ -700,16 +690,7 @@ class ClassificationAnalysis(object):
         return '{0}_{1}_{2}'.format(name, years_str, em_str)
 
     def load_ibtracs_year(self, year):
-        ibdata = IbtracsData(verbose=False)
-        best_tracks = ibdata.load_ibtracks_year(year)
-        self.all_best_tracks[year] = best_tracks
-
-        hurricanes_in_year = 0
-        for best_track in best_tracks:
-            for cls in best_track.cls:
-                if cls == 'HU':
-                    hurricanes_in_year += 1
-        self.hurricanes_in_year[year] = hurricanes_in_year
+        self.all_best_tracks[year] = self.ibdata.load_ibtracks_year(year)
 
     def miss_count(self, years, num_ensemble_members, hurr_counts):
         total_hurrs = self.get_total_hurrs(years)
@@ -720,13 +701,7 @@ class ClassificationAnalysis(object):
         return expexted_hurrs - all_tracked_hurricanes
 
     def get_total_hurrs(self, years):
-        total_hurricanes = 0
-
-        for year in years:
-            if year not in self.all_best_tracks:
-                self.load_ibtracs_year(year)
-            total_hurricanes += self.hurricanes_in_year[year]
-        return total_hurricanes
+        return self.ibdata.year_climatology(years).hurricane_fix_count.sum()
 
     def run_categorisation_analysis(self, years, ensemble_members=(0, ),
                                     plot_mode=None, save=False):
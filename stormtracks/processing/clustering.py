@@ -0,0 +1,201 @@
+'''Clustering of vortmax tracks across ensemble members
+
+Tracks from different ensemble members that follow the same system are grouped into
+clusters, and each cluster is summarised as a consensus track with its ensemble spread.
+'''
+import numpy as np
+import pandas as pd
+
+from .. import setup_logging
+from ..utils.utils import lonlat_to_xyz, xyz_to_lonlat, chord_to_geo_dist
+from .spatial_index import DateSpatialIndex
+
+log = setup_logging.get_logger('st.clustering')
+
+# Tracks must share at least this many timesteps to be in the same cluster...
+MIN_OVERLAP = 6
+# ...and be at most this far apart (km) on average over them.
+MAX_SEPARATION = 500.
+
+
+def close_track_pairs(track_store, max_separation=MAX_SEPARATION):
+    '''Finds pairs of tracks from different ensemble members that come close at any timestep
+
+    Points are put in a DateSpatialIndex, so only points on the same date that are within
+    max_separation of each other are compared.
+
+    :param track_store: TrackStore of tracks from any number of ensemble members
+    :param max_separation: distance (km) within which points count as close
+    :returns: (n, 2) array of unique track id pairs, lower track id first
+    '''
+    index = DateSpatialIndex(track_store.column('date'), track_store.column('lon'),
+                             track_store.column('lat'))
+    pairs = index.close_pairs(max_separation)
+    ems = track_store.column('em')
+    pairs = pairs[ems[pairs[:, 0]] != ems[pairs[:, 1]]]
+    pairs = np.sort(track_store.column('track_id')[pairs], axis=1)
+    if len(pairs) == 0:
+        return pairs
+    # Unique rows.
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    is_new = np.r_[True, (np.diff(pairs, axis=0) != 0).any(axis=1)]
+    return pairs[is_new]
+
+
+def track_pair_separations(track_store, pairs):
+    '''Calculates the overlap and mean separation of pairs of tracks
+
+    Tracks have a point at every timestep from their start to their end, so the points of
+    each pair over their shared timesteps are found with index arithmetic, and all the
+    distances are calculated in one go.
+
+    :param track_store: TrackStore that the tracks are in
+    :param pairs: (n, 2) array of track id pairs
+    :returns: number of shared timesteps and mean separation (km) of each pair
+    '''
+    date_idx = track_store.column('date_idx')
+    offsets = track_store.offsets
+    track_starts = date_idx[offsets[:-1]]
+    track_ends = date_idx[offsets[1:] - 1]
+
+    track1, track2 = pairs[:, 0], pairs[:, 1]
+    overlap_start = np.maximum(track_starts[track1], track_starts[track2])
+    overlap_end = np.minimum(track_ends[track1], track_ends[track2])
+    overlaps = np.maximum(overlap_end - overlap_start + 1, 0)
+
+    pair_index = np.repeat(np.arange(len(pairs)), overlaps)
+    step = np.arange(overlaps.sum()) - np.repeat(np.cumsum(overlaps) - overlaps, overlaps)
+    points1 = (offsets[track1] + overlap_start - track_starts[track1])[pair_index] + step
+    points2 = (offsets[track2] + overlap_start - track_starts[track2])[pair_index] + step
+
+    lons, lats = track_store.column('lon'), track_store.column('lat')
+    chords = np.linalg.norm(lonlat_to_xyz(lons[points1], lats[points1]) -
+                            lonlat_to_xyz(lons[points2], lats[points2]), axis=1)
+    sum_separations = np.bincount(pair_index, weights=chord_to_geo_dist(chords),
+                                  minlength=len(pairs))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_separations = sum_separations / overlaps
+    return overlaps, mean_separations
+
+
+def merge_track_pairs(track_ems, pairs):
+    '''Greedily merges pairs of tracks into clusters with at most one track per member
+
+    Pairs are taken in the order given (e.g. nearest first). Each pair joins the clusters of
+    its two tracks, unless they are already the same cluster or have a track from the same
+    ensemble member, so long chains of tracks can't join separate systems together through
+    one member's tracks.
+
+    :param track_ems: ensemble member of each track
+    :param pairs: (n, 2) array of track id pairs
+    :returns: cluster id of each track, numbered in order of their first track
+    '''
+    num_tracks = len(track_ems)
+    parents = np.arange(num_tracks)
+    # Ensemble members of each cluster as a bit mask, only kept up to date for roots.
+    cluster_members = [1 << int(em) for em in track_ems]
+
+    def find_root(track_id):
+        root = track_id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[track_id] != root:
+            parents[track_id], track_id = root, parents[track_id]
+        return root
+
+    for track_id1, track_id2 in pairs:
+        root1, root2 = find_root(track_id1), find_root(track_id2)
+        if root1 == root2 or cluster_members[root1] & cluster_members[root2]:
+            continue
+        root1, root2 = min(root1, root2), max(root1, root2)
+        parents[root2] = root1
+        cluster_members[root1] |= cluster_members[root2]
+
+    roots = np.array([find_root(track_id) for track_id in range(num_tracks)], dtype=np.int64)
+    # Roots are the lowest track id of each cluster, so this numbers them in order.
+    is_root = roots == np.arange(num_tracks)
+    return (np.cumsum(is_root) - 1)[roots]
+
+
+def cluster_tracks(track_store, min_overlap=MIN_OVERLAP, max_separation=MAX_SEPARATION):
+    '''Groups tracks from different ensemble members that follow the same system
+
+    Two tracks match if they share at least min_overlap timesteps and are less than
+    max_separation apart on average over them. Matches are merged into clusters closest
+    first, and a cluster never has more than one track from an ensemble member (see
+    merge_track_pairs).
+
+    :param track_store: TrackStore of tracks from any number of ensemble members
+    :param min_overlap: minimum number of shared timesteps
+    :param max_separation: maximum mean separation (km)
+    :returns: cluster id of each track (numbered in order of their first track), and
+        DataFrame of matching track pairs with their overlap and mean separation
+    '''
+    pairs = close_track_pairs(track_store, max_separation)
+    overlaps, mean_separations = track_pair_separations(track_store, pairs)
+    is_match = (overlaps >= min_overlap) & (mean_separations < max_separation)
+    log.info('{} matching track pairs from {} candidates'.format(is_match.sum(), len(pairs)))
+
+    matches = pd.DataFrame({'track_id1': pairs[is_match, 0],
+                            'track_id2': pairs[is_match, 1],
+                            'overlap': overlaps[is_match],
+                            'mean_separation': mean_separations[is_match]},
+                           columns=['track_id1', 'track_id2', 'overlap', 'mean_separation'])
+
+    order = np.lexsort((matches.track_id2.values, matches.track_id1.values,
+                        matches.mean_separation.values))
+    track_clusters = merge_track_pairs(track_store.track_ems,
+                                       matches[['track_id1', 'track_id2']].values[order])
+    return track_clusters, matches
+
+
+def consensus_tracks(track_store, track_clusters, min_tracks=2):
+    '''Summarises each cluster of tracks as an ensemble consensus track
+
+    At each timestep of a cluster, the consensus position is the mean of the cluster's
+    points (taken in 3D, so it is correct across the dateline), and the spread is how far
+    the points are from it.
+
+    :param track_store: TrackStore that the tracks are in
+    :param track_clusters: cluster id of each track (e.g. from cluster_tracks)
+    :param min_tracks: clusters with fewer tracks are left out
+    :returns: DataFrame with one row per cluster and timestep, sorted by cluster then date
+    '''
+    cluster_sizes = np.bincount(track_clusters)
+    point_clusters = track_clusters[track_store.column('track_id')]
+    point_mask = cluster_sizes[point_clusters] >= min_tracks
+
+    xyz = lonlat_to_xyz(track_store.column('lon')[point_mask],
+                        track_store.column('lat')[point_mask])
+    points = pd.DataFrame({'cluster_id': point_clusters[point_mask],
+                           'date_idx': track_store.column('date_idx')[point_mask],
+                           'date': track_store.column('date')[point_mask],
+                           'vort': track_store.column('vort')[point_mask],
+                           'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]})
+    groups = points.groupby(['cluster_id', 'date_idx'], sort=True)
+    consensus = groups.agg({'date': 'first', 'vort': ['mean', 'max'], 'x': ['mean', 'size'],
+                            'y': 'mean', 'z': 'mean'})
+
+    mean_xyz = consensus[[('x', 'mean'), ('y', 'mean'), ('z', 'mean')]].values
+    lons, lats = xyz_to_lonlat(mean_xyz)
+    # Project the mean back onto the surface to measure the spread around it.
+    surface_xyz = lonlat_to_xyz(lons, lats)
+    group_index = groups.ngroup().values
+    spreads = chord_to_geo_dist(np.linalg.norm(xyz - surface_xyz[group_index], axis=1))
+    spread_mean = np.bincount(group_index, weights=spreads) / consensus[('x', 'size')].values
+    spread_max = pd.Series(spreads).groupby(group_index).max().values
+
+    index = consensus.index
+    return pd.DataFrame({'cluster_id': index.get_level_values('cluster_id'),
+                         'date': consensus[('date', 'first')].values,
+                         'date_idx': index.get_level_values('date_idx'),
+                         'lon': lons.astype(np.float32),
+                         'lat': lats.astype(np.float32),
+                         'vort_mean': consensus[('vort', 'mean')].values,
+                         'vort_max': consensus[('vort', 'max')].values,
+                         'num_tracks': consensus[('x', 'size')].values,
+                         'spread_mean': spread_mean.astype(np.float32),
+                         'spread_max': spread_max.astype(np.float32)},
+                        columns=['cluster_id', 'date', 'date_idx', 'lon', 'lat',
+                                 'vort_mean', 'vort_max', 'num_tracks',
+                                 'spread_mean', 'spread_max'])
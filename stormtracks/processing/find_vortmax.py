@@ -5,54 +5,165 @@ import numpy as np
 import pandas as pd
 
 from .. import setup_logging
-from ..utils.utils import dist, geo_dist, find_extrema
+from ..utils.utils import geo_dist, find_extrema
+from ..utils.progress import ProgressReporter
 from ..load_settings import settings
+from .schema import ALL_FIELDS_SCHEMA, apply_schema
 
 log = setup_logging.get_logger('st.find_vortmax')
 
 VortMax = namedtuple('VortMax', ['date', 'pos', 'vort'])
 
+# Thresholds used to filter vortmaxes. Any threshold can be set to None to disable it.
+# vort_cutoff: minimum vort850.
+# dist_cutoff: vortmaxes closer than this to a stronger vortmax are removed.
+# lon_range/lat_range: (min, max) of the region of interest (inclusive).
+CutoffProfile = namedtuple('CutoffProfile', ['vort_cutoff', 'dist_cutoff',
+                                             'lon_range', 'lat_range'])
+
 NUM_ENSEMBLE_MEMBERS = 56
 
+# N.B. a vort_cutoff of 5e-5 was used with the old (wrong) vort calc, 2.5e-5 has also been tried.
+DEFAULT_CUTOFF_PROFILE = CutoffProfile(vort_cutoff=1e-5,
+                                       dist_cutoff=geo_dist((0, 0), (2, 0)) * 5,
+                                       lon_range=(settings.MIN_LON, settings.MAX_LON),
+                                       lat_range=(settings.MIN_LAT, settings.MAX_LAT))
+
+# Loosest thresholds at which candidates are recorded. Any profile that is at least as strict
+# can be applied afterwards using apply_cutoff_profile.
+RECORD_CUTOFF_PROFILE = CutoffProfile(vort_cutoff=0,
+                                      dist_cutoff=None,
+                                      lon_range=(settings.MIN_LON, settings.MAX_LON),
+                                      lat_range=(settings.MIN_LAT, settings.MAX_LAT))
+
+ALL_FIELDS_COLUMNS = list(ALL_FIELDS_SCHEMA.keys())
+
+
+def results_to_dataframe(results):
+    '''Converts a list of vortmax rows (dicts) into the all_fields DataFrame
+
+    Columns are cast to the compact dtypes of ALL_FIELDS_SCHEMA.
+    '''
+    return apply_schema(pd.DataFrame(results, columns=ALL_FIELDS_COLUMNS), ALL_FIELDS_SCHEMA)
+
+
+def stronger_neighbour_dists(lons, lats, vorts, dist_func=geo_dist):
+    '''Returns the distance from each vortmax to its nearest stronger vortmax
+
+    A vortmax is stronger if it has a higher vort, or the same vort and a higher index
+    (this matches the order in which secondary vortmaxes used to be removed).
+
+    :param lons: array of vortmax lons
+    :param lats: array of vortmax lats
+    :param vorts: array of vortmax vorts
+    :param dist_func: distance function that can be broadcast over arrays
+    :returns: array of distances, inf where there is no stronger vortmax
+    '''
+    if len(vorts) == 0:
+        return np.zeros(0)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    vorts = np.asarray(vorts)
+    index = np.arange(len(vorts))
+
+    dists = dist_func((lons[:, None], lats[:, None]), (lons[None, :], lats[None, :]))
+    stronger = ((vorts[None, :] > vorts[:, None]) |
+                ((vorts[None, :] == vorts[:, None]) & (index[None, :] > index[:, None])))
+    return np.where(stronger, dists, np.inf).min(axis=1)
+
+
+def cutoff_profile_mask(vorts, lons, lats, nbr_dists, profile):
+    '''Returns a boolean mask of the vortmaxes that pass all thresholds of a profile'''
+    mask = np.ones(len(vorts), dtype=bool)
+    if profile.vort_cutoff is not None:
+        mask &= vorts >= profile.vort_cutoff
+    if profile.lon_range is not None:
+        mask &= (lons >= profile.lon_range[0]) & (lons <= profile.lon_range[1])
+    if profile.lat_range is not None:
+        mask &= (lats >= profile.lat_range[0]) & (lats <= profile.lat_range[1])
+    if profile.dist_cutoff is not None:
+        mask &= nbr_dists >= profile.dist_cutoff
+    return mask
+
+
+def apply_cutoff_profile(df, profile):
+    '''Filters a table of recorded candidates using a cutoff profile
+
+    Does not need any C20 data, so many profiles can be tried against the output of one
+    VortmaxFinder(..., record_candidates=True) run. The dist_cutoff is applied using the
+    nbr_dist column, which was calculated against all recorded candidates, so profiles with
+    a smaller lon/lat range than the one used for recording can remove slightly more
+    vortmaxes than a full run would.
+
+    :param df: all_fields DataFrame with an nbr_dist column
+    :param profile: CutoffProfile to apply
+    :returns: filtered DataFrame (with a fresh index)
+    '''
+    mask = cutoff_profile_mask(df.vort850.values, df.lon.values, df.lat.values,
+                               df.nbr_dist.values, profile)
+    return df[mask].reset_index(drop=True)
+
 
 class VortmaxFinder(object):
-    '''Finds all vortmaxes across ensemble members'''
-    def __init__(self, c20data, use_dist_cutoff=True):
+    '''Finds all vortmaxes across ensemble members
+
+    :param c20data: C20Data to search
+    :param use_dist_cutoff: whether to remove vortmaxes close to a stronger one
+        (only used if cutoff_profile is not given)
+    :param cutoff_profile: CutoffProfile to filter vortmaxes with
+    :param record_candidates: if True, keep all candidates that pass RECORD_CUTOFF_PROFILE
+        instead of applying cutoff_profile, so that profiles can be applied later with
+        apply_cutoff_profile
+    '''
+    def __init__(self, c20data, use_dist_cutoff=True, cutoff_profile=None,
+                 record_candidates=False):
         self.c20data = c20data
 
-        # Some settings to document/consider playing with.
-        self.use_vort_cutoff = True
         self.use_dist_cutoff = use_dist_cutoff
-        self.use_range_cutoff = True
-        self.use_geo_dist = True
-
-        if self.use_geo_dist:
-            self.dist = geo_dist
-            self.dist_cutoff = geo_dist((0, 0), (2, 0)) * 5
+        if cutoff_profile is None:
+            cutoff_profile = DEFAULT_CUTOFF_PROFILE
+            if not use_dist_cutoff:
+                cutoff_profile = cutoff_profile._replace(dist_cutoff=None)
+        self.cutoff_profile = cutoff_profile
+        self.record_candidates = record_candidates
+
+        # Distances (and so dist_cutoffs) are always geodesic, in km.
+        self.dist = geo_dist
+
+        if self.record_candidates:
+            self.run_profile = RECORD_CUTOFF_PROFILE
         else:
-            self.dist = dist
-            self.dist_cutoff = 5
-
-        # self.vort_cutoff = 5e-5 # Old value with wrong vort calc.
-        # self.vort_cutoff = 2.5e-5
-        self.vort_cutoff = 1e-5
-	log.info('VortmaxFinder setup:')
-	for setting in ['use_vort_cutoff',
-		        'use_dist_cutoff',
-			'use_range_cutoff',
-			'use_geo_dist',
-			'vort_cutoff']:
-	    log.info('{}: {}'.format(setting, getattr(self, setting)))
+            self.run_profile = self.cutoff_profile
 
-    def find_vort_maxima(self, start_date, end_date):
-        '''Runs over the date range looking for all vorticity maxima'''
+        log.info('VortmaxFinder setup:')
+        for setting in ['cutoff_profile',
+                        'record_candidates',
+                        'run_profile']:
+            log.info('{}: {}'.format(setting, getattr(self, setting)))
+
+    def init_kwargs(self):
+        '''Returns the kwargs needed to create an identically set up VortmaxFinder'''
+        return {'use_dist_cutoff': self.use_dist_cutoff,
+                'cutoff_profile': self.cutoff_profile,
+                'record_candidates': self.record_candidates}
+
+    def date_range_indices(self, start_date, end_date):
+        '''Returns the indices of start_date and end_date in the C20 dates
+
+        Raises an exception if either date is outside the loaded year.
+        '''
         if start_date < self.c20data.dates[0]:
             raise Exception('Start date is out of date range, try setting the year appropriately')
         elif end_date > self.c20data.dates[-1]:
             raise Exception('End date is out of date range, try setting the year appropriately')
-	log.info('finding vortmaxima in range {}-{}'.format(start_date, end_date))
         index = np.where(self.c20data.dates == start_date)[0][0]
         end_index = np.where(self.c20data.dates == end_date)[0][0]
+        return index, end_index
+
+    def find_vort_maxima(self, start_date, end_date):
+        '''Runs over the date range looking for all vorticity maxima'''
+        index, end_index = self.date_range_indices(start_date, end_date)
+        log.info('finding vortmaxima in range {}-{}'.format(start_date, end_date))
 
         self.all_vortmax_time_series = []
         results = []
@@ -62,86 +173,66 @@ class VortmaxFinder(object):
         for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
             self.all_vortmax_time_series.append(OrderedDict())
 
+        progress = ProgressReporter(log, 'Finding vortmaxima', end_index - index + 1)
         while index <= end_index:
             date = self.c20data.dates[index]
+            bytes_read = self.c20data.bytes_read
             self.c20data.set_date(date)
 
-            print('Finding vortmaxima: {0}'.format(date))
-            log.debug('Finding vortmaxima: {0}'.format(date))
-
+            num_rows = len(results)
             for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
-                vortmax_time_series = self.all_vortmax_time_series[ensemble_member]
-                vortmaxes = []
-                vmaxs = self.c20data.vmaxs850[ensemble_member]
-
-                for vmax in vmaxs:
-                    if (self.use_range_cutoff and not
-			(settings.MIN_LON <= vmax[1][0] <= settings.MAX_LON and
-			 settings.MIN_LAT <= vmax[1][1] <= settings.MAX_LAT)):
-                        continue
-
-                    if self.use_vort_cutoff and vmax[0] < self.vort_cutoff:
-                        continue
-
-                    vortmax = VortMax(date, vmax[1], vmax[0])
-                    vortmaxes.append(vortmax)
-
-                if self.use_dist_cutoff:
-                    secondary_vortmaxes = []
-                    for i in range(len(vortmaxes)):
-                        v1 = vortmaxes[i]
-                        for j in range(i + 1, len(vortmaxes)):
-                            v2 = vortmaxes[j]
-                            if self.dist(v1.pos, v2.pos) < self.dist_cutoff:
-                                if v1.vort > v2.vort:
-                                    v1.secondary_vortmax.append(v2)
-                                    secondary_vortmaxes.append(v2)
-                                elif v1.vort <= v2.vort:
-                                    v2.secondary_vortmax.append(v1)
-                                    secondary_vortmaxes.append(v1)
-
-                    for v in secondary_vortmaxes:
-                        if v in vortmaxes:
-                            vortmaxes.remove(v)
-
-                vortmax_time_series[date] = vortmaxes
-
-                for vortmax in vortmaxes:
-                    row = {'date': date,
-                           'em': ensemble_member,
-                           'lon': vortmax.pos[0],
-                           'lat': vortmax.pos[1],
-                           'vort850': vortmax.vort}
-                    res = self.get_other_fields(ensemble_member, vortmax)
-                    row.update(res)
-                    results.append(row)
+                vortmaxes, rows = self.find_member_vortmaxes(date, ensemble_member)
+                self.all_vortmax_time_series[ensemble_member][date] = vortmaxes
+                results.extend(rows)
 
+            progress.update(rows=len(results) - num_rows,
+                            nbytes=self.c20data.bytes_read - bytes_read, current=date)
             index += 1
+        progress.finish()
 
-	end = dt.datetime.now()
-	log.info('Found vortmaxima and fields in {}'.format(end - start))
-
-        columns = ['date', 'em', 
-                   'lon', 
-                   'lat', 
-                   'max_ws_lon',
-                   'max_ws_lat',
-                   'pmin_lon',
-                   'pmin_lat',
-                   'vort9950', 
-                   'vort850', 
-                   'max_ws',
-                   'prmsl',
-                   'pmin_dist',
-                   'pmin',
-                   'p_ambient_diff',
-                   't850',
-                   't9950',
-                   'cape',
-                   'pwat']
-        df = pd.DataFrame(results, columns=columns)
         end = dt.datetime.now()
-        return df
+        log.info('Found vortmaxima and fields in {}'.format(end - start))
+
+        return results_to_dataframe(results)
+
+    def find_member_vortmaxes(self, date, ensemble_member):
+        '''Finds the vortmaxes for one ensemble member at the current date of self.c20data
+
+        :returns: list of vortmaxes and list of rows (dicts) with their fields
+        '''
+        vmaxs = self.c20data.vmaxs850[ensemble_member]
+        vorts = np.array([vmax[0] for vmax in vmaxs], dtype=np.float64)
+        lons = np.array([vmax[1][0] for vmax in vmaxs], dtype=np.float64)
+        lats = np.array([vmax[1][1] for vmax in vmaxs], dtype=np.float64)
+
+        # Stronger neighbours are only looked for among the vortmaxes that pass the vort and
+        # range thresholds.
+        base_mask = cutoff_profile_mask(vorts, lons, lats, None,
+                                        self.run_profile._replace(dist_cutoff=None))
+        base_index = np.where(base_mask)[0]
+        nbr_dists = stronger_neighbour_dists(lons[base_index], lats[base_index],
+                                             vorts[base_index], self.dist)
+        if self.run_profile.dist_cutoff is not None:
+            dist_mask = nbr_dists >= self.run_profile.dist_cutoff
+            base_index, nbr_dists = base_index[dist_mask], nbr_dists[dist_mask]
+
+        vortmaxes = []
+        rows = []
+        for i, nbr_dist in zip(base_index, nbr_dists):
+            vmax = vmaxs[i]
+            vortmax = VortMax(date, vmax[1], vmax[0])
+            vortmaxes.append(vortmax)
+
+            row = {'date': date,
+                   'em': ensemble_member,
+                   'lon': vortmax.pos[0],
+                   'lat': vortmax.pos[1],
+                   'vort850': vortmax.vort,
+                   'nbr_dist': nbr_dist}
+            res = self.get_other_fields(ensemble_member, vortmax)
+            row.update(res)
+            rows.append(row)
+        return vortmaxes, rows
 
     def get_other_fields(self, ensemble_member, vortmax):
         res = {}
@@ -165,6 +256,8 @@ class VortmaxFinder(object):
         lon = self.c20data.lons[min_lon + max_windspeed_pos[1]]
         lat = self.c20data.lats[min_lat + max_windspeed_pos[0]]
 
+        res['lon_idx'] = lon_index
+        res['lat_idx'] = lat_index
         res['max_ws'] = max_windspeed
         res['max_ws_lon'] = lon
         res['max_ws_lat'] = lat
@@ -194,8 +287,8 @@ class VortmaxFinder(object):
             res['p_ambient_diff'] = local_prmsl.mean() - pmin
         else:
             res['pmin'] = local_prmsl.min()
-            res['pmin_lon'] = None
-            res['pmin_lat'] = None
+            res['pmin_lon'] = np.nan
+            res['pmin_lat'] = np.nan
             res['p_ambient_diff'] = local_prmsl.mean() - local_prmsl.min()
 
         res['vort9950'] = self.c20data.vort9950[ensemble_member][lat_index, lon_index]
@@ -1,42 +1,173 @@
 import datetime as dt
 
+import numpy as np
 import pandas as pd
 
 from .. import setup_logging
-from ..utils.utils import geo_dist
+from ..utils.utils import lonlat_to_xyz, chord_to_geo_dist
+from .spatial_index import DateSpatialIndex
 
 log = setup_logging.get_logger('st.matching')
 
+MATCH_COLUMNS = ['bt_name', 'bt_min_dist', 'bt_wind', 'is_hurr']
 
-def simple_matching(best_tracks, df):
+
+def flatten_best_tracks(best_tracks):
+    '''Flattens the fixes of all best tracks into arrays
+
+    :param best_tracks: list of best tracks (e.g. from IbtracsData.load_ibtracks_year)
+    :returns: dict of arrays with one entry per fix (in best track, then date order): bt
+        (index of best track in best_tracks), date, lon, lat, wind, is_hurr
+    '''
+    lengths = [len(bt.dates) for bt in best_tracks]
+    if not best_tracks:
+        return {'bt': np.zeros(0, dtype=np.int64), 'date': np.zeros(0, dtype='datetime64[ns]'),
+                'lon': np.zeros(0), 'lat': np.zeros(0), 'wind': np.zeros(0),
+                'is_hurr': np.zeros(0, dtype=bool)}
+    return {'bt': np.repeat(np.arange(len(best_tracks)), lengths),
+            'date': np.concatenate([np.array(bt.dates, dtype='datetime64[ns]')
+                                    for bt in best_tracks]),
+            'lon': np.concatenate([np.asarray(bt.lons, dtype=np.float64) for bt in best_tracks]),
+            'lat': np.concatenate([np.asarray(bt.lats, dtype=np.float64) for bt in best_tracks]),
+            'wind': np.concatenate([np.asarray(bt.winds, dtype=np.float64)
+                                    for bt in best_tracks]),
+            'is_hurr': np.concatenate([np.array(bt.cls) == 'HU' for bt in best_tracks])}
+
+
+def simple_matching(best_tracks, df, max_dist=None, index=None):
+    '''Matches each best track fix to the nearest vortmax of each ensemble member on its date
+
+    All fixes are looked up in a DateSpatialIndex of the vortmaxes, and the nearest vortmax
+    is found for each fix and ensemble member (the first in df on a tie).
+
+    :param best_tracks: list of best tracks
+    :param df: all_fields DataFrame
+    :param max_dist: only match vortmaxes within this distance (km) of a fix, None for any
+    :param index: DateSpatialIndex of df, created if not given
+    :returns: DataFrame with a row for each (best track, fix, ensemble member) that has a
+        vortmax, in that order, indexed by the vortmax's index in df
+    '''
     start = dt.datetime.now()
-    print(start)
-
-    bt_matches = []
-    index = []
-    for bt in best_tracks:
-        for bt_index, date in enumerate(bt.dates):
-            print(date)
-            curr_inds = df.index[df.date == date]
-
-            min_dists = [{'bt_name': bt.name, 'bt_min_dist': 1e99, 'index': None} for i in range(56)]
-            for i in curr_inds:
-                row = df.iloc[i]
-                vortmax_pos = (row.lon, row.lat)
-                min_dist = min_dists[row.em]['bt_min_dist']
-                bt_pos = (bt.lons[bt_index], bt.lats[bt_index])
-                dist = geo_dist(vortmax_pos, bt_pos)
-                if dist < min_dist:
-                    min_dists[row.em]['bt_min_dist'] = dist
-                    min_dists[row.em]['index'] = i
-                    min_dists[row.em]['bt_wind'] = bt.winds[bt_index]
-                    min_dists[row.em]['is_hurr'] = bt.cls[bt_index] == 'HU'
-
-            for min_dist in min_dists:
-                if min_dist['index'] is not None:
-                    bt_matches.append(min_dist)
-                    index.append(min_dist['index'])
+    log.info('Matching {} best tracks'.format(len(best_tracks)))
+
+    if index is None:
+        index = DateSpatialIndex.from_dataframe(df)
+    fixes = flatten_best_tracks(best_tracks)
+    fix_index, positions, dists = index.nearest_per_member(fixes['date'], fixes['lon'],
+                                                           fixes['lat'], max_dist)
+
+    bt_names = np.array([bt.name for bt in best_tracks], dtype=object)
+    matches = pd.DataFrame({'bt_name': bt_names[fixes['bt'][fix_index]],
+                            'bt_min_dist': dists,
+                            'bt_wind': fixes['wind'][fix_index],
+                            'is_hurr': fixes['is_hurr'][fix_index]},
+                           index=df.index.values[positions], columns=MATCH_COLUMNS)
 
     end = dt.datetime.now()
-    print(end - start)
-    return pd.DataFrame(bt_matches, index=index, columns=['bt_name', 'bt_min_dist', 'bt_wind', 'is_hurr'])
+    log.info('Matched best tracks in {}'.format(end - start))
+    return matches
+
+
+# Track matches must overlap for at least this many 6 hourly timesteps...
+GOOD_MATCH_MIN_OVERLAP = 6
+# ...and be at most this far apart (km) on average.
+GOOD_MATCH_MAX_AV_DIST = 500.
+
+TRACK_MATCH_COLUMNS = ['bt_name', 'bt_index', 'track_id', 'em', 'overlap_start',
+                       'overlap_end', 'overlap', 'cum_dist', 'av_dist']
+
+
+def match_tracks(best_tracks, track_store):
+    '''Scores every (best track, vortmax track) pair by overlap and separation
+
+    The overlap of a pair is the number of best track fixes on dates that the vortmax track
+    has a point at, and cum_dist is the sum of the distances between them. The fixes are
+    joined to the vortmax track points by date: the points are sorted by date, so the points
+    on each fix's date are found by searchsorted. Only tracks that overlap a best track are
+    visited, then the distances for all the (fix, point) pairs are calculated in one go.
+
+    :param best_tracks: list of best tracks
+    :param track_store: TrackStore of vortmax tracks
+    :returns: DataFrame with a row for each pair with an overlap, sorted by best track then
+        track_id
+    '''
+    start = dt.datetime.now()
+    fixes = flatten_best_tracks(best_tracks)
+    dates = track_store.column('date')
+    offsets = track_store.offsets
+    if len(track_store) == 0 or len(fixes['date']) == 0:
+        return pd.DataFrame(columns=TRACK_MATCH_COLUMNS)
+
+    # Number dates in 6 hourly steps from a common origin, ignoring fixes between steps.
+    origin = min(dates.min(), fixes['date'].min())
+    six_hours = np.timedelta64(6, 'h')
+    fix_steps = (fixes['date'] - origin) // six_hours
+    on_step = (fixes['date'] - origin) % six_hours == np.timedelta64(0, 'h')
+    fix_index = np.where(on_step)[0]
+    fix_index = fix_index[np.lexsort((fix_steps[fix_index], fixes['bt'][fix_index]))]
+    fix_bts, fix_steps = fixes['bt'][fix_index], fix_steps[fix_index]
+
+    # Date join: the points of all tracks on each fix's date.
+    point_steps = (dates - origin) // six_hours
+    point_order = np.argsort(point_steps, kind='mergesort')
+    sorted_steps = point_steps[point_order]
+    first_point = np.searchsorted(sorted_steps, fix_steps, side='left')
+    num_points = np.searchsorted(sorted_steps, fix_steps, side='right') - first_point
+    if num_points.sum() == 0:
+        return pd.DataFrame(columns=TRACK_MATCH_COLUMNS)
+
+    pair_fixes = np.repeat(np.arange(len(fix_index)), num_points)
+    step = np.arange(num_points.sum()) - np.repeat(np.cumsum(num_points) - num_points,
+                                                   num_points)
+    points = point_order[first_point[pair_fixes] + step]
+    point_tracks = np.repeat(np.arange(len(track_store)), np.diff(offsets))
+    pair_bts, pair_tracks = fix_bts[pair_fixes], point_tracks[points]
+
+    fixes_xyz = lonlat_to_xyz(fixes['lon'][fix_index[pair_fixes]],
+                              fixes['lat'][fix_index[pair_fixes]])
+    points_xyz = lonlat_to_xyz(track_store.column('lon')[points],
+                               track_store.column('lat')[points])
+    dists = chord_to_geo_dist(np.linalg.norm(fixes_xyz - points_xyz, axis=1))
+
+    # Group the (fix, point) pairs by (best track, track); fixes are in date order within
+    # each best track, so each group runs from its first to its last overlapping fix.
+    order = np.lexsort((pair_fixes, pair_tracks, pair_bts))
+    pair_fixes, pair_bts, pair_tracks = pair_fixes[order], pair_bts[order], pair_tracks[order]
+    dists = dists[order]
+    is_first = np.r_[True, (np.diff(pair_bts) != 0) | (np.diff(pair_tracks) != 0)]
+    group_starts = np.where(is_first)[0]
+    group_ends = np.r_[group_starts[1:], len(pair_fixes)]
+
+    fix_dates = fixes['date'][fix_index]
+    bt_names = np.array([bt.name for bt in best_tracks], dtype=object)
+    group_bts, group_tracks = pair_bts[group_starts], pair_tracks[group_starts]
+    matches = pd.DataFrame({'bt_name': bt_names[group_bts],
+                            'bt_index': group_bts,
+                            'track_id': group_tracks,
+                            'em': track_store.track_ems[group_tracks],
+                            'overlap_start': fix_dates[pair_fixes[group_starts]],
+                            'overlap_end': fix_dates[pair_fixes[group_ends - 1]],
+                            'overlap': group_ends - group_starts,
+                            'cum_dist': np.add.reduceat(dists, group_starts)},
+                           columns=TRACK_MATCH_COLUMNS)
+    matches['av_dist'] = matches.cum_dist / matches.overlap
+
+    end = dt.datetime.now()
+    log.info('Scored {} track matches ({} fix/point pairs) in {}'.format(
+        len(matches), len(pair_fixes), end - start))
+    return matches
+
+
+def good_track_matches(matches, min_overlap=GOOD_MATCH_MIN_OVERLAP,
+                       max_av_dist=GOOD_MATCH_MAX_AV_DIST):
+    '''Picks the best vortmax track for each best track and ensemble member
+
+    :param matches: output of match_tracks
+    :param min_overlap: minimum overlap of a good match
+    :param max_av_dist: maximum average distance (km) of a good match
+    :returns: DataFrame of good matches, with the lowest av_dist for each best track and
+        ensemble member
+    '''
+    good = matches[(matches.overlap >= min_overlap) & (matches.av_dist <= max_av_dist)]
+    good = good.sort_values(['bt_index', 'em', 'av_dist'], kind='mergesort')
+    return good.drop_duplicates(['bt_index', 'em'])
@@ -0,0 +1,340 @@
+'''Drivers that spread stormtracks processing over a pool of worker processes
+
+Worker functions are module level so that they can be pickled by multiprocessing.
+'''
+import datetime as dt
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+
+from .. import setup_logging
+from ..utils.progress import ProgressReporter
+from ..c20data import C20Data, SharedFieldCubes, SharedC20Data
+from ..results import StormtracksResultsManager
+from ..ibtracsdata import IbtracsData
+from .find_vortmax import VortmaxFinder, results_to_dataframe, NUM_ENSEMBLE_MEMBERS
+from .track_store import TrackStore
+from .matching import simple_matching
+
+log = setup_logging.get_logger('st.parallel')
+
+# Per worker process state, set up by _init_member_worker.
+_member_worker_finder = None
+
+
+def shard_date_range(dates, start_date, end_date, num_shards):
+    '''Splits a date range into contiguous shards of (roughly) equal length
+
+    :param dates: array of all available dates (e.g. c20data.dates)
+    :param start_date: first date of range (inclusive)
+    :param end_date: last date of range (inclusive)
+    :param num_shards: number of shards to split range into
+    :returns: list of (shard_start_date, shard_end_date) tuples in date order
+    '''
+    index = np.where(dates == start_date)[0][0]
+    end_index = np.where(dates == end_date)[0][0]
+
+    shards = []
+    for shard_indices in np.array_split(np.arange(index, end_index + 1), num_shards):
+        if len(shard_indices):
+            shards.append((dates[shard_indices[0]], dates[shard_indices[-1]]))
+    return shards
+
+
+def _find_vort_maxima_shard(args):
+    '''Worker: finds vortmaxima for one date shard using its own C20Data'''
+    year, fields, version, finder_kwargs, start_date, end_date = args
+    c20data = C20Data(year, fields=fields, version=version)
+    try:
+        finder = VortmaxFinder(c20data, **finder_kwargs)
+        return finder.find_vort_maxima(start_date, end_date)
+    finally:
+        c20data.close_datasets()
+
+
+def find_vort_maxima_date_sharded(finder, start_date, end_date, num_procs=None):
+    '''Runs finder.find_vort_maxima over a date range split across worker processes
+
+    Each shard is a contiguous chunk of the date range and is processed by a worker
+    with its own C20Data instance. The per-shard outputs are concatenated in date order,
+    so the result is the same as calling finder.find_vort_maxima(start_date, end_date).
+
+    :param finder: configured VortmaxFinder, used as a template for the workers
+    :param start_date: first date to process
+    :param end_date: last date to process
+    :param num_procs: number of worker processes (defaults to number of cores)
+    :returns: pandas DataFrame of all vortmaxima with their fields
+    '''
+    finder.date_range_indices(start_date, end_date)
+    if num_procs is None:
+        num_procs = cpu_count()
+
+    c20data = finder.c20data
+    finder_kwargs = finder.init_kwargs()
+    shards = shard_date_range(c20data.dates, start_date, end_date, num_procs)
+    log.info('finding vortmaxima in range {}-{} using {} shards'.format(
+        start_date, end_date, len(shards)))
+
+    args = [(c20data._year, c20data.fields, c20data.version, finder_kwargs,
+             shard_start, shard_end)
+            for shard_start, shard_end in shards]
+
+    start = dt.datetime.now()
+    pool = Pool(min(num_procs, len(shards)))
+    try:
+        # map preserves the order of shards, and hence the date order.
+        dfs = pool.map(_find_vort_maxima_shard, args)
+    finally:
+        pool.close()
+        pool.join()
+    end = dt.datetime.now()
+    log.info('Found vortmaxima and fields in {}'.format(end - start))
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+def _init_member_worker(cubes, c20data, finder_kwargs):
+    '''Worker initialiser: attaches to the shared field cubes'''
+    global _member_worker_finder
+    _member_worker_finder = VortmaxFinder(SharedC20Data(cubes, c20data), **finder_kwargs)
+
+
+def _find_vort_maxima_members(args):
+    '''Worker: finds vortmaxima for a subset of ensemble members in one slot'''
+    slot, date, ensemble_members = args
+    finder = _member_worker_finder
+    finder.c20data.set_slot(slot, date, ensemble_members)
+
+    rows = []
+    for ensemble_member in ensemble_members:
+        vortmaxes, member_rows = finder.find_member_vortmaxes(date, ensemble_member)
+        rows.extend(member_rows)
+    return rows
+
+
+def _collect_member_rows(async_result, results):
+    '''Waits for one date's member shards and adds their rows (in member order) to results'''
+    num_rows = 0
+    for rows in async_result.get():
+        results.extend(rows)
+        num_rows += len(rows)
+    return num_rows
+
+
+def find_vort_maxima_member_sharded(finder, start_date, end_date, num_procs=None):
+    '''Runs finder.find_vort_maxima with ensemble members split across worker processes
+
+    The calling process acts as the loader: for each date it decodes the NetCDF4 data once
+    into a slot of SharedFieldCubes. Each worker owns a contiguous subset of ensemble members
+    and calculates vorticities, extrema and other fields for them straight from the shared
+    cubes. Two slots are used so that the next date is loaded while the workers process
+    the current one. Rows are returned in the same (date, ensemble member) order as
+    finder.find_vort_maxima(start_date, end_date).
+
+    Loading overwrites the fields of finder.c20data without calculating anything from them,
+    so afterwards its date is set back to what it was (reloading it). If it had no date,
+    it is left with date None and the raw fields of end_date.
+
+    :param finder: configured VortmaxFinder, its c20data is used for loading
+    :param start_date: first date to process
+    :param end_date: last date to process
+    :param num_procs: number of worker processes (defaults to number of cores)
+    :returns: pandas DataFrame of all vortmaxima with their fields
+    '''
+    index, end_index = finder.date_range_indices(start_date, end_date)
+    if num_procs is None:
+        num_procs = cpu_count()
+
+    c20data = finder.c20data
+    original_date = c20data.date
+    # Fields are about to be overwritten by raw data without any derived fields.
+    c20data.date = None
+    shape = (NUM_ENSEMBLE_MEMBERS, len(c20data.lats), len(c20data.lons))
+    cubes = SharedFieldCubes(c20data.fields, shape, num_slots=2)
+    finder_kwargs = finder.init_kwargs()
+    member_shards = [list(members) for members in
+                     np.array_split(np.arange(NUM_ENSEMBLE_MEMBERS), num_procs) if len(members)]
+    log.info('finding vortmaxima in range {}-{} using {} member shards'.format(
+        start_date, end_date, len(member_shards)))
+
+    start = dt.datetime.now()
+    results = []
+    progress = ProgressReporter(log, 'Finding vortmaxima', end_index - index + 1)
+    pool = Pool(len(member_shards), _init_member_worker, (cubes, c20data, finder_kwargs))
+    try:
+        pending, pending_date = None, None
+        while index <= end_index:
+            date = c20data.dates[index]
+            slot = index % cubes.num_slots
+            bytes_read = c20data.bytes_read
+            # The previous user of this slot was collected on the last iteration.
+            c20data._load_ensemble_data(index)
+            cubes.fill(slot, c20data)
+            progress.update(steps=0, nbytes=c20data.bytes_read - bytes_read)
+
+            args = [(slot, date, members) for members in member_shards]
+            async_result = pool.map_async(_find_vort_maxima_members, args)
+            if pending is not None:
+                progress.update(rows=_collect_member_rows(pending, results), current=pending_date)
+            pending, pending_date = async_result, date
+            index += 1
+
+        if pending is not None:
+            progress.update(rows=_collect_member_rows(pending, results), current=pending_date)
+        progress.finish()
+    finally:
+        pool.close()
+        pool.join()
+    end = dt.datetime.now()
+    log.info('Found vortmaxima and fields in {}'.format(end - start))
+
+    if original_date is not None:
+        c20data.set_date(original_date)
+    return results_to_dataframe(results)
+
+
+def _track_member(args):
+    '''Worker: tracks the vortmaxes of one ensemble member, returning their track ids'''
+    tracker, date_idx, lons, lats, vorts = args
+    return tracker.track_member(date_idx, lons, lats, vorts)
+
+
+def track_member_sharded(tracker, df, num_procs=None):
+    '''Runs tracker.track(df) with ensemble members tracked in worker processes
+
+    Only the arrays needed for linking (date_idx, lon, lat, vort) are sent to the workers,
+    which send back a track id for each vortmax. The track tables are built and merged in
+    member order in the calling process, so the result is identical to tracker.track(df).
+
+    :param tracker: tracker to use (e.g. VortmaxNearestNeighbourTracker), must be picklable
+    :param df: all_fields DataFrame, as passed to tracker.track
+    :param num_procs: number of worker processes (defaults to number of cores)
+    :returns: TrackStore of all tracks
+    '''
+    if num_procs is None:
+        num_procs = cpu_count()
+
+    all_columns = tracker._member_inputs(df)
+    args = [(tracker, columns['date_idx'], columns['lon'], columns['lat'], columns['vort'])
+            for columns in all_columns]
+    log.info('tracking {} ensemble members using {} processes'.format(len(args), num_procs))
+
+    start = dt.datetime.now()
+    stores = []
+    progress = ProgressReporter(log, 'Tracking vortmaxima', len(args))
+    pool = Pool(max(min(num_procs, len(args)), 1))
+    try:
+        # imap preserves the order of members, so tracks are numbered as in a serial run.
+        for columns, track_ids in zip(all_columns, pool.imap(_track_member, args)):
+            stores.append(TrackStore.from_track_ids(columns, track_ids))
+            progress.update(rows=len(track_ids), current=columns['em'][0])
+        progress.finish()
+    finally:
+        pool.close()
+        pool.join()
+    end = dt.datetime.now()
+    log.info('Tracked vortmaxima in {}'.format(end - start))
+
+    tracker.track_store = TrackStore.concat(stores)
+    return tracker.track_store
+
+
+def _match_members(best_tracks, df, ensemble_members):
+    '''Runs simple_matching on the vortmaxes of some ensemble members
+
+    Adds the keys needed to put partitions back into the order of simple_matching (see
+    _merge_partitions): best track, fix date and ensemble member.
+    '''
+    df = df[df.em.isin(ensemble_members)]
+    matches = simple_matching(best_tracks, df)
+    bt_indices = dict((bt.name, i) for i, bt in enumerate(best_tracks))
+    matches['_bt'] = matches.bt_name.map(bt_indices).values
+    matches['_date'] = df.date.loc[matches.index].values
+    matches['_em'] = df.em.loc[matches.index].values
+    return matches
+
+
+def _merge_partitions(partitions):
+    '''Merges the output of _match_members for all partitions of a year, in any order, into
+    what simple_matching gives for all ensemble members'''
+    matches = pd.concat(partitions)
+    matches = matches.sort_values(['_bt', '_date', '_em'], kind='mergesort')
+    return matches.drop(['_bt', '_date', '_em'], axis=1)
+
+
+def _match_partition(args):
+    '''Worker: matches best tracks to the vortmaxes of some ensemble members in one year'''
+    results_name, output_dir, year, ensemble_members, best_tracks = args
+    results_manager = StormtracksResultsManager(results_name, output_dir)
+    df = results_manager.get_result(year, 'all_fields')
+    return year, _match_members(best_tracks, df, ensemble_members)
+
+
+def _c20_dates(year):
+    '''Returns the 20CR dates of a year, which its best tracks are resampled onto'''
+    c20data = C20Data(year, fields=['prmsl'])
+    c20data.close_datasets()
+    return c20data.dates
+
+
+def match_years_sharded(results_name, years, num_procs=None, num_member_shards=1,
+                        output_dir=None, ibdata=None, force=False):
+    '''Runs simple_matching for many years, with (year, ensemble members) partitions
+    processed in worker processes
+
+    Each worker reads a year's all_fields from the results store. A year's
+    best_track_matches are saved as soon as all of its partitions are done, in the same
+    order as simple_matching would give for the whole year. As in process_2005, best tracks
+    are resampled onto the year's 20CR dates before matching. Years that already have
+    best_track_matches are skipped (unless force), so an interrupted run can be resumed by
+    running it again.
+
+    :param results_name: name of results (as passed to StormtracksResultsManager)
+    :param years: years to match, each must have all_fields saved
+    :param num_procs: number of worker processes (defaults to number of cores)
+    :param num_member_shards: number of partitions to split each year's members into
+    :param output_dir: results output dir (defaults to settings.OUTPUT_DIR)
+    :param ibdata: IbtracsData to load best tracks with
+    :param force: rematch years that already have best_track_matches
+    :returns: list of years that were matched
+    '''
+    if num_procs is None:
+        num_procs = cpu_count()
+    if ibdata is None:
+        ibdata = IbtracsData(verbose=False)
+    results_manager = StormtracksResultsManager(results_name, output_dir)
+
+    todo_years = [year for year in years
+                  if force or not results_manager.has_result(year, 'best_track_matches')]
+    log.info('matching {} years ({} already done) using {} processes'.format(
+        len(todo_years), len(years) - len(todo_years), num_procs))
+
+    member_shards = [list(members) for members in
+                     np.array_split(np.arange(NUM_ENSEMBLE_MEMBERS), num_member_shards)
+                     if len(members)]
+    args = []
+    for year in todo_years:
+        best_tracks = ibdata.load_ibtracks_year(year, dates=_c20_dates(year))
+        args.extend([(results_name, output_dir, year, members, best_tracks)
+                     for members in member_shards])
+
+    start = dt.datetime.now()
+    year_partitions = dict((year, []) for year in todo_years)
+    progress = ProgressReporter(log, 'Matching partitions', len(args))
+    pool = Pool(max(min(num_procs, len(args)), 1))
+    try:
+        for year, matches in pool.imap_unordered(_match_partition, args):
+            year_partitions[year].append(matches)
+            progress.update(rows=len(matches), current=year)
+            if len(year_partitions[year]) == len(member_shards):
+                matches = _merge_partitions(year_partitions.pop(year))
+                results_manager.save_result(year, 'best_track_matches', matches)
+        progress.finish()
+    finally:
+        pool.close()
+        pool.join()
+    end = dt.datetime.now()
+    log.info('Matched {} years in {}'.format(len(todo_years), end - start))
+
+    return todo_years
@@ -0,0 +1,79 @@
+'''Explicit column dtypes for results produced by the processing modules
+
+Results are cast to these dtypes when they are created, saved and loaded, which keeps
+the memory and disk footprint of large (multi-decade) results down.
+'''
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Output of VortmaxFinder.find_vort_maxima, saved under the 'all_fields' key.
+ALL_FIELDS_SCHEMA = OrderedDict([
+    ('date', 'datetime64[ns]'),
+    ('em', np.int8),
+    ('lon', np.float32),
+    ('lat', np.float32),
+    ('lon_idx', np.int16),
+    ('lat_idx', np.int16),
+    ('max_ws_lon', np.float32),
+    ('max_ws_lat', np.float32),
+    ('pmin_lon', np.float32),
+    ('pmin_lat', np.float32),
+    ('vort9950', np.float32),
+    ('vort850', np.float32),
+    ('nbr_dist', np.float32),
+    ('max_ws', np.float32),
+    ('prmsl', np.float32),
+    ('pmin_dist', np.float32),
+    ('pmin', np.float32),
+    ('p_ambient_diff', np.float32),
+    ('t850', np.float32),
+    ('t9950', np.float32),
+    ('cape', np.float32),
+    ('pwat', np.float32),
+])
+
+# Output of track_features.track_features, saved under the 'track_features' key.
+TRACK_FEATURES_SCHEMA = OrderedDict([
+    ('track_id', np.int32),
+    ('em', np.int8),
+    ('start_date', 'datetime64[ns]'),
+    ('end_date', 'datetime64[ns]'),
+    ('num_points', np.int16),
+    ('lifetime', np.float32),
+    ('max_vort', np.float32),
+    ('min_pmin', np.float32),
+    ('max_ws', np.float32),
+    ('pdi', np.float32),
+    ('genesis_lon', np.float32),
+    ('genesis_lat', np.float32),
+    ('lysis_lon', np.float32),
+    ('lysis_lat', np.float32),
+])
+
+# Schemas used by StormtracksResultsManager, keyed by result_key.
+RESULT_SCHEMAS = {
+    'all_fields': ALL_FIELDS_SCHEMA,
+    'track_features': TRACK_FEATURES_SCHEMA,
+}
+
+
+def apply_schema(df, schema):
+    '''Casts the columns of df (in place) to the dtypes given in schema
+
+    Columns that are not in the schema are left untouched, as are schema columns
+    that are missing from df (e.g. when loading results saved before they were added).
+
+    :param df: pandas DataFrame to cast
+    :param schema: OrderedDict of column name to dtype
+    :returns: DataFrame with cast columns
+    '''
+    for column, dtype in schema.items():
+        if column not in df:
+            continue
+        if dtype == 'datetime64[ns]':
+            df[column] = pd.to_datetime(df[column])
+        elif df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
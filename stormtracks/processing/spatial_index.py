@@ -0,0 +1,137 @@
+'''Per date spatial index of points, e.g. the vortmaxes in an all_fields DataFrame
+
+Points are sorted by date, and the points of each date are put into a cKDTree on their
+3D coordinates when it is first needed. This answers the questions asked by matching
+and analysis code (which points are near this one on its date, which are nearest for
+each ensemble member, which pairs of points are close) without comparing every point with
+every other point.
+'''
+import numpy as np
+from scipy.spatial import cKDTree
+
+from ..utils.utils import geo_dist, lonlat_to_xyz, geo_dist_to_chord
+
+
+class DateSpatialIndex(object):
+    '''Per date spatial index
+
+    :param dates: date of each point
+    :param lons: lon of each point
+    :param lats: lat of each point
+    :param ems: ensemble member of each point (needed for nearest_per_member)
+    '''
+    def __init__(self, dates, lons, lats, ems=None):
+        dates = np.asarray(dates).astype('datetime64[ns]')
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.ems = ems if ems is None else np.asarray(ems)
+
+        # Positions of the points sorted by date (stable, so in order within a date).
+        self.order = np.argsort(dates, kind='mergesort')
+        self.sorted_dates = dates[self.order]
+        self.dates, self.starts = np.unique(self.sorted_dates, return_index=True)
+        self.ends = np.r_[self.starts[1:], len(self.order)]
+        self._xyz = None
+        self._trees = {}
+
+    @classmethod
+    def from_dataframe(cls, df):
+        '''Creates an index of the rows of a DataFrame with date, lon, lat and em columns'''
+        return cls(df.date.values, df.lon.values, df.lat.values, df.em.values)
+
+    def __len__(self):
+        return len(self.order)
+
+    def date_positions(self, date):
+        '''Returns the positions of the points on a date (in order)'''
+        date = np.datetime64(date, 'ns')
+        start = np.searchsorted(self.sorted_dates, date, side='left')
+        end = np.searchsorted(self.sorted_dates, date, side='right')
+        return self.order[start:end]
+
+    def _tree(self, date_number):
+        if date_number not in self._trees:
+            if self._xyz is None:
+                self._xyz = lonlat_to_xyz(self.lons[self.order], self.lats[self.order])
+            start, end = self.starts[date_number], self.ends[date_number]
+            self._trees[date_number] = cKDTree(self._xyz[start:end])
+        return self._trees[date_number]
+
+    def query(self, dates, lons, lats, max_dist=None):
+        '''Finds the points on the same date as, and within max_dist of, each query point
+
+        :param dates: date of each query point
+        :param lons: lon of each query point
+        :param lats: lat of each query point
+        :param max_dist: distance (km), None for all points on the same date
+        :returns: query point index and position of each pair found, ordered by query point
+            then position
+        '''
+        dates = np.asarray(dates).astype('datetime64[ns]')
+        starts = np.searchsorted(self.sorted_dates, dates, side='left')
+        counts = np.searchsorted(self.sorted_dates, dates, side='right') - starts
+
+        if max_dist is None:
+            query_index = np.repeat(np.arange(len(dates)), counts)
+            step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            return query_index, self.order[np.repeat(starts, counts) + step]
+
+        xyz = lonlat_to_xyz(lons, lats)
+        max_chord = geo_dist_to_chord(max_dist)
+        date_numbers = np.searchsorted(self.dates, dates)
+        all_query_index = [np.zeros(0, dtype=np.int64)]
+        all_sorted_positions = [np.zeros(0, dtype=np.int64)]
+        for date_number in np.unique(date_numbers[counts > 0]):
+            query_index = np.where((date_numbers == date_number) & (counts > 0))[0]
+            neighbours = self._tree(date_number).query_ball_point(xyz[query_index], max_chord)
+            lengths = [len(n) for n in neighbours]
+            all_query_index.append(np.repeat(query_index, lengths))
+            all_sorted_positions.append(self.starts[date_number] +
+                                        np.array([i for n in neighbours for i in n],
+                                                 dtype=np.int64))
+
+        query_index = np.concatenate(all_query_index)
+        positions = self.order[np.concatenate(all_sorted_positions)]
+        order = np.lexsort((positions, query_index))
+        return query_index[order], positions[order]
+
+    def nearest_per_member(self, dates, lons, lats, max_dist=None):
+        '''Finds the nearest point of each ensemble member to each query point
+
+        Only points on the same date and within max_dist are considered. On a tie the first
+        point is taken.
+
+        :returns: query point index, position and distance of each nearest point, ordered by
+            query point then ensemble member
+        '''
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        query_index, positions = self.query(dates, lons, lats, max_dist)
+        ems = self.ems[positions]
+        dists = geo_dist((self.lons[positions], self.lats[positions]),
+                         (lons[query_index], lats[query_index]))
+
+        # Nearest first within each (query point, em), NaN distances (never nearer) last.
+        order = np.lexsort((positions, dists, ems, query_index))
+        query_index, ems, dists, positions = [a[order] for a in
+                                              (query_index, ems, dists, positions)]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = (query_index[1:] != query_index[:-1]) | (ems[1:] != ems[:-1])
+        is_nearest = is_first & ~np.isnan(dists)
+        if max_dist is not None:
+            is_nearest &= dists <= max_dist
+        return query_index[is_nearest], positions[is_nearest], dists[is_nearest]
+
+    def close_pairs(self, max_dist):
+        '''Finds all pairs of points on the same date that are within max_dist of each other
+
+        :returns: (n, 2) array of positions of the pairs
+        '''
+        max_chord = geo_dist_to_chord(max_dist)
+        all_pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for date_number, (start, end) in enumerate(zip(self.starts, self.ends)):
+            if end - start < 2:
+                continue
+            pairs = self._tree(date_number).query_pairs(max_chord, output_type='ndarray')
+            all_pairs.append(self.order[pairs + start])
+        return np.concatenate(all_pairs)
@@ -0,0 +1,88 @@
+'''Per track summaries of the tracks in a TrackStore
+
+All tracks are summarised at once: as the points of each track are contiguous in the
+TrackStore, every summary is one ufunc reduceat over a column.
+'''
+import numpy as np
+import pandas as pd
+
+from .schema import TRACK_FEATURES_SCHEMA, apply_schema
+
+# Point fields (other than TrackStore columns) that the features need.
+FEATURE_FIELDS = ['pmin', 'max_ws']
+
+
+def track_fields(track_store, all_fields, names=FEATURE_FIELDS):
+    '''Gets fields for the points of a TrackStore
+
+    Fields already collected into the store (e.g. by FieldFinder) are used where present,
+    otherwise they are looked up in all_fields using the points' row column.
+
+    :param track_store: TrackStore
+    :param all_fields: all_fields DataFrame the tracks were made from (can be None)
+    :param names: field names
+    :returns: dict of field name to array (NaN where a field is not available)
+    '''
+    fields = {}
+    num_points = len(track_store.points)
+    rows = track_store.column('row')
+    positions = None
+    if all_fields is not None:
+        positions = all_fields.index.get_indexer(rows)
+    for name in names:
+        if name in track_store.points:
+            fields[name] = track_store.column(name).astype(np.float64)
+        elif positions is not None and name in all_fields:
+            values = all_fields[name].values.astype(np.float64)[positions]
+            values[positions == -1] = np.nan
+            fields[name] = values
+        else:
+            fields[name] = np.ones(num_points) * np.nan
+    return fields
+
+
+def track_features(track_store, all_fields=None):
+    '''Calculates summary features of every track
+
+    Features are: start/end date, number of points, lifetime (hours), max vorticity,
+    min pressure minimum, max wind speed, power dissipation index (PDI, sum of the cube
+    of max wind speed over all 6 hourly points), and genesis/lysis positions. Missing
+    fields are ignored (a feature is NaN if a field is missing at all points).
+
+    :param track_store: TrackStore
+    :param all_fields: all_fields DataFrame the tracks were made from, used for any fields
+        that have not been collected into track_store
+    :returns: DataFrame with one row per track, in track_id order
+    '''
+    num_tracks = len(track_store)
+    if num_tracks == 0:
+        return apply_schema(pd.DataFrame(columns=list(TRACK_FEATURES_SCHEMA.keys())),
+                            TRACK_FEATURES_SCHEMA)
+
+    starts = track_store.offsets[:-1]
+    ends = track_store.offsets[1:] - 1
+    fields = track_fields(track_store, all_fields)
+    dates = track_store.column('date')
+    lons, lats = track_store.column('lon'), track_store.column('lat')
+
+    ws = fields['max_ws']
+    has_ws = np.add.reduceat(~np.isnan(ws), starts) > 0
+    pdi = np.add.reduceat(np.nan_to_num(ws) ** 3, starts)
+    pdi[~has_ws] = np.nan
+
+    features = pd.DataFrame(dict(
+        track_id=np.arange(num_tracks),
+        em=track_store.track_ems,
+        start_date=dates[starts],
+        end_date=dates[ends],
+        num_points=track_store.lengths,
+        lifetime=(dates[ends] - dates[starts]) / np.timedelta64(1, 'h'),
+        max_vort=np.maximum.reduceat(track_store.column('vort'), starts),
+        min_pmin=np.fmin.reduceat(fields['pmin'], starts),
+        max_ws=np.fmax.reduceat(ws, starts),
+        pdi=pdi,
+        genesis_lon=lons[starts],
+        genesis_lat=lats[starts],
+        lysis_lon=lons[ends],
+        lysis_lat=lats[ends]), columns=list(TRACK_FEATURES_SCHEMA.keys()))
+    return apply_schema(features, TRACK_FEATURES_SCHEMA)
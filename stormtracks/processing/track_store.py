@@ -0,0 +1,225 @@
+'''Columnar storage for vortmax tracks
+
+Replaces linked VortMax/VortMaxTrack objects: every point of every track is a row of one
+DataFrame, and tracks are contiguous runs of rows.
+'''
+import numpy as np
+import pandas as pd
+
+# Tracks with fewer points than this are discarded.
+MIN_TRACK_LENGTH = 6
+
+# Columns that every TrackStore has. em: ensemble member, date_idx: index of 6 hourly timestep,
+# row: index of the vortmax in the all_fields DataFrame it came from (-1 if unknown).
+TRACK_COLUMNS = ['track_id', 'em', 'date', 'date_idx', 'lon', 'lat', 'vort', 'row']
+
+
+def chain_links(step_sizes, links):
+    '''Turns links between consecutive timesteps into a track id for each point
+
+    :param step_sizes: number of points in each timestep
+    :param links: list of link arrays, one per pair of consecutive timesteps, holding the
+        index in the next timestep of each point (or -1)
+    :returns: int array of track ids for all points (in timestep order), tracks are numbered
+        in the order of their first point
+    '''
+    track_ids = np.empty(sum(step_sizes), dtype=np.int64)
+    next_track_id = 0
+    prev_ids = None
+    offset = 0
+    for i, step_size in enumerate(step_sizes):
+        ids = -np.ones(step_size, dtype=np.int64)
+        if i > 0:
+            step_links = links[i - 1]
+            is_linked = step_links >= 0
+            ids[step_links[is_linked]] = prev_ids[is_linked]
+
+        is_new = ids == -1
+        num_new = is_new.sum()
+        ids[is_new] = np.arange(next_track_id, next_track_id + num_new)
+        next_track_id += num_new
+
+        track_ids[offset:offset + step_size] = ids
+        offset += step_size
+        prev_ids = ids
+    return track_ids
+
+
+class TrackStore(object):
+    '''Columnar store of tracks
+
+    All points are held in one DataFrame, sorted by track_id and then date_idx, with the
+    tracks numbered 0 to len(self) - 1. offsets[i]:offsets[i + 1] are the rows of track i,
+    so any track's points can be got in O(1) as views of the column arrays, and
+    to_dataframe is free. Extra per point columns (e.g. fields collected along the tracks)
+    can be added with add_columns.
+
+    :param points: DataFrame with (at least) TRACK_COLUMNS, sorted by track_id, date_idx
+    '''
+    def __init__(self, points):
+        self.points = points
+        track_ids = points.track_id.values
+        num_tracks = track_ids[-1] + 1 if len(track_ids) else 0
+        self.offsets = np.searchsorted(track_ids, np.arange(num_tracks + 1))
+        self._columns = {}
+
+    @classmethod
+    def from_track_ids(cls, columns, track_ids, min_length=MIN_TRACK_LENGTH):
+        '''Creates a TrackStore from points in timestep order and their track ids
+
+        :param columns: dict of column name to array, one entry per point
+        :param track_ids: track id of each point (e.g. from chain_links)
+        :param min_length: tracks with fewer points are discarded
+        :returns: TrackStore, with tracks renumbered in order of their original ids
+        '''
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        lengths = np.bincount(track_ids) if len(track_ids) else np.zeros(0, dtype=np.int64)
+        is_kept = lengths >= min_length
+        new_ids = np.cumsum(is_kept) - 1
+
+        point_mask = is_kept[track_ids]
+        # Points are in timestep order, so a stable sort by track keeps each track in order.
+        order = np.where(point_mask)[0][np.argsort(track_ids[point_mask], kind='mergesort')]
+
+        points = pd.DataFrame(dict((name, np.asarray(values)[order])
+                                   for name, values in columns.items()))
+        points['track_id'] = new_ids[track_ids[order]]
+        other_columns = [name for name in points.columns if name not in TRACK_COLUMNS]
+        return cls(points[TRACK_COLUMNS + other_columns])
+
+    @classmethod
+    def concat(cls, stores):
+        '''Joins several stores (e.g. one per ensemble member) into one, in the order given'''
+        all_points = []
+        num_tracks = 0
+        for store in stores:
+            points = store.points.copy()
+            points['track_id'] += num_tracks
+            num_tracks += len(store)
+            all_points.append(points)
+        if not all_points:
+            return cls(pd.DataFrame(columns=TRACK_COLUMNS))
+        return cls(pd.concat(all_points, ignore_index=True))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        '''Number of points in each track'''
+        return np.diff(self.offsets)
+
+    @property
+    def track_ems(self):
+        '''Ensemble member of each track'''
+        return self.column('em')[self.offsets[:-1]]
+
+    def column(self, name):
+        '''Returns a column of all points as a numpy array'''
+        if name not in self._columns:
+            self._columns[name] = self.points[name].values
+        return self._columns[name]
+
+    def track_slice(self, track_id):
+        '''Returns the slice of rows belonging to a track'''
+        return slice(self.offsets[track_id], self.offsets[track_id + 1])
+
+    def track_column(self, track_id, name):
+        '''Returns one column of a track's points (a view, no copy)'''
+        return self.column(name)[self.track_slice(track_id)]
+
+    def get_track(self, track_id):
+        '''Returns a track's points as a DataFrame'''
+        return self.points.iloc[self.track_slice(track_id)]
+
+    def add_columns(self, columns):
+        '''Adds per point columns, e.g. fields collected along the tracks
+
+        :param columns: dict of column name to array (one entry per point)
+        '''
+        for name, values in columns.items():
+            self.points[name] = values
+            self._columns.pop(name, None)
+
+    def select(self, track_mask):
+        '''Returns a new TrackStore with only the tracks in track_mask (renumbered)'''
+        track_mask = np.asarray(track_mask, dtype=bool)
+        new_ids = np.cumsum(track_mask) - 1
+        track_ids = self.column('track_id')
+        point_mask = track_mask[track_ids]
+        points = self.points[point_mask].reset_index(drop=True)
+        points['track_id'] = new_ids[track_ids[point_mask]]
+        return TrackStore(points)
+
+    def to_dataframe(self):
+        '''Returns all points as a DataFrame (no copy)'''
+        return self.points
+
+
+def grid_indices(values, grid_values):
+    '''Returns the index in grid_values of each of values (which must all be on the grid)'''
+    sorter = np.argsort(grid_values)
+    positions = np.searchsorted(grid_values, values, sorter=sorter)
+    indices = sorter[np.clip(positions, 0, len(grid_values) - 1)]
+    if len(values) and (grid_values[indices] != values).any():
+        raise Exception('Values are not all on the grid')
+    return indices
+
+
+def round_to_grid(values, spacing=2):
+    '''Rounds values to the nearest multiple of spacing (halves away from zero, like round)'''
+    scaled = np.asarray(values, dtype=np.float64) / spacing
+    return np.sign(scaled) * np.floor(np.abs(scaled) + 0.5) * spacing
+
+
+class TrackDateIndex(object):
+    '''Index of the points of a TrackStore by timestep
+
+    The points of each timestep are held as one contiguous block of rows (sorted by ensemble
+    member), so everything needed to look them up in that timestep's fields can be got with
+    one slice.
+
+    :param track_store: TrackStore to index
+    :param lons: lons of the grid
+    :param lats: lats of the grid
+    '''
+    def __init__(self, track_store, lons, lats):
+        date_idx = track_store.column('date_idx')
+        ems = track_store.column('em')
+        order = np.lexsort((np.arange(len(date_idx)), ems, date_idx))
+
+        # Points can come from an interpolated field, so round them onto the 2 degree grid.
+        lon_idx = grid_indices(round_to_grid(track_store.column('lon')[order]), lons)
+        lat_idx = grid_indices(round_to_grid(track_store.column('lat')[order]), lats)
+
+        self.point_index = order
+        self.rows = np.column_stack([ems[order], lon_idx, lat_idx,
+                                     track_store.column('track_id')[order]]).astype(np.int32)
+
+        sorted_date_idx = date_idx[order]
+        if len(order):
+            starts = np.r_[0, np.where(np.diff(sorted_date_idx))[0] + 1]
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        self.date_idx = sorted_date_idx[starts]
+        self.dates = track_store.column('date')[order][starts]
+        self.offsets = np.r_[starts, len(order)].astype(np.int64)
+
+    def __len__(self):
+        return len(self.date_idx)
+
+    def step(self, step_index):
+        '''Returns the points of the step_index-th timestep that has any points
+
+        :returns: (point indices into the TrackStore, (n, 4) array of rows of
+            em, lon_idx, lat_idx, track_id), both contiguous
+        '''
+        step_slice = slice(self.offsets[step_index], self.offsets[step_index + 1])
+        return self.point_index[step_slice], self.rows[step_slice]
+
+    def lookup(self, date_idx):
+        '''Returns the points at a timestep (empty arrays if there are none), as step'''
+        step_index = np.searchsorted(self.date_idx, date_idx)
+        if step_index == len(self.date_idx) or self.date_idx[step_index] != date_idx:
+            return self.point_index[:0], self.rows[:0]
+        return self.step(step_index)
@@ -1,15 +1,109 @@
-from collections import OrderedDict, namedtuple
-import datetime as dt
+from collections import OrderedDict
 
 import numpy as np
+import pandas as pd
+from scipy.ndimage.filters import minimum_filter
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 from .. import setup_logging
-from ..utils.utils import dist, geo_dist, pairwise, find_extrema
+from ..utils.utils import (geo_dist, geo_dist_matrix, dist_matrix, pairwise,
+                           lonlat_to_xyz, geo_dist_to_chord, chord_to_geo_dist)
+from ..utils.progress import ProgressReporter
+from .track_store import (TrackStore, TrackDateIndex, chain_links, MIN_TRACK_LENGTH,
+                          TRACK_COLUMNS)
 
 log = setup_logging.get_logger('st.tracking')
 
 NUM_ENSEMBLE_MEMBERS = 56
 
+# Fields collected along tracks by FieldFinder (NaN where they could not be found).
+TRACK_FIELD_COLUMNS = ['max_ws', 'max_ws_lon', 'max_ws_lat',
+                       'pmin_dist', 'pmin', 'pmin_lon', 'pmin_lat', 'p_ambient_diff',
+                       't850', 't9950', 'cape', 'pwat']
+
+
+def link_nearest_neighbours(dists, dist_cutoff):
+    '''Links each point in one timestep to its nearest neighbour in the next timestep
+
+    Only neighbours closer than dist_cutoff are linked. Where several points have the same
+    nearest neighbour, only the nearest of them keeps the link (the first one on a tie).
+
+    :param dists: (n1, n2) array of distances from the points in one timestep to the next
+    :param dist_cutoff: maximum distance between linked points
+    :returns: int array of length n1 with the index of each point's next point, or -1
+    '''
+    num_points, num_next_points = dists.shape
+    links = -np.ones(num_points, dtype=np.int32)
+    if num_points == 0 or num_next_points == 0:
+        return links
+
+    nearest = dists.argmin(axis=1)
+    nearest_dists = dists[np.arange(num_points), nearest]
+    linked = np.where(nearest_dists < dist_cutoff)[0]
+
+    # Sort by next point, then distance, then index: the first of each run of equal
+    # next points is the one that keeps the link.
+    order = np.lexsort((linked, nearest_dists[linked], nearest[linked]))
+    linked = linked[order]
+    next_points = nearest[linked]
+    is_first = np.ones(len(linked), dtype=bool)
+    is_first[1:] = next_points[1:] != next_points[:-1]
+
+    links[linked[is_first]] = next_points[is_first]
+    return links
+
+
+def link_min_cost(point_idx, next_point_idx, costs, num_points):
+    '''Links points in one timestep to the next by solving a min-cost assignment
+
+    Only the candidate pairs given can be linked. The candidate pairs are split into
+    connected components and an assignment is solved for each one, so the cost is
+    close to linear in the number of candidates when they are sparse. Within a component,
+    as many pairs as possible are linked, and then the total cost is minimised.
+
+    :param point_idx: index in the first timestep of each candidate pair
+    :param next_point_idx: index in the next timestep of each candidate pair
+    :param costs: cost of linking each candidate pair
+    :param num_points: number of points in the first timestep
+    :returns: int array of length num_points with the index of each point's next point, or -1
+    '''
+    links = -np.ones(num_points, dtype=np.int32)
+    if len(point_idx) == 0:
+        return links
+
+    # Nodes of the bipartite graph are the points, then the next points.
+    num_next_points = next_point_idx.max() + 1
+    num_nodes = num_points + num_next_points
+    graph = coo_matrix((np.ones(len(point_idx)), (point_idx, num_points + next_point_idx)),
+                       shape=(num_nodes, num_nodes))
+    num_components, labels = connected_components(graph, directed=False)
+
+    pair_labels = labels[point_idx]
+    order = np.argsort(pair_labels, kind='mergesort')
+    starts = np.r_[0, np.where(np.diff(pair_labels[order]))[0] + 1]
+    ends = np.r_[starts[1:], len(order)]
+
+    for start, end in zip(starts, ends):
+        pairs = order[start:end]
+        if len(pairs) == 1:
+            links[point_idx[pairs[0]]] = next_point_idx[pairs[0]]
+            continue
+
+        rows, row_idx = np.unique(point_idx[pairs], return_inverse=True)
+        cols, col_idx = np.unique(next_point_idx[pairs], return_inverse=True)
+        # Pairs that are not candidates cost more than all the candidates together.
+        no_link_cost = costs[pairs].sum() + 1
+        component_costs = np.full((len(rows), len(cols)), no_link_cost)
+        component_costs[row_idx, col_idx] = costs[pairs]
+
+        assigned_rows, assigned_cols = linear_sum_assignment(component_costs)
+        is_candidate = component_costs[assigned_rows, assigned_cols] < no_link_cost
+        links[rows[assigned_rows[is_candidate]]] = cols[assigned_cols[is_candidate]]
+    return links
+
 
 class VortmaxNearestNeighbourTracker(object):
     '''Simple nearest neighbour tracker
@@ -20,199 +114,523 @@ class VortmaxNearestNeighbourTracker(object):
         self.use_geo_dist = True
 
         if self.use_geo_dist:
-            self.dist = geo_dist
+            self.dist_matrix = geo_dist_matrix
             self.dist_cutoff = geo_dist((0, 0), (2, 0)) * 8
         else:
-            self.dist = dist
+            self.dist_matrix = dist_matrix
             self.dist_cutoff = 5
 
-    def _construct_vortmax_tracks_by_date(self, all_vortmax_time_series):
-        self.all_vort_tracks_by_date = []
-        for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
-            vortmax_time_series = all_vortmax_time_series[ensemble_member]
-            vortmax_tracks = []
-            vort_tracks_by_date = OrderedDict()
-            # Find all start vortmaxes (those that have no previous vortmaxes)
-            # and use these to generate a track.
-            for vortmaxes in vortmax_time_series.values():
-                for vortmax in vortmaxes:
-                    if len(vortmax.prev_vortmax) == 0:
-                        vortmax_track = VortMaxTrack(vortmax, ensemble_member)
-                        if len(vortmax_track.vortmaxes) >= 6:
-                            vortmax_tracks.append(vortmax_track)
-
-                            for date in vortmax_track.vortmax_by_date.keys():
-                                if date not in vort_tracks_by_date:
-                                    vort_tracks_by_date[date] = []
-                                vort_tracks_by_date[date].append(vortmax_track)
-
-                    # Allows vort_tracks_by_date to be serialized.
-                    vortmax.next_vortmax = []
-                    vortmax.prev_vortmax = []
-
-            self.all_vort_tracks_by_date.append(vort_tracks_by_date)
-        return self.all_vort_tracks_by_date
+    def link(self, lons1, lats1, vorts1, lons2, lats2, vorts2):
+        '''Links the vortmaxes in one timestep to those in the next
+
+        :returns: int array with the index in the next timestep of each vortmax, or -1
+        '''
+        dists = self.dist_matrix(lons1, lats1, lons2, lats2)
+        return link_nearest_neighbours(dists, self.dist_cutoff)
+
+    def link_steps(self, steps):
+        '''Links the vortmaxes in each consecutive pair of timesteps
+
+        Timesteps that are not adjacent (i.e. there is a gap between them) are not linked.
+
+        :param steps: list of (date_idx, lons, lats, vorts), one entry per timestep
+        :returns: list of link arrays, one for each pair of timesteps
+        '''
+        all_links = []
+        for step1, step2 in pairwise(steps):
+            date_idx1, lons1, lats1, vorts1 = step1
+            date_idx2, lons2, lats2, vorts2 = step2
+            if date_idx2 == date_idx1 + 1:
+                all_links.append(self.link(lons1, lats1, vorts1, lons2, lats2, vorts2))
+            else:
+                all_links.append(-np.ones(len(lons1), dtype=np.int32))
+        return all_links
+
+    def track_member(self, date_idx, lons, lats, vorts):
+        '''Tracks the vortmaxes of one ensemble member
+
+        :param date_idx: timestep index of each vortmax (must be sorted)
+        :param lons: array of vortmax lons
+        :param lats: array of vortmax lats
+        :param vorts: array of vortmax vorts
+        :returns: track id of each vortmax, tracks are numbered in order of their first vortmax
+        '''
+        if len(date_idx) == 0:
+            return np.zeros(0, dtype=np.int64)
+        step_starts = np.r_[0, np.where(np.diff(date_idx))[0] + 1]
+        step_ends = np.r_[step_starts[1:], len(date_idx)]
 
+        steps = [(date_idx[start], lons[start:end], lats[start:end], vorts[start:end])
+                 for start, end in zip(step_starts, step_ends)]
+        links = self.link_steps(steps)
+        return chain_links(step_ends - step_starts, links)
 
     def track(self, df):
-        all_vortmax_time_series = []
-        for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
-            vortmax_time_series = OrderedDict()
-            all_vortmax_time_series.append(vortmax_time_series)
-            for i in df[df.em == ensemble_member].index:
-                row = df.loc[i]
-                if row.date not in vortmax_time_series:
-                    vortmax_time_series[row.date] = []
-                vortmax = VortMax(row.date, (row.lon, row.lat), row.vort)
-                vortmax_time_series[vortmax.date].append(vortmax)
-        print('Made objects')
-        return self.track_vort_maxima(all_vortmax_time_series)
+        '''Tracks the vortmaxes in the output of VortmaxFinder.find_vort_maxima
+
+        :param df: all_fields DataFrame (must have em, date, lon, lat and vort850 columns)
+        :returns: TrackStore of all tracks with at least MIN_TRACK_LENGTH vortmaxes, the row
+            column holds the index of each vortmax in df
+        '''
+        stores = []
+        for columns in self._member_inputs(df):
+            log.info('Tracking vortmaxima: {0}'.format(columns['em'][0]))
+            stores.append(self._track_columns(columns))
+        self.track_store = TrackStore.concat(stores)
+        return self.track_store
+
+    def _member_inputs(self, df):
+        '''Splits an all_fields DataFrame into the columns of each ensemble member
+
+        Rows are sorted by em then date, keeping the order of df within each date.
 
+        :returns: list of dicts of column name to array, one per ensemble member in df
+        '''
+        if len(df) == 0:
+            return []
+        ems = df.em.values
+        dates = df.date.values.astype('datetime64[ns]')
+        order = np.lexsort((dates, ems))
+
+        ems = ems[order]
+        dates = dates[order]
+        date_idx = ((dates - dates.min()) // np.timedelta64(6, 'h')).astype(np.int32)
+        columns = {'em': ems.astype(np.int8),
+                   'date': dates,
+                   'date_idx': date_idx,
+                   'lon': df.lon.values[order].astype(np.float32),
+                   'lat': df.lat.values[order].astype(np.float32),
+                   'vort': df.vort850.values[order].astype(np.float32),
+                   'row': df.index.values[order].astype(np.int64)}
+
+        em_starts = np.r_[0, np.where(np.diff(ems))[0] + 1]
+        em_ends = np.r_[em_starts[1:], len(ems)]
+        return [dict((name, values[start:end]) for name, values in columns.items())
+                for start, end in zip(em_starts, em_ends)]
+
+    def _track_columns(self, columns):
+        '''Tracks the vortmaxes of one ensemble member given as columns (sorted by date_idx)'''
+        track_ids = self.track_member(columns['date_idx'], columns['lon'],
+                                      columns['lat'], columns['vort'])
+        return TrackStore.from_track_ids(columns, track_ids)
 
     def track_vort_maxima(self, all_vortmax_time_series):
         '''Uses a generated list of vortmaxes to track them from one timestep to another
 
-        :param vortmax_time_series: dict of vortmaxes
-        :returns: self.vort_tracks_by_date (OrderedDict)
+        :param all_vortmax_time_series: list (one per ensemble member) of dicts of vortmaxes,
+            keyed by consecutive dates (e.g. VortmaxFinder.all_vortmax_time_series)
+        :returns: TrackStore of all tracks with at least MIN_TRACK_LENGTH vortmaxes
         '''
+        stores = []
         for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
             log.info('Tracking vortmaxima: {0}'.format(ensemble_member))
             vortmax_time_series = all_vortmax_time_series[ensemble_member]
-            # Loops over 2 lists of vortmaxes
-            for vs1, vs2 in pairwise(vortmax_time_series.values()):
-                for v1 in vs1:
-                    min_dist = self.dist_cutoff
-                    v2next = None
-
-                    # Find the nearest vortmax in the next timestep.
-                    for v2 in vs2:
-                        d = self.dist(v1.pos, v2.pos)
-                        if d < min_dist:
-                            min_dist = d
-                            v2next = v2
-
-                    # Add the nearest vortmax in the next timestep.
-                    if v2next:
-                        v1.add_next(v2next)
-                        if len(v1.next_vortmax) != 1:
-                            raise Exception('There should only ever be one next_vortmax')
-
-            # Some vortmaxes may have more than one previous vortmax.
-            # Find these and choose the nearest one as the actual previous.
-            for vs in vortmax_time_series.values():
-                for v in vs:
-                    if len(v.prev_vortmax) > 1:
-                        min_dist = self.dist_cutoff
-                        vprev = None
-                        for pv in v.prev_vortmax:
-                            d = self.dist(pv.pos, v.pos)
-                            if d < min_dist:
-                                min_dist = d
-                                vprev = pv
-
-                        for pv in v.prev_vortmax:
-                            if pv != vprev:
-                                pv.next_vortmax.remove(v)
-
-                        v.prev_vortmax = [vprev]
-
-        return self._construct_vortmax_tracks_by_date(all_vortmax_time_series)
+            vortmaxes = [(date_idx, vortmax)
+                         for date_idx, date_vortmaxes in enumerate(vortmax_time_series.values())
+                         for vortmax in date_vortmaxes]
+            columns = {'em': np.ones(len(vortmaxes), dtype=np.int8) * ensemble_member,
+                       'date': np.array([v.date for i, v in vortmaxes], dtype='datetime64[ns]'),
+                       'date_idx': np.array([i for i, v in vortmaxes], dtype=np.int32),
+                       'lon': np.array([v.pos[0] for i, v in vortmaxes], dtype=np.float32),
+                       'lat': np.array([v.pos[1] for i, v in vortmaxes], dtype=np.float32),
+                       'vort': np.array([v.vort for i, v in vortmaxes], dtype=np.float32),
+                       'row': -np.ones(len(vortmaxes), dtype=np.int64)}
+            stores.append(self._track_columns(columns))
+
+        self.track_store = TrackStore.concat(stores)
+        return self.track_store
+
+
+class VortmaxAssignmentTracker(VortmaxNearestNeighbourTracker):
+    '''Tracker that links the vortmaxes in each pair of timesteps by optimal assignment
+
+    Unlike the nearest neighbour tracker, one vortmax can't take another's link just because
+    it was considered first: the links of each pair of timesteps are chosen together to
+    minimise the total cost. The cost of a link is its distance (as a fraction of
+    dist_cutoff) plus vort_weight times the relative change in vorticity. Vortmaxes further
+    apart than dist_cutoff are never linked, and are not considered at all thanks to a
+    spatial index.
+
+    :param vort_weight: weight of vorticity change relative to distance
+    '''
+    def __init__(self, vort_weight=0.5):
+        super(VortmaxAssignmentTracker, self).__init__()
+        self.vort_weight = vort_weight
 
+    def candidate_pairs(self, lons1, lats1, lons2, lats2):
+        '''Finds all pairs of vortmaxes from two timesteps that are within dist_cutoff
 
-class FieldFinder(object):
-    def __init__(self, c20data, all_vort_tracks_by_date):
-        self.c20data = c20data
-        self.all_vort_tracks_by_date = all_vort_tracks_by_date
-        self.all_cyclone_tracks = []
-        for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
-            self.all_cyclone_tracks.append({})
-
-    def collect_fields(self, start_date, end_date):
-        # import ipdb; ipdb.set_trace()
-        index = np.where(self.c20data.dates == start_date)[0][0]
-        end_index = np.where(self.c20data.dates == end_date)[0][0]
-
-        while index <= end_index:
-            date = self.c20data.dates[index]
-            log.info('Collecting fields for: {0}'.format(date))
-            self.c20data.set_date(date)
-            for ensemble_member in range(NUM_ENSEMBLE_MEMBERS):
-                cyclone_tracks = self.all_cyclone_tracks[ensemble_member]
-
-                if date not in self.all_vort_tracks_by_date[ensemble_member]:
-                    continue
-
-                vort_tracks = self.all_vort_tracks_by_date[ensemble_member][date]
-                for vort_track in vort_tracks:
-                    cyclone_track = None
-                    if vort_track not in cyclone_tracks:
-                        if len(vort_track.vortmaxes) >= 6:
-                            cyclone_track = CycloneTrack(vort_track, ensemble_member)
-                            cyclone_tracks[vort_track] = cyclone_track
-                    else:
-                        cyclone_track = cyclone_tracks[vort_track]
-
-                    if cyclone_track:
-                        self.add_fields_to_track(date, cyclone_track, ensemble_member)
-            index += 1
-
-    def add_fields_to_track(self, date, cyclone_track, ensemble_member):
-        actual_vmax_pos = cyclone_track.get_vmax_pos(date)
-        # Round values to the nearest multiple of 2 (vmax_pos can come from an interpolated field)
-        vmax_pos = tuple([int(round(p / 2.)) * 2 for p in actual_vmax_pos])
-        lon_index = np.where(self.c20data.lons == vmax_pos[0])[0][0]
-        lat_index = np.where(self.c20data.lats == vmax_pos[1])[0][0]
-
-        min_lon, max_lon = lon_index - 5, lon_index + 6
-        min_lat, max_lat = lat_index - 5, lat_index + 6
-        local_slice = (slice(min_lat, max_lat), slice(min_lon, max_lon))
-
-        local_prmsl = self.c20data.prmsl[ensemble_member][local_slice].copy()
-
-	# 9950 pressure level.
-        local_windspeed = np.sqrt(self.c20data.u9950[ensemble_member][local_slice] ** 2 +
-                                  self.c20data.v9950[ensemble_member][local_slice] ** 2)
-        max_windspeed_pos = np.unravel_index(np.argmax(local_windspeed), (11, 11))
-        max_windspeed = local_windspeed[max_windspeed_pos]
-
-        lon = self.c20data.lons[min_lon + max_windspeed_pos[1]]
-        lat = self.c20data.lats[min_lat + max_windspeed_pos[0]]
-
-        cyclone_track.max_windspeeds[date] = max_windspeed
-        cyclone_track.max_windspeed_positions[date] = (lon, lat)
-
-        e, index_pmaxs, index_pmins = find_extrema(local_prmsl)
-        min_dist = 1000
-        pmin = None
-        pmin_pos = None
-        for index_pmin in index_pmins:
-            lon = self.c20data.lons[min_lon + index_pmin[1]]
-            lat = self.c20data.lats[min_lat + index_pmin[0]]
-
-            local_pmin = local_prmsl[index_pmin[0], index_pmin[1]]
-            local_pmin_pos = (lon, lat)
-            dist = geo_dist(actual_vmax_pos, local_pmin_pos)
-            if dist < min_dist:
-                min_dist = dist
-                pmin = local_pmin
-                pmin_pos = local_pmin_pos
-
-        cyclone_track.min_dists[date] = min_dist
-        cyclone_track.pmins[date] = pmin
-        cyclone_track.pmin_positions[date] = pmin_pos
-
-        if pmin:
-            cyclone_track.p_ambient_diffs[date] = local_prmsl.mean() - pmin
+        :returns: index arrays of the pairs in each timestep, and array of their distances
+        '''
+        if self.use_geo_dist:
+            points1, points2 = lonlat_to_xyz(lons1, lats1), lonlat_to_xyz(lons2, lats2)
+            max_dist = geo_dist_to_chord(self.dist_cutoff)
         else:
-            cyclone_track.p_ambient_diffs[date] = None
+            points1, points2 = np.column_stack([lons1, lats1]), np.column_stack([lons2, lats2])
+            max_dist = self.dist_cutoff
 
-        cyclone_track.t850s[date] = self.c20data.t850[ensemble_member][lat_index, lon_index]
-        cyclone_track.t995s[date] = self.c20data.t995[ensemble_member][lat_index, lon_index]
-        cyclone_track.capes[date] = self.c20data.cape[ensemble_member][lat_index, lon_index]
-        cyclone_track.pwats[date] = self.c20data.pwat[ensemble_member][lat_index, lon_index]
-        # No longer using due to it not having much
-        # discriminatory power and space constraints.
-        cyclone_track.rh995s[date] = 0
+        pairs = cKDTree(points1).sparse_distance_matrix(cKDTree(points2), max_dist,
+                                                        output_type='ndarray')
+        dists = pairs['v']
+        if self.use_geo_dist:
+            dists = chord_to_geo_dist(dists)
+        is_close = dists < self.dist_cutoff
+        return pairs['i'][is_close], pairs['j'][is_close], dists[is_close]
+
+    def link(self, lons1, lats1, vorts1, lons2, lats2, vorts2):
+        '''Links the vortmaxes in one timestep to those in the next
+
+        :returns: int array with the index in the next timestep of each vortmax, or -1
+        '''
+        if len(lons1) == 0 or len(lons2) == 0:
+            return -np.ones(len(lons1), dtype=np.int32)
+
+        idx1, idx2, dists = self.candidate_pairs(lons1, lats1, lons2, lats2)
+        vorts1 = np.abs(np.asarray(vorts1, dtype=np.float64))[idx1]
+        vorts2 = np.abs(np.asarray(vorts2, dtype=np.float64))[idx2]
+        vort_change = np.abs(vorts2 - vorts1) / np.maximum(np.maximum(vorts1, vorts2), 1e-12)
+
+        costs = dists / self.dist_cutoff + self.vort_weight * vort_change
+        return link_min_cost(idx1, idx2, costs, len(lons1))
+
+
+class VortmaxKalmanFilterTracker(VortmaxNearestNeighbourTracker):
+    '''Tracker that links vortmaxes to where their track is predicted to be next
+
+    Each track has a constant velocity Kalman filter state (lon, lat, lon speed, lat speed),
+    in degrees and degrees per timestep. At each timestep the positions of all tracks are
+    predicted, vortmaxes in the next timestep that are outside the gate of a prediction
+    (by Mahalanobis distance) or further than dist_cutoff from it are ruled out, the rest
+    are linked to the nearest predictions, and the linked tracks' states are updated. The
+    states of all the tracks are held in stacked arrays so that each of these is one
+    NumPy operation per timestep. New tracks start with no velocity.
+
+    :param process_noise: variance of the change in speed per timestep
+    :param measurement_noise: variance of vortmax positions (they are on a 2 degree grid)
+    :param initial_speed_var: variance of the speed of new tracks
+    :param gate: maximum squared Mahalanobis distance of a vortmax from a prediction
+        (9.21 keeps 99% of vortmaxes that follow the model)
+    '''
+    def __init__(self, process_noise=0.5, measurement_noise=1., initial_speed_var=9.,
+                 gate=9.21):
+        super(VortmaxKalmanFilterTracker, self).__init__()
+        self.gate = gate
+
+        self.F = np.eye(4)
+        self.F[0, 2] = self.F[1, 3] = 1
+        self.Q = process_noise * np.array([[0.25, 0, 0.5, 0],
+                                           [0, 0.25, 0, 0.5],
+                                           [0.5, 0, 1, 0],
+                                           [0, 0.5, 0, 1]])
+        self.R = measurement_noise * np.eye(2)
+        self.P0 = np.diag([measurement_noise, measurement_noise,
+                           initial_speed_var, initial_speed_var])
+
+    def init_states(self, lons, lats):
+        '''Returns the states and covariances of new tracks starting at lons, lats'''
+        num_points = len(lons)
+        X = np.zeros((num_points, 4))
+        X[:, 0] = lons
+        X[:, 1] = lats
+        P = np.tile(self.P0, (num_points, 1, 1))
+        return X, P
+
+    def predict(self, X, P):
+        '''Predicts the states and covariances of all tracks at the next timestep'''
+        X = X.dot(self.F.T)
+        P = np.einsum('ij,njk,lk->nil', self.F, P, self.F) + self.Q
+        return X, P
+
+    def associate(self, X, P, lons, lats):
+        '''Links predicted states to the vortmaxes in the next timestep
+
+        :returns: link array and inverse innovation covariances of the predictions
+        '''
+        S_inv = np.linalg.inv(P[:, :2, :2] + self.R)
+        z = np.column_stack([lons, lats])
+        innovations = z[None, :, :] - X[:, None, :2]
+        mahalanobis_sq = np.einsum('abi,aij,abj->ab', innovations, S_inv, innovations)
 
+        dists = self.dist_matrix(X[:, 0], X[:, 1], np.asarray(lons), np.asarray(lats))
+        dists[mahalanobis_sq > self.gate] = np.inf
+        return link_nearest_neighbours(dists, self.dist_cutoff), S_inv
 
+    def update(self, X, P, S_inv, links, lons, lats):
+        '''Returns the states of the vortmaxes in the next timestep
 
+        Linked vortmaxes get their track's predicted state updated with their position,
+        others start new tracks.
+        '''
+        X_next, P_next = self.init_states(lons, lats)
+        track_idx = np.where(links >= 0)[0]
+        point_idx = links[track_idx]
+        if len(track_idx) == 0:
+            return X_next, P_next
+
+        X, P, S_inv = X[track_idx], P[track_idx], S_inv[track_idx]
+        z = np.column_stack([lons, lats])[point_idx]
+        # H selects the position, so P H^T = P[:, :, :2] and H P = P[:, :2, :].
+        K = np.einsum('nik,nkj->nij', P[:, :, :2], S_inv)
+        X_next[point_idx] = X + np.einsum('nij,nj->ni', K, z - X[:, :2])
+        P_next[point_idx] = P - np.einsum('nik,nkj->nij', K, P[:, :2, :])
+        return X_next, P_next
+
+    def link_steps(self, steps):
+        '''Links the vortmaxes in each consecutive pair of timesteps
+
+        Timesteps that are not adjacent (i.e. there is a gap between them) are not linked.
+
+        :param steps: list of (date_idx, lons, lats, vorts), one entry per timestep
+        :returns: list of link arrays, one for each pair of timesteps
+        '''
+        all_links = []
+        if not steps:
+            return all_links
+
+        X, P = self.init_states(steps[0][1], steps[0][2])
+        for step1, step2 in pairwise(steps):
+            date_idx1, lons1 = step1[:2]
+            date_idx2, lons2, lats2 = step2[:3]
+            if date_idx2 == date_idx1 + 1 and len(lons1) and len(lons2):
+                X, P = self.predict(X, P)
+                links, S_inv = self.associate(X, P, lons2, lats2)
+                X, P = self.update(X, P, S_inv, links, lons2, lats2)
+            else:
+                links = -np.ones(len(lons1), dtype=np.int32)
+                X, P = self.init_states(lons2, lats2)
+            all_links.append(links)
+        return all_links
+
+
+class OnlineVortmaxTracker(object):
+    '''Tracks vortmaxes incrementally, one timestep at a time
+
+    Only the open tracks (those that have a vortmax in the last timestep) are kept in memory.
+    A track that is not extended in a timestep is finished, and is emitted (if it has at
+    least min_length vortmaxes) by the add_step call that finished it, so the same tracks as
+    tracker.track(df) come out as a stream while the season is still being processed.
+
+    :param tracker: tracker whose link method is used to link timesteps, defaults to a
+        VortmaxNearestNeighbourTracker
+    :param min_length: finished tracks with fewer vortmaxes are discarded
+    '''
+    def __init__(self, tracker=None, min_length=MIN_TRACK_LENGTH):
+        if tracker is None:
+            tracker = VortmaxNearestNeighbourTracker()
+        self.tracker = tracker
+        self.min_length = min_length
+        self.start_date = None
+        # Per ensemble member: (date_idx, columns, track keys) of the last timestep.
+        self.frontiers = {}
+        # Points of each open track, keyed by track key (keys increase with start date).
+        self.open_tracks = {}
+        self._next_key = 0
+
+    def add_step(self, df):
+        '''Adds the vortmaxes of one timestep
+
+        :param df: all_fields rows for one date (any ensemble members)
+        :returns: TrackStore of the tracks that were finished by this timestep
+        '''
+        if len(df) == 0:
+            return self._emit([])
+        date = df.date.values[0].astype('datetime64[ns]')
+        if self.start_date is None:
+            self.start_date = date
+        date_idx = int((date - self.start_date) // np.timedelta64(6, 'h'))
+
+        finished_keys = []
+        stepped_ems = set()
+        for columns in self.tracker._member_inputs(df):
+            columns['date_idx'] += date_idx
+            em = columns['em'][0]
+            stepped_ems.add(em)
+            finished_keys.extend(self._add_member_step(em, date_idx, columns))
+
+        for em in list(self.frontiers):
+            if em not in stepped_ems:
+                finished_keys.extend(self.frontiers.pop(em)[2])
+        return self._emit(finished_keys)
+
+    def flush(self):
+        '''Finishes all open tracks
+
+        :returns: TrackStore of the tracks that were still open
+        '''
+        finished_keys = []
+        for em in list(self.frontiers):
+            finished_keys.extend(self.frontiers.pop(em)[2])
+        return self._emit(finished_keys)
+
+    def track_stream(self, step_dfs):
+        '''Generator of finished tracks
+
+        :param step_dfs: iterable of all_fields DataFrames, one per date in date order
+        :returns: yields a TrackStore each time any tracks are finished
+        '''
+        for df in step_dfs:
+            finished = self.add_step(df)
+            if len(finished):
+                yield finished
+        finished = self.flush()
+        if len(finished):
+            yield finished
+
+    def _add_member_step(self, em, date_idx, columns):
+        num_points = len(columns['lon'])
+        links = -np.ones(0, dtype=np.int32)
+        prev_keys = []
+        if em in self.frontiers:
+            prev_date_idx, prev_columns, prev_keys = self.frontiers[em]
+            if prev_date_idx == date_idx - 1:
+                links = self.tracker.link(prev_columns['lon'], prev_columns['lat'],
+                                          prev_columns['vort'], columns['lon'],
+                                          columns['lat'], columns['vort'])
+            else:
+                links = -np.ones(len(prev_keys), dtype=np.int32)
+
+        keys = [None] * num_points
+        finished_keys = []
+        for prev_key, link in zip(prev_keys, links):
+            if link >= 0:
+                keys[link] = prev_key
+            else:
+                finished_keys.append(prev_key)
+
+        for i in range(num_points):
+            if keys[i] is None:
+                keys[i] = self._next_key
+                self.open_tracks[self._next_key] = []
+                self._next_key += 1
+            self.open_tracks[keys[i]].append(tuple(columns[name][i]
+                                                   for name in TRACK_COLUMNS[1:]))
+
+        self.frontiers[em] = (date_idx, columns, keys)
+        return finished_keys
+
+    def _emit(self, finished_keys):
+        points = []
+        track_ids = []
+        for track_id, key in enumerate(sorted(finished_keys)):
+            track_points = self.open_tracks.pop(key)
+            points.extend(track_points)
+            track_ids.extend([track_id] * len(track_points))
+
+        columns = {}
+        for i, name in enumerate(TRACK_COLUMNS[1:]):
+            columns[name] = np.array([point[i] for point in points])
+        if not points:
+            columns['date'] = columns['date'].astype('datetime64[ns]')
+        return TrackStore.from_track_ids(columns, track_ids, self.min_length)
+
+
+class FieldFinder(object):
+    '''Collects fields from C20 data along each point of each track
+
+    :param c20data: C20Data to take fields from
+    :param track_store: TrackStore of tracks, fields are added to it as new columns
+    '''
+    def __init__(self, c20data, track_store):
+        self.c20data = c20data
+        self.track_store = track_store
+        num_points = len(track_store.points)
+        self.fields = OrderedDict((name, np.zeros(num_points, dtype=np.float32) * np.nan)
+                                  for name in TRACK_FIELD_COLUMNS)
+
+    def collect_fields(self, start_date, end_date):
+        date_index = TrackDateIndex(self.track_store, self.c20data.lons, self.c20data.lats)
+        start_date, end_date = np.datetime64(start_date), np.datetime64(end_date)
+
+        progress = ProgressReporter(log, 'Collecting fields', len(date_index))
+        for step_index, date in enumerate(date_index.dates):
+            if not start_date <= date <= end_date:
+                continue
+            self.c20data.set_date(pd.Timestamp(date).to_pydatetime())
+            point_index, rows = date_index.step(step_index)
+            self.add_fields_to_points(point_index, rows)
+            progress.update(rows=len(point_index), current=date)
+        progress.finish()
+
+        self.track_store.add_columns(self.fields)
+        return self.track_store
+
+    def add_fields_to_points(self, point_index, rows):
+        '''Collects the fields for all track points at the current date
+
+        Fields are gathered from an 11x11 window around each point, for all points at once.
+        Windows wrap around in longitude (the grid is global) and are truncated in latitude:
+        window cells beyond the poles are masked out, and the first and last grid rows are
+        treated as the edge of the window when looking for pressure minima.
+
+        :param point_index: indices of the points in the TrackStore
+        :param rows: TrackDateIndex rows (em, lon_idx, lat_idx, track_id) of the points
+        '''
+        c20data = self.c20data
+        num_lats, num_lons = len(c20data.lats), len(c20data.lons)
+        ems, lon_index, lat_index = rows[:, 0], rows[:, 1], rows[:, 2]
+        actual_lons = self.track_store.column('lon')[point_index]
+        actual_lats = self.track_store.column('lat')[point_index]
+        all_points = np.arange(len(rows))
+
+        offsets = np.arange(-5, 6)
+        window_lat_index = lat_index[:, None] + offsets
+        window_lon_index = (lon_index[:, None] + offsets) % num_lons
+        lat_is_valid = (window_lat_index >= 0) & (window_lat_index < num_lats)
+        window_lat_index = np.clip(window_lat_index, 0, num_lats - 1)
+        window_lats = window_lat_index[:, :, None]
+        window_lons = window_lon_index[:, None, :]
+        is_valid = np.repeat(lat_is_valid[:, :, None], 11, axis=2)
+        window = (ems[:, None, None], window_lats, window_lons)
+        centre = (ems, lat_index, lon_index)
+
+        local_prmsl = np.where(is_valid, c20data.prmsl[window], np.nan)
+
+        # 9950 pressure level.
+        local_windspeed = np.sqrt(c20data.u9950[window] ** 2 + c20data.v9950[window] ** 2)
+        local_windspeed = np.where(is_valid, local_windspeed, -np.inf)
+        max_windspeed_pos = local_windspeed.reshape(len(rows), -1).argmax(axis=1)
+        max_ws_lat, max_ws_lon = np.unravel_index(max_windspeed_pos, (11, 11))
+
+        fields = self.fields
+        fields['max_ws'][point_index] = local_windspeed.reshape(len(rows), -1)[
+            all_points, max_windspeed_pos]
+        fields['max_ws_lon'][point_index] = c20data.lons[window_lon_index[all_points, max_ws_lon]]
+        fields['max_ws_lat'][point_index] = c20data.lats[window_lat_index[all_points, max_ws_lat]]
+
+        # Pressure minima inside the window (not on its edge), as found by find_extrema.
+        # Masked cells only border the first/last grid rows, which can't be minima anyway.
+        is_min = minimum_filter(np.where(is_valid, local_prmsl, np.inf),
+                                size=(1, 3, 3)) == local_prmsl
+        is_min[:, [0, -1], :] = False
+        is_min[:, :, [0, -1]] = False
+        is_min &= ((window_lats > 0) & (window_lats < num_lats - 1))
+        # Distances in float64, as geo_dist gives for individual points.
+        lons, lats = c20data.lons.astype(np.float64), c20data.lats.astype(np.float64)
+        pmin_dists = geo_dist((actual_lons[:, None, None].astype(np.float64),
+                               actual_lats[:, None, None].astype(np.float64)),
+                              (lons[window_lons], lats[window_lats]))
+        pmin_dists[~is_min | np.isnan(pmin_dists)] = np.inf
+
+        # argmin takes the first of equally near minima, in the order find_extrema gives them.
+        nearest = pmin_dists.reshape(len(rows), -1).argmin(axis=1)
+        min_dists = pmin_dists.reshape(len(rows), -1)[all_points, nearest]
+        has_pmin = min_dists < 1000
+        fields['pmin_dist'][point_index] = np.where(has_pmin, min_dists, 1000)
+
+        pmin_lat, pmin_lon = np.unravel_index(nearest[has_pmin], (11, 11))
+        pmin_rows = all_points[has_pmin]
+        pmin = local_prmsl[pmin_rows, pmin_lat, pmin_lon]
+        pmin_points = point_index[has_pmin]
+        fields['pmin'][pmin_points] = pmin
+        fields['pmin_lon'][pmin_points] = c20data.lons[window_lon_index[pmin_rows, pmin_lon]]
+        fields['pmin_lat'][pmin_points] = c20data.lats[window_lat_index[pmin_rows, pmin_lat]]
+        # Mean in float64, so that it doesn't depend on how many cells are masked out.
+        ambient_prmsl = np.nanmean(local_prmsl[has_pmin], axis=(1, 2), dtype=np.float64)
+        fields['p_ambient_diff'][pmin_points] = ambient_prmsl - pmin
+
+        fields['t850'][point_index] = c20data.t850[centre]
+        fields['t9950'][point_index] = c20data.t9950[centre]
+        fields['cape'][point_index] = c20data.cape[centre]
+        fields['pwat'][point_index] = c20data.pwat[centre]
+        # No longer collecting rh995 due to it not having much
+        # discriminatory power and space constraints.
@@ -5,6 +5,7 @@ import pandas as pd
 
 from load_settings import settings
 from utils.utils import compress_file, decompress_file
+from processing.schema import RESULT_SCHEMAS, apply_schema
 
 RESULTS_TPL = '{0}.hdf'
 
@@ -36,6 +37,9 @@ class StormtracksResultsManager(object):
 	filename = RESULTS_TPL.format(year)
 	print('saving {0}'.format(filename))
 	path = os.path.join(dirname, filename)
+	if result_key in RESULT_SCHEMAS:
+	    # apply_schema casts in place, so leave the caller's DataFrame alone.
+	    result = apply_schema(result.copy(), RESULT_SCHEMAS[result_key])
 	result.to_hdf(path, result_key)
 
     def get_result(self, year, result_key):
@@ -49,8 +53,21 @@ class StormtracksResultsManager(object):
 	except Exception, e:
 	    raise ResultNotFound
 
+	if result_key in RESULT_SCHEMAS:
+	    result = apply_schema(result, RESULT_SCHEMAS[result_key])
         return result
 
+    def has_result(self, year, result_key):
+        '''Returns whether a result has been saved, without loading it'''
+	path = os.path.join(self.output_dir, self.name, RESULTS_TPL.format(year))
+	if not os.path.exists(path):
+	    return False
+
+	store = pd.HDFStore(path, mode='r')
+	try:
+	    return '/' + result_key in store.keys()
+	finally:
+	    store.close()
 
     def delete(self, year, result_key):
         '''Deletes a specific result from disk'''
@@ -0,0 +1,69 @@
+import time
+import logging
+
+
+class ProgressReporter(object):
+    '''Aggregates the throughput of a long running loop and logs it at a fixed interval
+
+    Call update once per step of the loop: it only does some additions unless it is time
+    to report, and does nothing at all if the logger is not enabled for level. This makes
+    it cheap enough to use in place of per step print/log calls in hot loops.
+
+    :param log: logger to report to
+    :param name: what is being done, e.g. 'Finding vortmaxima'
+    :param total_steps: total number of steps, if known
+    :param interval: minimum number of seconds between reports
+    :param level: logging level to report at
+    '''
+    def __init__(self, log, name, total_steps=None, interval=10., level=logging.INFO):
+        self.log = log
+        self.name = name
+        self.total_steps = total_steps
+        self.interval = interval
+        self.level = level
+        self.enabled = log.isEnabledFor(level)
+
+        self.steps = 0
+        self.rows = 0
+        self.nbytes = 0
+        self.start = time.time()
+        self._last_report = self.start
+
+    def update(self, steps=1, rows=0, nbytes=0, current=None):
+        '''Records progress, and reports it if interval seconds have passed since last report
+
+        :param steps: number of steps completed
+        :param rows: number of rows (e.g. vortmaxes) produced
+        :param nbytes: number of bytes read
+        :param current: optional description of the current step (e.g. its date)
+        '''
+        self.steps += steps
+        self.rows += rows
+        self.nbytes += nbytes
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._report(now, current)
+            self._last_report = now
+
+    def finish(self):
+        '''Reports the final totals'''
+        if self.enabled:
+            self._report(time.time(), 'done')
+
+    def _report(self, now, current):
+        elapsed = max(now - self.start, 1e-9)
+        if self.total_steps:
+            steps = '{}/{} steps ({:.0f}%)'.format(self.steps, self.total_steps,
+                                                   100. * self.steps / self.total_steps)
+        else:
+            steps = '{} steps'.format(self.steps)
+
+        message = '{}: {} in {:.1f}s, {:.2f} steps/s, {:.1f} rows/s, {:.2f} MB/s'.format(
+            self.name, steps, elapsed, self.steps / elapsed, self.rows / elapsed,
+            self.nbytes / elapsed / 1e6)
+        if current is not None:
+            message += ' [{}]'.format(current)
+        self.log.log(self.level, message)
@@ -152,6 +152,63 @@ def dist(p1, p2):
     return ((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2) ** 0.5
 
 
+def geo_dist_matrix(lons1, lats1, lons2, lats2):
+    '''Returns the geodesic distances between every pair of points from two sets
+
+    lons/lats should be 1D arrays in degrees. Unlike geo_dist, coincident points are
+    0 apart rather than nan (rounding can otherwise take the arccos argument above 1).
+
+    :returns: (len(lons1), len(lons2)) array of distances in km
+    '''
+    lons1, lats1, lons2, lats2 = [np.radians(np.asarray(a, dtype=np.float64))
+                                  for a in (lons1, lats1, lons2, lats2)]
+    lons1, lats1 = lons1[:, None], lats1[:, None]
+    lons2, lats2 = lons2[None, :], lats2[None, :]
+    cos_angle = (np.sin(lats1) * np.sin(lats2) +
+                 np.cos(lats1) * np.cos(lats2) * np.cos(lons2 - lons1))
+    return np.arccos(np.clip(cos_angle, -1, 1)) * EARTH_RADIUS
+
+
+def dist_matrix(xs1, ys1, xs2, ys2):
+    '''Returns the cartesian distances between every pair of points from two sets'''
+    return np.hypot(xs1[:, None] - xs2[None, :], ys1[:, None] - ys2[None, :])
+
+
+def lonlat_to_xyz(lons, lats):
+    '''Returns the cartesian coordinates (in km) of points on the earth's surface
+
+    Straight line (chord) distances between these are monotonic in geodesic distance, so
+    they can be put into a spatial index such as scipy's cKDTree.
+
+    :returns: (len(lons), 3) array
+    '''
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    return EARTH_RADIUS * np.column_stack([np.cos(lats) * np.cos(lons),
+                                           np.cos(lats) * np.sin(lons),
+                                           np.sin(lats)])
+
+
+def xyz_to_lonlat(xyz):
+    '''Inverse of lonlat_to_xyz, points need not be on the surface (e.g. means of points)
+
+    :returns: lons (0 to 360) and lats in degrees
+    '''
+    lons = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+    lats = np.degrees(np.arctan2(xyz[:, 2], np.hypot(xyz[:, 0], xyz[:, 1])))
+    return lons, lats
+
+
+def geo_dist_to_chord(dist):
+    '''Converts a geodesic distance (km) to the chord distance between points lonlat_to_xyz'''
+    return 2 * EARTH_RADIUS * np.sin(np.minimum(dist / (2. * EARTH_RADIUS), np.pi / 2))
+
+
+def chord_to_geo_dist(chord):
+    '''Converts a chord distance between points from lonlat_to_xyz to a geodesic distance'''
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / (2. * EARTH_RADIUS), 0, 1))
+
+
 def raster_voronoi(extrema, maximums, minimums):
     '''
     Takes a 2D array and points of max/mins, and returns a 2D array
@@ -0,0 +1,266 @@
+import sys
+sys.path.insert(0, '..')
+
+import datetime as dt
+from multiprocessing import Pool
+from tempfile import mkdtemp
+import shutil
+
+import numpy as np
+import pandas as pd
+from nose.plugins.skip import SkipTest
+
+from stormtracks.c20data import C20Data, SharedFieldCubes, SharedC20Data, EARTH_CIRC
+from stormtracks.processing.find_vortmax import VortmaxFinder
+from stormtracks.processing.matching import simple_matching
+import stormtracks.processing.parallel as parallel
+from stormtracks.processing.parallel import (_match_members, _merge_partitions,
+                                             match_years_sharded, track_member_sharded,
+                                             find_vort_maxima_member_sharded,
+                                             shard_date_range, find_vort_maxima_date_sharded)
+from stormtracks.processing.tracking import (VortmaxNearestNeighbourTracker,
+                                             VortmaxAssignmentTracker,
+                                             VortmaxKalmanFilterTracker)
+from stormtracks.results import StormtracksResultsManager
+
+
+class FakeC20Data(C20Data):
+    '''C20Data with random fields on the 20CR grid, instead of fields from NetCDF4 files'''
+    def _load_datasets(self, year):
+        self.nc_datasets = {}
+        self.lons = np.arange(0, 360, 2).astype(np.float32)
+        self.lats = np.arange(90, -92, -2).astype(np.float32)
+        self.dates = np.array([dt.datetime(year, 6, 1) + dt.timedelta(hours=6 * i)
+                               for i in range(8)])
+        self.dx = (4 * np.cos(self.lats * np.pi / 180) * EARTH_CIRC / 360.).astype(np.float32)
+        self.dy = 4 * EARTH_CIRC / 360.
+
+    def _load_ensemble_data(self, index):
+        rs = np.random.RandomState(index)
+        for field in self.fields:
+            scale, offset = {'prmsl': (500., 101325.)}.get(field, (10., 0.))
+            setattr(self, field, (offset + scale * rs.randn(56, 91, 180)).astype(np.float32))
+
+
+# Set in each worker process by _init_cube_worker.
+_worker_cubes = None
+
+
+def _init_cube_worker(cubes):
+    global _worker_cubes
+    _worker_cubes = cubes
+
+
+def _read_cube(args):
+    slot, field = args
+    return _worker_cubes.cube(slot, field).copy()
+
+
+class FakeBestTrack(object):
+    def __init__(self, name, dates, lons, lats, winds, cls):
+        self.name = name
+        self.dates = np.array(dates)
+        self.lons = np.array(lons)
+        self.lats = np.array(lats)
+        self.winds = np.array(winds)
+        self.cls = cls
+
+
+class FakeIbtracsData(object):
+    def __init__(self, best_tracks):
+        self.best_tracks = best_tracks
+        self.dates = {}
+
+    def load_ibtracks_year(self, year, dates=None):
+        self.dates[year] = dates
+        return self.best_tracks
+
+
+def create_year(seed=0):
+    '''Random vortmaxes for 4 ensemble members (spread over the member shards) and best
+    tracks that cross them'''
+    rs = np.random.RandomState(seed)
+    dates = [dt.datetime(2005, 6, 1) + dt.timedelta(hours=6 * i) for i in range(8)]
+    ems = np.array([0, 20, 40, 41], dtype=np.int8)
+    num_points = 5 * len(dates) * len(ems)
+    df = pd.DataFrame({'date': np.repeat(dates, 5 * len(ems)),
+                       'em': np.tile(np.repeat(ems, 5), len(dates)),
+                       'lon': rs.uniform(280., 320., num_points),
+                       'lat': rs.uniform(10., 40., num_points)},
+                      index=np.arange(100, 100 + num_points))
+    best_tracks = [FakeBestTrack('bt{}'.format(i), dates[i:i + 5],
+                                 rs.uniform(280., 320., 5), rs.uniform(10., 40., 5),
+                                 rs.uniform(30., 120., 5), ['TS', 'TS', 'HU', 'HU', 'TS'])
+                   for i in range(3)]
+    return df, best_tracks
+
+
+class TestMatchYearsSharded:
+    def setUp(self):
+        self.df, self.best_tracks = create_year()
+
+    def test_1_merged_partitions_match_simple_matching(self):
+        # Partitions come back in any order, and some have no vortmaxes at all.
+        member_shards = [[50, 51], [40, 41], [20], [0, 1]]
+        partitions = [_match_members(self.best_tracks, self.df, members)
+                      for members in member_shards]
+        matches = _merge_partitions(partitions)
+        assert matches.equals(simple_matching(self.best_tracks, self.df))
+
+    def test_2_skips_done_years_unless_forced(self):
+        try:
+            import tables
+        except ImportError:
+            raise SkipTest('PyTables is needed to save results')
+        tmp_dir = mkdtemp()
+        parallel.C20Data = FakeC20Data
+        try:
+            results_manager = StormtracksResultsManager('test', tmp_dir)
+            results_manager.save_result(2005, 'all_fields', self.df)
+            results_manager.save_result(2006, 'all_fields', self.df)
+            ibdata = FakeIbtracsData(self.best_tracks)
+
+            done = match_years_sharded('test', [2005], num_procs=2, num_member_shards=3,
+                                       output_dir=tmp_dir, ibdata=ibdata)
+            assert done == [2005]
+            # Best tracks are resampled onto the year's 20CR dates.
+            assert (ibdata.dates[2005] == FakeC20Data(2005).dates).all()
+            df = results_manager.get_result(2005, 'all_fields')
+            expected = simple_matching(self.best_tracks, df)
+            assert results_manager.get_result(2005, 'best_track_matches').equals(expected)
+
+            done = match_years_sharded('test', [2005, 2006], num_procs=2, output_dir=tmp_dir,
+                                       ibdata=ibdata)
+            assert done == [2006]
+            done = match_years_sharded('test', [2005, 2006], num_procs=2, output_dir=tmp_dir,
+                                       ibdata=ibdata, force=True)
+            assert done == [2005, 2006]
+        finally:
+            shutil.rmtree(tmp_dir)
+            parallel.C20Data = C20Data
+
+
+def create_moving_vortmaxes(seed=0):
+    '''Vortmaxes of 3 ensemble members that drift a few degrees each timestep'''
+    rs = np.random.RandomState(seed)
+    dates = [dt.datetime(2005, 6, 1) + dt.timedelta(hours=6 * i) for i in range(12)]
+    rows = []
+    for em in [2, 0, 1]:
+        lons, lats = rs.uniform(270., 330., 8), rs.uniform(5., 45., 8)
+        for date in dates:
+            lons += rs.uniform(-3., 1., 8)
+            lats += rs.uniform(-1., 2., 8)
+            keep = rs.rand(8) > 0.1
+            rows.append(pd.DataFrame({'date': date, 'em': np.int8(em), 'lon': lons[keep],
+                                      'lat': lats[keep],
+                                      'vort850': rs.uniform(1e-5, 1e-4, keep.sum())}))
+    df = pd.concat(rows, ignore_index=True)
+    return df.iloc[rs.permutation(len(df))]
+
+
+class TestTrackMemberSharded:
+    def setUp(self):
+        self.df = create_moving_vortmaxes()
+
+    def check_same_as_serial(self, tracker):
+        store = track_member_sharded(tracker, self.df, num_procs=2)
+        serial_store = tracker.track(self.df)
+        assert len(store) > 0
+        assert (store.offsets == serial_store.offsets).all()
+        assert store.points.equals(serial_store.points)
+
+    def test_1_nearest_neighbour(self):
+        self.check_same_as_serial(VortmaxNearestNeighbourTracker())
+
+    def test_2_assignment(self):
+        self.check_same_as_serial(VortmaxAssignmentTracker())
+
+    def test_3_kalman_filter(self):
+        self.check_same_as_serial(VortmaxKalmanFilterTracker())
+
+
+class TestMemberSharding:
+    def setUp(self):
+        self.c20data = FakeC20Data(2005, fields=['u850', 'v850', 'prmsl'])
+        self.shape = (56, len(self.c20data.lats), len(self.c20data.lons))
+
+    def test_1_shared_cubes_across_processes(self):
+        cubes = SharedFieldCubes(['u850', 'prmsl'], self.shape)
+        # Workers are forked before the cubes are filled, so they must see later writes.
+        pool = Pool(2, _init_cube_worker, (cubes,))
+        try:
+            for slot, index in [(0, 0), (1, 1)]:
+                self.c20data._load_ensemble_data(index)
+                cubes.fill(slot, self.c20data)
+            worker_cubes = pool.map(_read_cube, [(1, 'u850'), (0, 'prmsl'), (1, 'prmsl')])
+        finally:
+            pool.close()
+            pool.join()
+        assert (worker_cubes[0] == self.c20data.u850).all()
+        assert (worker_cubes[2] == self.c20data.prmsl).all()
+        self.c20data._load_ensemble_data(0)
+        assert (worker_cubes[1] == self.c20data.prmsl).all()
+
+    def test_2_set_slot_same_as_c20data(self):
+        date = self.c20data.dates[1]
+        self.c20data.set_date(date)
+        cubes = SharedFieldCubes(self.c20data.fields, self.shape, num_slots=1)
+        cubes.fill(0, self.c20data)
+        shared_c20data = SharedC20Data(cubes, self.c20data)
+        shared_c20data.set_slot(0, date, [3, 10])
+
+        for em in [3, 10]:
+            assert (shared_c20data.vort850[em] == self.c20data.vort850[em]).all()
+            assert shared_c20data.vmaxs850[em] == self.c20data.vmaxs850[em]
+            assert shared_c20data.pmins[em] == self.c20data.pmins[em]
+        # Other members are left out.
+        assert shared_c20data.vmaxs850[0] == []
+        assert (shared_c20data.vort850[0] == 0).all()
+
+    def test_3_same_as_serial_and_date_restored(self):
+        c20data = FakeC20Data(2005)
+        finder = VortmaxFinder(c20data, False)
+        start_date, end_date = c20data.dates[1], c20data.dates[2]
+        df = finder.find_vort_maxima(start_date, end_date)
+
+        c20data.set_date(c20data.dates[4])
+        vmaxs850 = c20data.vmaxs850
+        sharded_df = find_vort_maxima_member_sharded(finder, start_date, end_date, num_procs=2)
+        assert sharded_df.equals(df)
+        assert c20data.date == c20data.dates[4]
+        assert c20data.vmaxs850 == vmaxs850
+
+
+class TestDateSharding:
+    def setUp(self):
+        self.dates = FakeC20Data(2005).dates
+
+    def test_1_shards_cover_range(self):
+        for num_shards in [1, 2, 3, 4, 10]:
+            shards = shard_date_range(self.dates, self.dates[1], self.dates[6], num_shards)
+            assert len(shards) == min(num_shards, 6)
+            assert shards[0][0] == self.dates[1]
+            assert shards[-1][1] == self.dates[6]
+            for (start1, end1), (start2, end2) in zip(shards[:-1], shards[1:]):
+                assert start1 <= end1
+                # The next shard starts on the date after this one ends.
+                assert list(self.dates).index(start2) == list(self.dates).index(end1) + 1
+
+    def test_2_single_date(self):
+        shards = shard_date_range(self.dates, self.dates[3], self.dates[3], 4)
+        assert shards == [(self.dates[3], self.dates[3])]
+
+    def test_3_same_as_serial(self):
+        c20data = FakeC20Data(2005)
+        finder = VortmaxFinder(c20data, False)
+        start_date, end_date = c20data.dates[1], c20data.dates[3]
+        df = finder.find_vort_maxima(start_date, end_date)
+
+        # Workers create their own C20Data.
+        parallel.C20Data = FakeC20Data
+        try:
+            sharded_df = find_vort_maxima_date_sharded(finder, start_date, end_date,
+                                                       num_procs=2)
+        finally:
+            parallel.C20Data = C20Data
+        assert sharded_df.equals(df)
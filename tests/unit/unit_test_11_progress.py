@@ -0,0 +1,77 @@
+import sys
+sys.path.insert(0, '..')
+
+import logging
+
+import stormtracks.utils.progress as progress
+from stormtracks.utils.progress import ProgressReporter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+        self.num_calls = 0
+
+    def time(self):
+        self.num_calls += 1
+        return self.now
+
+
+class FakeLogger(object):
+    def __init__(self, level=logging.INFO):
+        self.level = level
+        self.messages = []
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def log(self, level, message):
+        self.messages.append(message)
+
+
+class TestProgressReporter:
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = progress.time
+        progress.time = self.clock
+
+    def tearDown(self):
+        progress.time = self.time
+
+    def test_1_reports_at_interval(self):
+        log = FakeLogger()
+        reporter = ProgressReporter(log, 'Testing', total_steps=10, interval=10.)
+        for i in range(4):
+            self.clock.now += 4.
+            reporter.update(rows=5, current=i)
+        # Reports after 12s (step 3), the next is not due until 22s.
+        assert len(log.messages) == 1
+        assert log.messages[0].startswith('Testing: 3/10 steps (30%) in 12.0s')
+        assert log.messages[0].endswith('[2]')
+
+        self.clock.now += 6.
+        reporter.update()
+        assert len(log.messages) == 2
+        assert '5/10 steps' in log.messages[1]
+
+    def test_2_finish(self):
+        log = FakeLogger()
+        reporter = ProgressReporter(log, 'Testing', interval=10.)
+        reporter.update(rows=20)
+        self.clock.now += 2.
+        reporter.finish()
+        assert log.messages == ['Testing: 1 steps in 2.0s, 0.50 steps/s, 10.0 rows/s, '
+                                '0.00 MB/s [done]']
+
+    def test_3_disabled_does_nothing(self):
+        log = FakeLogger(logging.WARNING)
+        reporter = ProgressReporter(log, 'Testing', interval=10.)
+        num_calls = self.clock.num_calls
+        for i in range(5):
+            self.clock.now += 100.
+            reporter.update(rows=1)
+        reporter.finish()
+        # Totals are still kept, but the clock is never read and nothing is formatted.
+        assert reporter.steps == 5 and reporter.rows == 5
+        assert self.clock.num_calls == num_calls
+        assert log.messages == []
@@ -0,0 +1,46 @@
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+import pandas as pd
+
+from stormtracks.processing.find_vortmax import (CutoffProfile, stronger_neighbour_dists,
+                                                 apply_cutoff_profile)
+from stormtracks.utils.utils import geo_dist
+
+
+class TestCutoffProfiles:
+    def __init__(self):
+        self.lons = np.array([280., 282., 300., 320.])
+        self.lats = np.array([20., 20., 20., 40.])
+        self.vorts = np.array([2e-5, 3e-5, 0.5e-5, 1e-5])
+        self.nbr_dists = stronger_neighbour_dists(self.lons, self.lats, self.vorts)
+        self.df = pd.DataFrame({'lon': self.lons, 'lat': self.lats,
+                                'vort850': self.vorts, 'nbr_dist': self.nbr_dists})
+
+    def test_1_strongest_has_no_neighbour(self):
+        assert np.isinf(self.nbr_dists[1])
+
+    def test_2_nearest_stronger_neighbour(self):
+        assert self.nbr_dists[0] == geo_dist((280, 20), (282, 20))
+        assert self.nbr_dists[2] == geo_dist((300, 20), (282, 20))
+
+    def test_3_equal_vorts_later_is_stronger(self):
+        nbr_dists = stronger_neighbour_dists(np.array([0., 2.]), np.array([0., 0.]),
+                                             np.array([1., 1.]))
+        assert not np.isinf(nbr_dists[0])
+        assert np.isinf(nbr_dists[1])
+
+    def test_4_vort_cutoff(self):
+        profile = CutoffProfile(1e-5, None, None, None)
+        assert len(apply_cutoff_profile(self.df, profile)) == 3
+
+    def test_5_dist_cutoff(self):
+        profile = CutoffProfile(None, geo_dist((0, 0), (2, 0)) * 5, None, None)
+        filtered = apply_cutoff_profile(self.df, profile)
+        assert list(filtered.lon) == [282., 300., 320.]
+
+    def test_6_range_cutoff(self):
+        profile = CutoffProfile(None, None, (290, 340), (0, 30))
+        filtered = apply_cutoff_profile(self.df, profile)
+        assert list(filtered.lon) == [300.]
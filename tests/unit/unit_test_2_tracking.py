@@ -0,0 +1,224 @@
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+import pandas as pd
+
+from stormtracks.processing.tracking import (link_nearest_neighbours, link_min_cost,
+                                             VortmaxNearestNeighbourTracker,
+                                             VortmaxAssignmentTracker,
+                                             VortmaxKalmanFilterTracker,
+                                             OnlineVortmaxTracker, FieldFinder,
+                                             TRACK_FIELD_COLUMNS)
+from stormtracks.processing.track_store import TrackStore, TrackDateIndex
+from stormtracks.utils.utils import find_extrema, geo_dist
+
+
+class TestLinkNearestNeighbours:
+    def test_1_links_nearest(self):
+        dists = np.array([[5., 1., 3.],
+                          [2., 7., 9.]])
+        assert list(link_nearest_neighbours(dists, 10.)) == [1, 0]
+
+    def test_2_respects_cutoff(self):
+        dists = np.array([[5., 12.],
+                          [11., 12.]])
+        assert list(link_nearest_neighbours(dists, 10.)) == [0, -1]
+
+    def test_3_conflict_keeps_nearest(self):
+        dists = np.array([[2., 8.],
+                          [1., 9.],
+                          [1., 3.]])
+        # Points 1 and 2 are equally near to 0, so the first one keeps the link.
+        assert list(link_nearest_neighbours(dists, 10.)) == [-1, 0, -1]
+
+    def test_4_empty_timesteps(self):
+        assert len(link_nearest_neighbours(np.zeros((0, 3)), 10.)) == 0
+        assert list(link_nearest_neighbours(np.zeros((2, 0)), 10.)) == [-1, -1]
+
+
+class TestLinkMinCost:
+    def test_1_no_stolen_links(self):
+        # Greedy linking would give point 0 its nearest next point and leave point 1 unlinked.
+        links = link_min_cost(np.array([0, 0, 1]), np.array([0, 1, 0]),
+                              np.array([1., 2., 1.5]), 3)
+        assert list(links) == [1, 0, -1]
+
+    def test_2_no_candidates(self):
+        links = link_min_cost(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0), 2)
+        assert list(links) == [-1, -1]
+
+
+class TestNearestNeighbourTracker:
+    def setUp(self):
+        self.tracker = VortmaxNearestNeighbourTracker()
+
+    def test_1_stationary_vortmax_is_linked(self):
+        lons, lats, vorts = np.array([300.]), np.array([20.]), np.array([1e-4])
+        links = self.tracker.link(lons, lats, vorts, lons, lats, vorts)
+        assert list(links) == [0]
+
+    def test_2_link_steps(self):
+        steps = [(0, np.array([300., 280.]), np.array([20., 10.]), np.array([1e-4, 1e-4])),
+                 (1, np.array([282., 302.]), np.array([10., 20.]), np.array([1e-4, 1e-4])),
+                 (2, np.array([250.]), np.array([50.]), np.array([1e-4]))]
+        links = self.tracker.link_steps(steps)
+        assert len(links) == 2
+        assert list(links[0]) == [1, 0]
+        assert list(links[1]) == [-1, -1]
+
+    def test_3_no_links_across_gaps(self):
+        steps = [(0, np.array([300.]), np.array([20.]), np.array([1e-4])),
+                 (2, np.array([300.]), np.array([20.]), np.array([1e-4]))]
+        assert list(self.tracker.link_steps(steps)[0]) == [-1]
+
+    def test_4_track_member(self):
+        date_idx = np.array([0, 0, 1, 1, 2, 3])
+        lons = np.array([300., 280., 282., 302., 304., 306.])
+        lats = np.array([20., 10., 10., 20., 20., 20.])
+        track_ids = self.tracker.track_member(date_idx, lons, lats, np.ones(6))
+        assert list(track_ids) == [0, 1, 1, 0, 0, 0]
+
+    def test_5_track_df(self):
+        dates = pd.date_range('2005-06-01', periods=8, freq='6H')
+        df = pd.DataFrame({'em': np.r_[np.ones(8), np.zeros(8)].astype(np.int8),
+                           'date': np.r_[dates, dates],
+                           'lon': np.r_[np.arange(300., 316., 2.), np.arange(280., 296., 2.)],
+                           'lat': np.ones(16) * 20.,
+                           'vort850': np.ones(16) * 1e-4},
+                          index=np.arange(100, 116))
+        # Shuffle rows to check that tracking doesn't depend on their order.
+        store = self.tracker.track(df.iloc[::-1])
+        assert len(store) == 2
+        assert list(store.track_ems) == [0, 1]
+        assert list(store.track_column(0, 'row')) == list(range(108, 116))
+        assert list(store.track_column(1, 'date_idx')) == list(range(8))
+
+
+class TestAssignmentTracker:
+    def setUp(self):
+        self.tracker = VortmaxAssignmentTracker()
+
+    def test_1_stationary_vortmax_is_linked(self):
+        lons, lats, vorts = np.array([300.]), np.array([20.]), np.array([1e-4])
+        links = self.tracker.link(lons, lats, vorts, lons, lats, vorts)
+        assert list(links) == [0]
+
+    def test_2_respects_cutoff(self):
+        links = self.tracker.link(np.array([300., 280.]), np.array([20., 10.]), np.ones(2),
+                                  np.array([250., 282.]), np.array([50., 10.]), np.ones(2))
+        assert list(links) == [-1, 1]
+
+
+class TestKalmanFilterTracker:
+    def setUp(self):
+        self.tracker = VortmaxKalmanFilterTracker()
+
+    def test_1_follows_moving_vortmax(self):
+        # Two vortmaxes that pass each other: once the filter has their velocities, each is
+        # linked to where it is predicted to be rather than to the nearest vortmax.
+        date_idx = np.repeat(np.arange(5), 2)
+        lons = np.array([300., 280., 297., 283., 294., 286., 291., 289., 288., 292.])
+        lats = np.tile([20., 21.], 5)
+        track_ids = self.tracker.track_member(date_idx, lons, lats, np.ones(10))
+        assert list(track_ids) == [0, 1] * 5
+
+        nn_track_ids = VortmaxNearestNeighbourTracker().track_member(date_idx, lons, lats,
+                                                                     np.ones(10))
+        assert list(nn_track_ids[-2:]) == [1, 0]
+
+    def test_2_no_links_across_gaps(self):
+        steps = [(0, np.array([300.]), np.array([20.]), np.array([1e-4])),
+                 (2, np.array([300.]), np.array([20.]), np.array([1e-4]))]
+        assert list(self.tracker.link_steps(steps)[0]) == [-1]
+
+
+class TestOnlineTracker:
+    def test_1_emits_finished_tracks(self):
+        dates = pd.date_range('2005-06-01', periods=10, freq='6H')
+        # One vortmax moving for all 10 steps, another for the first 7 only.
+        df = pd.DataFrame({'em': np.zeros(17, dtype=np.int8),
+                           'date': np.r_[dates, dates[:7]],
+                           'lon': np.r_[np.arange(300., 320., 2.), np.arange(270., 284., 2.)],
+                           'lat': np.ones(17) * 20.,
+                           'vort850': np.ones(17) * 1e-4})
+        tracker = OnlineVortmaxTracker()
+        finished = [len(tracker.add_step(df[df.date == date])) for date in dates]
+        assert finished == [0] * 7 + [1, 0, 0]
+        store = tracker.flush()
+        assert len(store) == 1
+        assert list(store.track_column(0, 'row')) == list(range(10))
+        assert not tracker.open_tracks
+
+
+class FakeFields(object):
+    '''Random fields for 2 ensemble members on the 20CR grid'''
+    def __init__(self):
+        rs = np.random.RandomState(0)
+        self.lons = np.arange(0, 360, 2).astype(np.float32)
+        self.lats = np.arange(90, -92, -2).astype(np.float32)
+        shape = (2, len(self.lats), len(self.lons))
+        # Smooth-ish pressure, so that windows have a few minima.
+        self.prmsl = (101325 + 500 * np.cumsum(rs.randn(*shape), axis=2)).astype(np.float32)
+        for field in ['u9950', 'v9950', 't850', 't9950', 'cape', 'pwat']:
+            setattr(self, field, rs.randn(*shape).astype(np.float32))
+
+
+def point_fields(c20data, em, lon, lat, lon_index, lat_index):
+    '''Fields for one point, using slices of an 11x11 window truncated in latitude and wrapped
+    in longitude'''
+    min_lat = max(lat_index - 5, 0)
+    lat_slice = slice(min_lat, lat_index + 6)
+    lon_indices = np.arange(lon_index - 5, lon_index + 6) % len(c20data.lons)
+
+    def local(field):
+        return getattr(c20data, field)[em][lat_slice][:, lon_indices]
+
+    local_prmsl = local('prmsl')
+    local_windspeed = np.sqrt(local('u9950') ** 2 + local('v9950') ** 2)
+    max_pos = np.unravel_index(np.argmax(local_windspeed), local_windspeed.shape)
+    fields = {'max_ws': local_windspeed[max_pos],
+              'max_ws_lon': c20data.lons[lon_indices[max_pos[1]]],
+              'max_ws_lat': c20data.lats[min_lat + max_pos[0]],
+              'pmin_dist': 1000}
+    e, index_pmaxs, index_pmins = find_extrema(local_prmsl)
+    for index_pmin in index_pmins:
+        pmin_pos = (c20data.lons[lon_indices[index_pmin[1]]],
+                    c20data.lats[min_lat + index_pmin[0]])
+        dist = geo_dist((lon, lat), pmin_pos)
+        if dist < fields['pmin_dist']:
+            fields.update({'pmin_dist': dist, 'pmin': local_prmsl[index_pmin],
+                           'pmin_lon': pmin_pos[0], 'pmin_lat': pmin_pos[1],
+                           'p_ambient_diff': (local_prmsl.mean(dtype=np.float64) -
+                                              local_prmsl[index_pmin])})
+    for field in ['t850', 't9950', 'cape', 'pwat']:
+        fields[field] = getattr(c20data, field)[em][lat_index, lon_index]
+    return fields
+
+
+class TestFieldFinder:
+    def test_1_same_as_per_point_windows(self):
+        c20data = FakeFields()
+        # Points in the middle of the grid and within 5 cells of each edge.
+        lon_index = np.array([90, 0, 3, 179, 176, 40, 40, 40, 40, 1, 178])
+        lat_index = np.array([45, 45, 45, 45, 45, 0, 4, 90, 86, 2, 88])
+        num_points = len(lon_index)
+        columns = {'em': np.arange(num_points) % 2, 'date': np.zeros(num_points, dtype='M8[ns]'),
+                   'date_idx': np.zeros(num_points, dtype=int),
+                   'lon': c20data.lons[lon_index] + 0.3, 'lat': c20data.lats[lat_index] - 0.3,
+                   'vort': np.ones(num_points), 'row': np.arange(num_points)}
+        store = TrackStore.from_track_ids(columns, np.arange(num_points), min_length=1)
+
+        finder = FieldFinder(c20data, store)
+        point_index, rows = TrackDateIndex(store, c20data.lons, c20data.lats).step(0)
+        finder.add_fields_to_points(point_index, rows)
+
+        for i in range(num_points):
+            expected = point_fields(c20data, columns['em'][i], columns['lon'][i],
+                                    columns['lat'][i], lon_index[i], lat_index[i])
+            for field in TRACK_FIELD_COLUMNS:
+                value = finder.fields[field][i]
+                if field in expected:
+                    assert np.isclose(value, expected[field], rtol=1e-6), (i, field)
+                else:
+                    assert np.isnan(value), (i, field)
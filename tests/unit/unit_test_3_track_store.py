@@ -0,0 +1,78 @@
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+
+from stormtracks.processing.track_store import TrackStore, TrackDateIndex, chain_links
+
+
+class TestChainLinks:
+    def test_1_chain_links(self):
+        links = [np.array([1, -1]), np.array([-1, 0])]
+        track_ids = chain_links([2, 2, 1], links)
+        assert list(track_ids) == [0, 1, 2, 0, 0]
+
+
+class TestTrackStore:
+    def setUp(self):
+        # Two timesteps per point of track 0, track 1 is too short to keep.
+        track_ids = np.array([0, 1, 0, 1, 0, 2, 0, 2, 0, 2, 0, 2, 2, 2])
+        num_points = len(track_ids)
+        columns = {'em': np.zeros(num_points, dtype=np.int8),
+                   'date': np.zeros(num_points, dtype='datetime64[ns]'),
+                   'date_idx': np.arange(num_points),
+                   'lon': np.arange(num_points, dtype=np.float32),
+                   'lat': np.zeros(num_points, dtype=np.float32),
+                   'vort': np.ones(num_points, dtype=np.float32),
+                   'row': np.arange(num_points)}
+        self.store = TrackStore.from_track_ids(columns, track_ids)
+
+    def test_1_short_tracks_removed(self):
+        assert len(self.store) == 2
+        assert list(self.store.lengths) == [6, 6]
+
+    def test_2_tracks_are_contiguous_and_ordered(self):
+        assert list(self.store.track_column(0, 'row')) == [0, 2, 4, 6, 8, 10]
+        assert list(self.store.track_column(1, 'row')) == [5, 7, 9, 11, 12, 13]
+
+    def test_3_track_column_is_a_view(self):
+        assert self.store.track_column(1, 'lon').base is not None
+
+    def test_4_select(self):
+        selected = self.store.select([False, True])
+        assert len(selected) == 1
+        assert list(selected.track_column(0, 'row')) == [5, 7, 9, 11, 12, 13]
+
+    def test_5_concat(self):
+        store = TrackStore.concat([self.store, self.store])
+        assert len(store) == 4
+        assert list(store.track_column(3, 'row')) == [5, 7, 9, 11, 12, 13]
+
+
+class TestTrackDateIndex:
+    def setUp(self):
+        # Two tracks in different ensemble members, the second starting a timestep later.
+        track_ids = np.repeat([0, 1], 6)
+        date_idx = np.r_[np.arange(6), np.arange(1, 7)]
+        columns = {'em': np.repeat([3, 1], 6).astype(np.int8),
+                   'date': np.zeros(12, dtype='datetime64[ns]') + date_idx,
+                   'date_idx': date_idx,
+                   'lon': np.r_[np.arange(280., 292., 2.), np.arange(300., 312., 2.)] + 0.5,
+                   'lat': np.ones(12, dtype=np.float32) * 19.,
+                   'vort': np.ones(12, dtype=np.float32),
+                   'row': np.arange(12)}
+        store = TrackStore.from_track_ids(columns, track_ids)
+        self.index = TrackDateIndex(store, np.arange(0., 360., 2.), np.arange(90., -92., -2.))
+
+    def test_1_steps(self):
+        assert len(self.index) == 7
+        assert list(self.index.date_idx) == list(range(7))
+
+    def test_2_rows_sorted_by_member(self):
+        point_index, rows = self.index.lookup(3)
+        assert list(point_index) == [8, 3]
+        assert rows.tolist() == [[1, 152, 35, 1], [3, 143, 35, 0]]
+
+    def test_3_missing_step(self):
+        point_index, rows = self.index.lookup(9)
+        assert len(point_index) == 0 and rows.shape == (0, 4)
@@ -0,0 +1,76 @@
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+
+from stormtracks.processing.track_store import TrackStore
+from stormtracks.processing.clustering import (cluster_tracks, consensus_tracks,
+                                               merge_track_pairs)
+
+
+class TestClustering:
+    def _create_store(self, tracks):
+        '''tracks is a list of (em, first date_idx, length, lat)'''
+        columns = dict((name, []) for name in ['em', 'date_idx', 'lon', 'lat'])
+        track_ids = []
+        for track_id, (em, offset, length, lat) in enumerate(tracks):
+            date_idx = np.arange(offset, offset + length)
+            columns['em'].append(np.ones(length, dtype=np.int8) * em)
+            columns['date_idx'].append(date_idx)
+            columns['lon'].append(300. + date_idx)
+            columns['lat'].append(np.ones(length) * lat)
+            track_ids.append(np.ones(length, dtype=int) * track_id)
+        columns = dict((name, np.concatenate(values)) for name, values in columns.items())
+        num_points = len(columns['em'])
+        columns['date'] = np.zeros(num_points, dtype='datetime64[ns]') + columns['date_idx']
+        columns['vort'] = np.ones(num_points)
+        columns['row'] = np.arange(num_points)
+        return TrackStore.from_track_ids(columns, np.concatenate(track_ids))
+
+    def test_1_close_tracks_cluster(self):
+        store = self._create_store([(0, 0, 20, 20.), (1, 0, 20, 21.)])
+        track_clusters, matches = cluster_tracks(store)
+        assert list(track_clusters) == [0, 0]
+        assert list(matches.overlap) == [20]
+
+    def test_2_far_tracks_dont_cluster(self):
+        store = self._create_store([(0, 0, 20, 20.), (1, 0, 20, 40.)])
+        track_clusters, matches = cluster_tracks(store)
+        assert list(track_clusters) == [0, 1]
+
+    def test_3_short_overlap_doesnt_cluster(self):
+        store = self._create_store([(0, 0, 12, 20.), (1, 8, 12, 20.)])
+        track_clusters, matches = cluster_tracks(store)
+        assert list(track_clusters) == [0, 1]
+
+    def test_4_same_member_doesnt_cluster(self):
+        store = self._create_store([(0, 0, 10, 20.), (0, 10, 10, 20.5)])
+        track_clusters, matches = cluster_tracks(store)
+        assert len(matches) == 0
+
+    def test_5_consensus(self):
+        store = self._create_store([(0, 0, 20, 20.), (1, 0, 10, 22.), (2, 0, 20, 40.)])
+        track_clusters, matches = cluster_tracks(store)
+        consensus = consensus_tracks(store, track_clusters)
+        assert len(consensus) == 20
+        assert list(consensus.num_tracks[:10]) == [2] * 10
+        assert list(consensus.num_tracks[10:]) == [1] * 10
+        assert abs(consensus.lat.values[0] - 21.) < 0.01
+        assert consensus.lat.values[10] == 20.
+        assert abs(consensus.spread_mean.values[0] - 111.2) < 0.1
+
+    def test_6_one_track_per_member(self):
+        # Two tracks of member 0 side by side, and a member 1 track that is close to both:
+        # it only joins the nearer one.
+        store = self._create_store([(0, 0, 20, 20.), (0, 0, 20, 21.), (1, 0, 20, 20.3)])
+        track_clusters, matches = cluster_tracks(store)
+        assert len(matches) == 2
+        assert list(track_clusters) == [0, 1, 0]
+        consensus = consensus_tracks(store, track_clusters)
+        assert list(consensus.num_tracks) == [2] * 20
+
+    def test_7_no_chaining_through_a_member(self):
+        # 0-1 and 2-3 are the closest pairs, then 1-2 would put two member 0 tracks together.
+        track_clusters = merge_track_pairs(np.array([0, 1, 0, 2]),
+                                           np.array([[0, 1], [2, 3], [1, 2], [1, 3]]))
+        assert list(track_clusters) == [0, 0, 1, 1]
@@ -0,0 +1,48 @@
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+import pandas as pd
+
+from stormtracks.processing.track_store import TrackStore
+from stormtracks.processing.track_features import track_features
+
+
+class TestTrackFeatures:
+    def setUp(self):
+        track_ids = np.repeat([0, 1], [6, 7])
+        date_idx = np.r_[np.arange(6), np.arange(3, 10)]
+        columns = {'em': np.repeat([0, 5], [6, 7]).astype(np.int8),
+                   'date': (np.datetime64('2005-06-01T00:00', 'ns') +
+                            date_idx * np.timedelta64(6, 'h')),
+                   'date_idx': date_idx,
+                   'lon': np.arange(280., 306., 2.),
+                   'lat': np.arange(10., 23.),
+                   'vort': np.r_[np.arange(1., 7.), np.arange(7., 0., -1.)],
+                   'row': np.arange(100, 113)}
+        self.store = TrackStore.from_track_ids(columns, track_ids)
+        # Fields for the first track are missing from all_fields.
+        self.all_fields = pd.DataFrame({'max_ws': np.r_[np.nan, 1., 2., 3., 4., 5., 6.],
+                                        'pmin': np.r_[np.nan, 1010., 1000., np.nan, 990.,
+                                                      995., 1000.]},
+                                       index=np.arange(106, 113))
+
+    def test_1_features(self):
+        features = track_features(self.store, self.all_fields)
+        assert list(features.em) == [0, 5]
+        assert list(features.num_points) == [6, 7]
+        assert list(features.lifetime) == [30., 36.]
+        assert list(features.max_vort) == [6., 7.]
+        assert list(features.genesis_lon) == [280., 292.]
+        assert list(features.lysis_lat) == [15., 22.]
+
+    def test_2_fields_from_all_fields(self):
+        features = track_features(self.store, self.all_fields)
+        assert np.isnan(features.max_ws[0]) and np.isnan(features.pdi[0])
+        assert features.max_ws[1] == 6.
+        assert features.min_pmin[1] == 990.
+        assert features.pdi[1] == sum(ws ** 3 for ws in range(1, 7))
+
+    def test_3_no_tracks(self):
+        features = track_features(self.store.select([False, False]))
+        assert len(features) == 0
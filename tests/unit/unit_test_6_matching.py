@@ -0,0 +1,76 @@
+import sys
+sys.path.insert(0, '..')
+
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from stormtracks.processing.matching import (simple_matching, match_tracks,
+                                             good_track_matches)
+from stormtracks.processing.track_store import TrackStore
+from stormtracks.utils.utils import geo_dist
+
+
+class FakeBestTrack(object):
+    def __init__(self, name, dates, lons, lats, winds, cls):
+        self.name = name
+        self.dates = np.array(dates)
+        self.lons = np.array(lons)
+        self.lats = np.array(lats)
+        self.winds = np.array(winds)
+        self.cls = cls
+
+
+class TestSimpleMatching:
+    def setUp(self):
+        self.dates = [dt.datetime(2005, 6, 1, 6 * i) for i in range(3)]
+        self.df = pd.DataFrame({'date': [self.dates[0]] * 3 + [self.dates[1]] * 2,
+                                'em': np.array([1, 0, 1, 0, 0], dtype=np.int8),
+                                'lon': [300., 302., 310., 304., 290.],
+                                'lat': [20., 20., 20., 20., 20.]})
+        self.best_tracks = [FakeBestTrack('bt', self.dates, [301., 303., 305.], [20.] * 3,
+                                          [30., 40., 50.], ['TS', 'HU', 'HU'])]
+
+    def test_1_nearest_per_member(self):
+        matches = simple_matching(self.best_tracks, self.df)
+        # Fix 0 matches rows 1 (em 0) and 0 (em 1), fix 1 matches row 3, fix 2 has no vortmax.
+        assert list(matches.index) == [1, 0, 3]
+        assert list(matches.bt_wind) == [30., 30., 40.]
+        assert list(matches.is_hurr) == [False, False, True]
+        assert matches.bt_min_dist.values[2] == geo_dist((304., 20.), (303., 20.))
+
+    def test_2_first_on_tie(self):
+        self.df.loc[2, 'lon'] = 302.
+        matches = simple_matching(self.best_tracks, self.df)
+        assert list(matches.index) == [1, 0, 3]
+
+
+class TestTrackMatching:
+    def setUp(self):
+        dates = np.array([dt.datetime(2005, 6, 1) + dt.timedelta(hours=6 * i) for i in range(20)])
+        # Track 0 (em 0) follows the best track closely, track 1 (em 0) is further away and
+        # track 2 (em 1) is before it.
+        track_ids = np.repeat([0, 1, 2], [10, 10, 6])
+        date_idx = np.r_[np.arange(5, 15), np.arange(5, 15), np.arange(0, 6)]
+        columns = {'em': np.repeat([0, 0, 1], [10, 10, 6]).astype(np.int8),
+                   'date': dates[date_idx].astype('datetime64[ns]'),
+                   'date_idx': date_idx,
+                   'lon': np.r_[300. + np.arange(5, 15), 300. + np.arange(5, 15),
+                                300. + np.arange(6)],
+                   'lat': np.r_[np.ones(10) * 20.5, np.ones(10) * 23., np.ones(6) * 20.],
+                   'vort': np.ones(26),
+                   'row': np.arange(26)}
+        self.store = TrackStore.from_track_ids(columns, track_ids)
+        self.best_tracks = [FakeBestTrack('bt', dates[8:20], 300. + np.arange(8, 20),
+                                          [20.] * 12, [50.] * 12, ['HU'] * 12)]
+
+    def test_1_overlap_and_distance(self):
+        matches = match_tracks(self.best_tracks, self.store)
+        assert list(matches.track_id) == [0, 1]
+        assert list(matches.overlap) == [7, 7]
+        assert abs(matches.av_dist.values[0] - geo_dist((300., 20.), (300., 20.5))) < 1e-6
+
+    def test_2_good_matches(self):
+        matches = good_track_matches(match_tracks(self.best_tracks, self.store))
+        assert list(matches.track_id) == [0]
@@ -0,0 +1,37 @@
+import sys
+sys.path.insert(0, '..')
+
+import datetime as dt
+
+from stormtracks.processing.spatial_index import DateSpatialIndex
+
+
+class TestDateSpatialIndex:
+    def setUp(self):
+        self.date1, self.date2 = dt.datetime(2005, 6, 1), dt.datetime(2005, 6, 1, 6)
+        dates = [self.date2, self.date1, self.date1, self.date1, self.date2]
+        self.index = DateSpatialIndex(dates, [300., 300., 301., 340., 300.5],
+                                      [20., 20., 20., 20., 20.], [0, 0, 1, 1, 1])
+
+    def test_1_date_positions(self):
+        assert list(self.index.date_positions(self.date1)) == [1, 2, 3]
+        assert list(self.index.date_positions(dt.datetime(2005, 1, 1))) == []
+
+    def test_2_query_within_dist(self):
+        query_index, positions = self.index.query([self.date1, self.date2], [300.2] * 2,
+                                                  [20.] * 2, 500.)
+        assert list(query_index) == [0, 0, 1, 1]
+        assert list(positions) == [1, 2, 0, 4]
+
+    def test_3_query_whole_date(self):
+        query_index, positions = self.index.query([self.date1], [300.2], [20.])
+        assert list(positions) == [1, 2, 3]
+
+    def test_4_nearest_per_member(self):
+        query_index, positions, dists = self.index.nearest_per_member([self.date1],
+                                                                      [330.], [20.])
+        assert list(positions) == [1, 3]
+
+    def test_5_close_pairs(self):
+        pairs = self.index.close_pairs(200.)
+        assert sorted(map(sorted, pairs.tolist())) == [[0, 4], [1, 2]]
@@ -0,0 +1,173 @@
+import sys
+sys.path.insert(0, '..')
+
+import os
+import datetime as dt
+from tempfile import mkdtemp
+import shutil
+
+import numpy as np
+
+from stormtracks.ibtracsdata import IbtracsArchive, IbtracsData
+
+
+def create_storm(name, basin, length):
+    start = np.datetime64(dt.datetime(int(name[:4]), 8, 1), 's')
+    return {'name': name, 'year': int(name[:4]), 'basin': basin,
+            'date': start + np.arange(length) * np.timedelta64(6, 'h'),
+            'lon': np.linspace(300., 320., length).astype(np.float32),
+            'lat': np.linspace(10., 30., length).astype(np.float32),
+            'wind': np.linspace(30., 100., length).astype(np.float32),
+            'pressure': np.linspace(1000., 950., length).astype(np.float32),
+            'cls': np.array(['TS'] * (length - 1) + ['HU'], dtype='S2')}
+
+
+class TestIbtracsArchive:
+    def setUp(self):
+        self.archive = IbtracsArchive.from_storms([create_storm('2005236N23285', 'NA', 10),
+                                                   create_storm('2004100N10100', 'WP', 5),
+                                                   create_storm('2005100N10100', 'NA', 8)])
+
+    def test_1_storms_sorted_by_year(self):
+        assert list(self.archive.storm_names) == ['2004100N10100', '2005100N10100',
+                                                  '2005236N23285']
+        assert list(self.archive.storm_offsets) == [0, 5, 13, 23]
+
+    def test_2_year_storms(self):
+        assert self.archive.year_storms(2005) == slice(1, 3)
+        assert self.archive.year_storms(2006) == slice(3, 3)
+
+    def test_3_best_track(self):
+        best_track = self.archive.best_track(2)
+        assert best_track.name == '2005236N23285'
+        assert best_track.dates[1] == dt.datetime(2005, 8, 1, 6)
+        assert len(best_track.lons) == 10
+        assert best_track.is_hurricane
+
+    def test_4_save_and_load(self):
+        tmp_dir = mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'archive.npz')
+            self.archive.save(path)
+            archive = IbtracsArchive.load(path)
+            assert (archive.date == self.archive.date).all()
+            assert (archive.cls == self.archive.cls).all()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_5_storm_mask(self):
+        assert list(self.archive.storm_mask(years=[2005])) == [False, True, True]
+        assert list(self.archive.storm_mask(basins=['WP'])) == [True, False, False]
+        assert list(self.archive.storm_mask([2004, 2005], ['NA', 'SP'])) == [False, True, True]
+
+    def test_6_obs_mask(self):
+        mask = self.archive.obs_mask(basins=['NA'], classes=['HU'])
+        assert list(np.where(mask)[0]) == [12, 22]
+        mask = self.archive.obs_mask(years=[2005], bbox=(300., 310., 0., 20.))
+        assert list(self.archive.storm[mask]) == [1] * 4 + [2] * 5
+
+    def test_7_resample(self):
+        storm = create_storm('2005100N10100', 'NA', 3)
+        # Fixes at 00Z, 12Z and 21Z, on the equator.
+        storm['date'] = storm['date'][0] + np.array([0, 12, 21]) * np.timedelta64(1, 'h')
+        storm['lat'][:] = 0.
+        storm['lon'] = np.array([300., 310., 319.], dtype=np.float32)
+        archive = IbtracsArchive.from_storms([storm])
+        dates = [dt.datetime(2005, 8, 1) + dt.timedelta(hours=6 * i) for i in range(-2, 6)]
+
+        resampled = archive.resample(dates)
+        assert list(resampled.storm_offsets) == [0, 4]
+        assert list(resampled.date.astype(dt.datetime)) == dates[2:6]
+        assert np.allclose(resampled.lon, [300., 305., 310., 316.])
+        assert np.allclose(resampled.lat, 0.)
+        assert np.allclose(resampled.wind, [30., 47.5, 65., 88.3333])
+        assert list(resampled.cls) == ['TS', 'TS', 'TS', 'HU']
+
+    def test_8_climatology(self):
+        climatology = self.archive.climatology()
+        assert list(climatology.year) == [2004, 2005]
+        assert list(climatology.basin) == ['WP', 'NA']
+        assert list(climatology.storm_count) == [1, 2]
+        assert list(climatology.hurricane_fix_count) == [1, 2]
+        assert list(climatology.pdi) == [1e6, 2e6]
+
+
+class TestIbtracsQuery:
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        archive = IbtracsArchive.from_storms([create_storm('2005236N23285', 'NA', 10),
+                                              create_storm('2004100N10100', 'WP', 5)])
+        archive.save(os.path.join(self.tmp_dir, 'archive.npz'))
+        self.ibdata = IbtracsData(self.tmp_dir, verbose=False,
+                                  archive_path=os.path.join(self.tmp_dir, 'archive.npz'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_1_query(self):
+        obs = self.ibdata.query(years=range(2000, 2010), classes=['HU'])
+        assert list(obs['storm']) == [0, 1]
+        assert list(obs['wind']) == [100., 100.]
+
+    def test_2_iter_storms(self):
+        best_tracks = list(self.ibdata.iter_storms(basins=['NA']))
+        assert [bt.name for bt in best_tracks] == ['2005236N23285']
+        assert len(best_tracks[0].dates) == 10
+
+    def test_3_year_climatology(self):
+        climatology = self.ibdata.year_climatology([2004, 2005, 2006])
+        assert list(climatology.hurricane_count) == [0, 1, 0]
+        # Loaded from the cache the second time.
+        climatology = IbtracsData(self.tmp_dir, verbose=False,
+                                  archive_path=self.ibdata.archive_path).climatology
+        assert list(climatology.basin) == ['WP', 'NA']
+
+
+class TestBuildArchive:
+    def test_1_failures_are_collected(self):
+        tmp_dir = mkdtemp()
+        try:
+            with open(os.path.join(tmp_dir, '2005001N00000.ibtracs.nc'), 'w') as f:
+                f.write('not a netcdf file')
+            ibdata = IbtracsData(tmp_dir, verbose=False)
+            archive = ibdata.build_archive(num_procs=1)
+            assert len(archive) == 0
+            assert len(ibdata.failures) == 1
+            assert ibdata.failures[0][0].endswith('2005001N00000.ibtracs.nc')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_2_rebuilt_when_files_change(self):
+        tmp_dir = mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, '2005001N00000.ibtracs.nc')
+            with open(path, 'w') as f:
+                f.write('not a netcdf file')
+            IbtracsData(tmp_dir, verbose=False).build_archive(num_procs=1)
+
+            # Unchanged, so loaded rather than rebuilt.
+            ibdata = IbtracsData(tmp_dir, verbose=False)
+            ibdata.archive
+            assert ibdata.failures == []
+            assert list(ibdata.archive.source_files) == [path]
+
+            os.utime(path, (0, 0))
+            ibdata = IbtracsData(tmp_dir, verbose=False)
+            ibdata.archive
+            assert len(ibdata.failures) == 1
+
+            with open(os.path.join(tmp_dir, '2005002N00000.ibtracs.nc'), 'w') as f:
+                f.write('not a netcdf file')
+            ibdata = IbtracsData(tmp_dir, verbose=False)
+            ibdata.archive
+            assert len(ibdata.failures) == 2
+
+            # Archives saved without their source files are always rebuilt.
+            archive = IbtracsArchive.from_storms([])
+            archive.source_files = archive.source_mtimes = None
+            archive.save(ibdata.archive_path)
+            ibdata = IbtracsData(tmp_dir, verbose=False)
+            ibdata.archive
+            assert len(ibdata.failures) == 2
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,58 @@
+import sys
+sys.path.insert(0, '..')
+
+import os
+from tempfile import mkdtemp
+import shutil
+
+import numpy as np
+import pandas as pd
+from nose.plugins.skip import SkipTest
+
+from stormtracks.processing.schema import ALL_FIELDS_SCHEMA, apply_schema
+from stormtracks.results import StormtracksResultsManager
+
+
+def create_all_fields():
+    return pd.DataFrame({'date': ['2005-08-01 00:00', '2005-08-01 06:00'],
+                         'em': [0, 55],
+                         'lon': [300., 302.],
+                         'lat': [20., 22.],
+                         'vort850': [1e-4, 2e-4],
+                         'extra': [1, 2]})
+
+
+class TestApplySchema:
+    def test_1_casts_to_schema(self):
+        df = apply_schema(create_all_fields(), ALL_FIELDS_SCHEMA)
+        assert df.date.dtype == np.dtype('datetime64[ns]')
+        assert df.em.dtype == np.int8
+        assert df.lon.dtype == np.float32
+        assert df.vort850.dtype == np.float32
+        # Columns not in the schema are left alone.
+        assert df.extra.dtype == np.int64
+
+    def test_2_round_trip(self):
+        df = apply_schema(create_all_fields(), ALL_FIELDS_SCHEMA)
+        round_tripped = apply_schema(df.copy(), ALL_FIELDS_SCHEMA)
+        assert (round_tripped.dtypes == df.dtypes).all()
+        assert round_tripped.equals(df)
+
+    def test_3_save_result_leaves_caller_frame_alone(self):
+        try:
+            import tables
+        except ImportError:
+            raise SkipTest('PyTables is needed to save results')
+        tmp_dir = mkdtemp()
+        try:
+            df = create_all_fields()
+            dtypes = df.dtypes.copy()
+            results_manager = StormtracksResultsManager('test', tmp_dir)
+            results_manager.save_result(2005, 'all_fields', df)
+            assert (df.dtypes == dtypes).all()
+
+            loaded = results_manager.get_result(2005, 'all_fields')
+            assert loaded.em.dtype == np.int8
+            assert loaded.lon.dtype == np.float32
+        finally:
+            shutil.rmtree(tmp_dir)